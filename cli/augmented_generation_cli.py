@@ -1,7 +1,25 @@
-import argparse
+import sys, argparse
 
-from lib.augmented_generation import rag_command, summarize_command, citations_command, question_command
-from lib.search_utils import DEFAULT_SEARCH_LIMIT
+from lib.augmented_generation import rag_command, summarize_command, citations_command, question_command, stream_command, format_stream_stats
+from lib.search_utils import DEFAULT_SEARCH_LIMIT, DEFAULT_SEARCH_SERVER, RAG_CONTEXT_TOKENS
+from lib.search_client import rag_request
+from lib.tracing import add_profile_arguments, start_profiling
+
+STREAM_HEADINGS = {"rag": "RAG Response:", "summarize": "LLM Summary:", "citations": "LLM Answer:", "question": "Answer:"}
+
+def print_stream(events, heading):
+    for kind, value in events:
+        match kind:
+            case "results":
+                print("Search Results:")
+                for title in value:
+                    print(title)
+                print(f"\n{heading}", flush=True)
+            case "text":
+                print(value, end="", flush=True)
+            case "done":
+                print()
+                print(format_stream_stats(value), file=sys.stderr)
 
 def main():
     parser = argparse.ArgumentParser(description="Retrieval Augmented Generation CLI")
@@ -9,22 +27,42 @@ def main():
     
     rag_parser = subparsers.add_parser("rag", help="Perform RAG (search + generate answer)")
     rag_parser.add_argument("query", type=str, help="Search query for RAG")
+    rag_parser.add_argument("--server", type=str, nargs='?', const=DEFAULT_SEARCH_SERVER, help="Send the request to a running search_server_cli.py instead of loading models locally")
     summarize_parser = subparsers.add_parser("summarize", help="Synthetize multiple search result")
     summarize_parser.add_argument("query", type=str, help="Search query for summarization")
     summarize_parser.add_argument("--limit", type=int, nargs='?', default=DEFAULT_SEARCH_LIMIT, help="Limit search")
+    summarize_parser.add_argument("--server", type=str, nargs='?', const=DEFAULT_SEARCH_SERVER, help="Send the request to a running search_server_cli.py instead of loading models locally")
     citations_parser = subparsers.add_parser("citations", help="Reference sources")
     citations_parser.add_argument("query", type=str, help="Search query for citations")
     citations_parser.add_argument("--limit", type=int, nargs='?', default=DEFAULT_SEARCH_LIMIT, help="Limit search")
+    citations_parser.add_argument("--server", type=str, nargs='?', const=DEFAULT_SEARCH_SERVER, help="Send the request to a running search_server_cli.py instead of loading models locally")
     question_parser = subparsers.add_parser("question", help="Ask the llm")
     question_parser.add_argument("question", type=str, help="Question to ask the llm")
     question_parser.add_argument("--limit", type=int, nargs='?', default=DEFAULT_SEARCH_LIMIT, help="Limit search")
+    question_parser.add_argument("--server", type=str, nargs='?', const=DEFAULT_SEARCH_SERVER, help="Send the request to a running search_server_cli.py instead of loading models locally")
     
+    for subparser in (rag_parser, summarize_parser, citations_parser, question_parser):
+        subparser.add_argument("--context-tokens", type=int, default=RAG_CONTEXT_TOKENS, help="Token budget for the retrieved passages in the prompt (0 sends whole descriptions; ignored with --server)")
+        subparser.add_argument("--stream", action="store_true", help="Print the search results as soon as they are ready and the answer as it is generated, then the time to first token")
+
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    start_profiling(args)
+
+    if getattr(args, "stream", False):
+        if args.server:
+            parser.error("--stream runs the search and generation locally and cannot be combined with --server")
+        query = args.question if args.command == "question" else args.query
+        print_stream(stream_command(args.command, query, getattr(args, "limit", DEFAULT_SEARCH_LIMIT), context_tokens=args.context_tokens), STREAM_HEADINGS[args.command])
+        return
 
     match args.command:
         case "rag":
             query = args.query
-            titles, generated_answer = rag_command(query)
+            if args.server:
+                titles, generated_answer = rag_request(args.server, "rag", query)
+            else:
+                titles, generated_answer = rag_command(query, context_tokens=args.context_tokens)
             print("Search Results:")
             for title in titles:
                 print(title)
@@ -32,7 +70,10 @@ def main():
             print(generated_answer)
         case "summarize":
             query, limit = args.query, args.limit
-            titles, generated_summary = summarize_command(query, limit)
+            if args.server:
+                titles, generated_summary = rag_request(args.server, "summarize", query, limit)
+            else:
+                titles, generated_summary = summarize_command(query, limit, context_tokens=args.context_tokens)
             print("Search Results:")
             for title in titles: 
                 print(title)
@@ -40,7 +81,10 @@ def main():
             print(generated_summary)
         case "citations":
             query, limit = args.query, args.limit
-            titles, generated_answer_citations = citations_command(query, limit)
+            if args.server:
+                titles, generated_answer_citations = rag_request(args.server, "citations", query, limit)
+            else:
+                titles, generated_answer_citations = citations_command(query, limit, context_tokens=args.context_tokens)
             print("Search Results:")
             for title in titles: 
                 print(title)
@@ -48,7 +92,10 @@ def main():
             print(generated_answer_citations)    
         case "question":
             question, limit = args.question, args.limit
-            titles, generated_question_answer = question_command(question, limit)
+            if args.server:
+                titles, generated_question_answer = rag_request(args.server, "question", question, limit)
+            else:
+                titles, generated_question_answer = question_command(question, limit, context_tokens=args.context_tokens)
             print("Search Results:")
             for title in titles: 
                 print(title)
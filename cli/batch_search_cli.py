@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+import sys, argparse
+from lib.batch_search import batch_search_command, BATCH_METHODS
+from lib.search_utils import DEFAULT_SEARCH_LIMIT, DEFAULT_ALPHA_HYBRID, RRF_K1, SEARCH_BATCH_SIZE
+from lib.tracing import add_profile_arguments, start_profiling
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Batch Search CLI")
+    subparsers = parser.add_subparsers(dest="command", help="Available commands")
+    search_parser = subparsers.add_parser("search", help="Search every query in a file and stream the results as JSONL")
+    search_parser.add_argument("input", type=str, help="File with one query per line or JSONL records with a 'query' field ('-' reads stdin)")
+    search_parser.add_argument("--method", type=str, choices=BATCH_METHODS, default="rrf", help="Search method")
+    search_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help="Results per query")
+    search_parser.add_argument("--output", type=str, help="Write results to this file instead of stdout")
+    search_parser.add_argument("--batch-size", type=int, default=SEARCH_BATCH_SIZE, help="Queries encoded and scored together")
+    search_parser.add_argument("--alpha", type=float, default=DEFAULT_ALPHA_HYBRID, help="Weighting between BM25 and semantic scores for --method weighted")
+    search_parser.add_argument("-k", type=float, default=RRF_K1, help="RRF constant for --method rrf")
+    search_parser.add_argument("--nprobe", type=int, help="Use the chunk ANN index for the semantic branch, probing this many lists")
+    search_parser.add_argument("--depth", type=int, help="Candidates taken from each retriever before hybrid fusion (defaults to limit * 500)")
+
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    start_profiling(args)
+
+    match args.command:
+        case "search":
+            count = batch_search_command(args.input, args.method, args.limit, args.output, args.batch_size, args.nprobe, args.depth, args.alpha, args.k)
+            print(f"Searched {count} queries", file=sys.stderr)
+        case _:
+            parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+import argparse
+from lib.benchmarks import tokenizer_benchmark, bm25_pruning_benchmark, dense_retrieval_benchmark, ann_benchmark, quantization_benchmark, startup_benchmark, import_time_benchmark, CLI_ENTRY_POINTS, hybrid_stage_benchmark, rerank_benchmark, llm_scheduler_benchmark, context_benchmark, embedding_build_benchmark, sharded_search_benchmark
+from lib.search_utils import RAG_CONTEXT_TOKENS, EMBED_BATCH_SIZE, EMBED_SORT_WINDOW
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark CLI")
+    subparsers = parser.add_subparsers(dest="command", help="Available commands")
+    tokenizer_parser = subparsers.add_parser("tokenizer", help="Compare tokens per second of the legacy and cached tokenizer")
+    tokenizer_parser.add_argument("--limit", type=int, default=500, help="Number of movies to tokenize")
+    tokenizer_parser.add_argument("--repeat", type=int, default=3, help="Number of passes with the cached tokenizer")
+    bm25_pruning_parser = subparsers.add_parser("bm25-pruning", help="Compare exhaustive BM25 scoring with WAND and Block-Max WAND")
+    bm25_pruning_parser.add_argument("--limit", type=int, default=5, help="Top-k to retrieve")
+    bm25_pruning_parser.add_argument("--query", type=str, action="append", help="Query to run (defaults to the golden dataset queries)")
+    dense_parser = subparsers.add_parser("dense", help="Latency of matrix-based dense retrieval against the per-row cosine loop")
+    dense_parser.add_argument("--sizes", type=int, nargs="+", default=[5_000, 50_000, 250_000, 1_000_000], help="Corpus sizes (number of vectors)")
+    dense_parser.add_argument("--dim", type=int, default=384, help="Embedding dimensions")
+    dense_parser.add_argument("--limit", type=int, default=5, help="Top-k to retrieve")
+    dense_parser.add_argument("--queries", type=int, default=20, help="Queries per corpus size")
+    dense_parser.add_argument("--legacy-max", type=int, default=50_000, help="Largest corpus to also time with the per-row loop")
+    ann_parser = subparsers.add_parser("ann", help="Recall@k versus latency of the IVF index against brute force")
+    ann_parser.add_argument("--size", type=int, default=200_000, help="Number of synthetic vectors")
+    ann_parser.add_argument("--dim", type=int, default=384, help="Embedding dimensions")
+    ann_parser.add_argument("--lists", type=int, help="Number of inverted lists (defaults to 4 * sqrt(size))")
+    ann_parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64], help="nprobe values to sweep")
+    ann_parser.add_argument("--limit", type=int, default=10, help="k for recall@k")
+    ann_parser.add_argument("--queries", type=int, default=100, help="Number of queries")
+    ann_parser.add_argument("--use-cache", action="store_true", help="Use cache/chunk_embeddings.npy instead of synthetic vectors")
+    quantization_parser = subparsers.add_parser("quantization", help="Memory saved and recall lost for each embedding storage encoding")
+    quantization_parser.add_argument("--size", type=int, default=100_000, help="Number of synthetic vectors")
+    quantization_parser.add_argument("--dim", type=int, default=384, help="Embedding dimensions")
+    quantization_parser.add_argument("--limit", type=int, default=10, help="k for recall@k")
+    quantization_parser.add_argument("--queries", type=int, default=100, help="Number of queries")
+    quantization_parser.add_argument("--embeddings", type=str, help="Path to a cached .npy embedding matrix to use instead of synthetic vectors")
+    startup_parser = subparsers.add_parser("startup", help="Wall time of hybrid_search_cli.py rrf-search with a cold and a warm page cache")
+    startup_parser.add_argument("--query", type=str, default="family movie about bears", help="Query to search")
+    startup_parser.add_argument("--runs", type=int, default=5, help="Runs per cache state")
+    imports_parser = subparsers.add_parser("imports", help="Module import time of each CLI entry point, measured with python -X importtime")
+    imports_parser.add_argument("--entry-point", type=str, action="append", choices=CLI_ENTRY_POINTS, help="CLI to measure (defaults to all)")
+    imports_parser.add_argument("--runs", type=int, default=3, help="Runs per CLI (the fastest is reported)")
+    imports_parser.add_argument("--top", type=int, default=5, help="Number of heaviest top-level imports to list")
+    imports_parser.add_argument("--max-ms", type=float, help="Exit with an error if any CLI spends longer than this importing modules")
+    hybrid_parser = subparsers.add_parser("hybrid", help="Latency of each hybrid search stage (retrieval, fusion, formatting)")
+    hybrid_parser.add_argument("--limit", type=int, default=5, help="Results per query")
+    hybrid_parser.add_argument("--depth", type=int, help="Candidates per retriever (defaults to limit * 500)")
+    hybrid_parser.add_argument("--query", type=str, action="append", help="Query to run (defaults to the golden dataset queries)")
+    rerank_parser = subparsers.add_parser("rerank", help="Cross-encoder reranking throughput (pairs/s) per batch size, cold and cached")
+    rerank_parser.add_argument("--top-n", type=int, default=25, help="Fused candidates re-ranked per query")
+    rerank_parser.add_argument("--batch-size", type=int, action="append", help="Batch size to try (repeatable; defaults to 8, 16, 32 and 64)")
+    rerank_parser.add_argument("--query", type=str, action="append", help="Query to run (defaults to the golden dataset queries)")
+    llm_parser = subparsers.add_parser("llm", help="Individual LLM reranking through the rate-limited scheduler, against an offline stub client")
+    llm_parser.add_argument("--candidates", type=int, default=25, help="Results to rerank, one request each")
+    llm_parser.add_argument("--rpm", type=int, help="Requests per minute quota (defaults to the rerank model's)")
+    llm_parser.add_argument("--tpm", type=int, help="Tokens per minute quota (defaults to the rerank model's)")
+    llm_parser.add_argument("--latency", type=float, default=0.5, help="Seconds the stub takes per request")
+    llm_parser.add_argument("--failure-rate", type=float, default=0.1, help="Fraction of stub requests that fail with a retryable 429")
+    llm_parser.add_argument("--concurrency", type=int, default=4, help="Maximum requests in flight")
+    context_parser = subparsers.add_parser("context", help="Prompt tokens and answer relevance of token-budgeted RAG context against whole descriptions, on the golden dataset")
+    context_parser.add_argument("--limit", type=int, default=5, help="Results retrieved per query")
+    context_parser.add_argument("--budget", type=int, action="append", help="Context token budget to compare (repeatable)")
+    context_parser.add_argument("--no-judge", action="store_true", help="Skip generating and rating answers (no LLM calls)")
+    embed_parser = subparsers.add_parser("embed", help="Chunks/s and peak RSS of the streaming chunk embedding build against the previous in-memory build, as the corpus grows")
+    embed_parser.add_argument("--scale", type=int, action="append", help="Copies of the corpus to build (repeatable, default 1, 2 and 4)")
+    embed_parser.add_argument("--limit", type=int, help="Use only the first N movies of each copy")
+    embed_parser.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE, help="Chunks per encode batch")
+    embed_parser.add_argument("--window", type=int, default=EMBED_SORT_WINDOW, help="Chunks read and sorted by length at a time")
+    shards_parser = subparsers.add_parser("shards", help="Throughput and p99 latency of hybrid search scattered across 1-8 shard processes")
+    shards_parser.add_argument("--shards", type=int, action="append", help="Shard count to try (repeatable; defaults to 1, 2, 4 and 8)")
+    shards_parser.add_argument("--limit", type=int, default=5, help="Results per query")
+    shards_parser.add_argument("--concurrency", type=int, default=8, help="Client threads issuing queries")
+    shards_parser.add_argument("--repeat", type=int, default=5, help="Passes over the queries")
+    shards_parser.add_argument("--query", type=str, action="append", help="Query to run (defaults to the golden dataset queries)")
+
+    args = parser.parse_args()
+
+    match args.command:
+        case "tokenizer":
+            report = tokenizer_benchmark(args.limit, args.repeat)
+            print(f"Tokenized {report['documents']} documents ({report['tokens']} tokens)")
+            print(f"Legacy tokenize_text: {report['legacy_tokens_per_second']:,.0f} tokens/s")
+            print(f"Tokenizer (cold cache): {report['cold_tokens_per_second']:,.0f} tokens/s")
+            print(f"Tokenizer (warm cache): {report['warm_tokens_per_second']:,.0f} tokens/s")
+            print(f"Stem cache: {report['stem_cache']}")
+        case "bm25-pruning":
+            report = bm25_pruning_benchmark(args.limit, args.query)
+            print(f"Ran {report['queries']} queries with limit={report['limit']}")
+            for method, totals in report["methods"].items():
+                print(f"- {method}: {totals['seconds'] * 1000:.1f} ms, scored {totals['scored']} of {totals['matched']} matching documents (skipped {totals['skipped']}), identical to exhaustive: {report['identical'][method]}")
+        case "dense":
+            report = dense_retrieval_benchmark(args.sizes, args.dim, args.limit, args.queries, args.legacy_max)
+            for row in report:
+                legacy = f"{row['legacy_ms']:.1f} ms (same top-k: {row['same_top_k']})" if row["legacy_ms"] is not None else "skipped"
+                print(f"{row['size']:>9} vectors: normalize {row['build_ms']:.1f} ms, search p50 {row['dense_p50_ms']:.2f} ms, p99 {row['dense_p99_ms']:.2f} ms, per-row loop {legacy}")
+        case "ann":
+            report = ann_benchmark(args.size, args.dim, args.lists, args.nprobe, args.limit, args.queries, args.use_cache)
+            print(f"IVF over {report['vectors']} vectors with {report['lists']} lists (built in {report['build_seconds']:.1f}s)")
+            for row in report["rows"]:
+                print(f"- nprobe={row['nprobe']}: recall@{report['limit']} {row['recall']:.3f}, p50 {row['p50_ms']:.2f} ms, p99 {row['p99_ms']:.2f} ms, {row['candidates']:.0f} candidates")
+        case "quantization":
+            report = quantization_benchmark(args.size, args.dim, args.limit, args.queries, args.embeddings)
+            print(f"{report['vectors']} vectors x {report['dim']} dimensions, recall@{report['limit']}")
+            for row in report["rows"]:
+                print(f"- {row['encoding']}: {row['bytes'] / 2**20:.1f} MiB ({row['saved']:.1%} saved), recall {row['recall']:.3f}, with re-ranking {row['rerank_recall']:.3f}, p50 {row['p50_ms']:.2f} ms, encoded in {row['build_seconds']:.1f}s")
+        case "startup":
+            report = startup_benchmark(args.query, args.runs)
+            print(f"{report['command']} ({report['runs']} runs each, {report['evicted_bytes'] / 2**20:.1f} MiB evicted before cold runs)")
+            for mode in ("cold", "warm"):
+                print(f"- {mode}: p50 {report[f'{mode}_p50_seconds'] * 1000:.0f} ms, min {report[f'{mode}_min_seconds'] * 1000:.0f} ms")
+        case "imports":
+            report = import_time_benchmark(args.entry_point or CLI_ENTRY_POINTS, args.runs, args.top)
+            over_budget = []
+            for row in report:
+                print(f"{row['entry_point']}: imports {row['import_us'] / 1000:.0f} ms, --help wall time {row['wall_seconds'] * 1000:.0f} ms")
+                for name, cumulative in row["heaviest"]:
+                    print(f"   {cumulative / 1000:8.1f} ms  {name}")
+                if row["returncode"] != 0:
+                    over_budget.append(f"{row['entry_point']} exited with {row['returncode']}")
+                elif args.max_ms is not None and row["import_us"] / 1000 > args.max_ms:
+                    over_budget.append(f"{row['entry_point']} imports took {row['import_us'] / 1000:.0f} ms (budget {args.max_ms:.0f} ms)")
+            if over_budget:
+                parser.exit(1, "\n".join(over_budget) + "\n")
+        case "hybrid":
+            report = hybrid_stage_benchmark(args.limit, args.depth, args.query)
+            print(f"Loaded hybrid search in {report['load_seconds'] * 1000:.0f} ms; {report['queries']} queries, limit={report['limit']}, depth={report['depth']}")
+            for name, row in report["stages"].items():
+                print(f"- {name}: p50 {row['p50_ms']:.2f} ms, p99 {row['p99_ms']:.2f} ms")
+            for name, row in report["saved_ms"].items():
+                print(f"Concurrent branches saved {row['p50']:.2f} ms per query at p50 ({row['mean']:.2f} ms mean), {name} query embedding")
+        case "rerank":
+            report = rerank_benchmark(args.top_n, args.batch_size or (8, 16, 32, 64), args.query)
+            print(f"Loaded cross-encoder in {report['load_seconds'] * 1000:.0f} ms; {report['queries']} queries, top {report['top_n']} candidates each")
+            print(f"- previous (uncached, stringified documents): {report['previous_pairs_per_second']:.0f} pairs/s")
+            for batch_size, row in report["batch_sizes"].items():
+                print(f"- batch {batch_size}: {row['pairs_per_second']:.0f} pairs/s, {row['cold_ms_per_query']:.2f} ms/query cold, {row['warm_ms_per_query']:.2f} ms/query cached ({row['hit_rate']:.0%} hits)")
+        case "llm":
+            report = llm_scheduler_benchmark(args.candidates, args.rpm, args.tpm, args.latency, args.failure_rate, args.concurrency)
+            print(f"Reranked {report['candidates']} candidates in {report['seconds']:.1f} s at {report['requests_per_minute']} RPM / {report['tokens_per_minute']} TPM, concurrency {report['max_concurrency']} (fixed 60 s sleep: {report['previous_seconds']:.0f} s)")
+            print(f"- {report['stub_calls']} stub calls, {report['retries']} retries, {report['failures']} failures; {report['throttled_seconds']:.1f} request-seconds waiting for quota, {report['backoff_seconds']:.1f} backing off")
+        case "context":
+            report = context_benchmark(args.limit, args.budget or (RAG_CONTEXT_TOKENS,), not args.no_judge)
+            print(f"{report['queries']} golden queries, {report['limit']} results each")
+            for name, row in report["variants"].items():
+                line = f"- {name}: {row['prompt_tokens']:.0f} prompt tokens ({row['saved']:.0%} saved), {row['relevant_in_context']:.0%} of relevant movies in context, packed in {row['pack_ms']:.2f} ms"
+                if "answer_relevance" in row:
+                    line += f", answer relevance {row['answer_relevance']:.2f}/10"
+                print(line)
+        case "embed":
+            report = embedding_build_benchmark(args.scale or (1, 2, 4), args.batch_size, args.window, args.limit)
+            print(f"Batch size {report['batch_size']}, sort window {report['window']} chunks")
+            for row in report["rows"]:
+                print(f"- {row['documents']} documents, {row['build']}: {row['chunks']} chunks in {row['seconds']:.1f} s ({row['chunks_per_second']:.0f} chunks/s), peak RSS {row['peak_rss_bytes'] / 2**20:.0f} MiB (+{row['rss_growth_bytes'] / 2**20:.0f} MiB)")
+        case "shards":
+            report = sharded_search_benchmark(args.shards or (1, 2, 4, 8), args.limit, args.concurrency, args.repeat, args.query)
+            print(f"{report['queries']} RRF queries (limit {report['limit']}, depth {report['depth']}) from {report['concurrency']} client threads on {report['cpus']} CPUs")
+            for row in report["rows"]:
+                name = f"{row['shards']} shards" if row["shards"] else "unsharded"
+                print(f"- {name}: {row['queries_per_second']:.1f} queries/s, p50 {row['p50_ms']:.1f} ms, p99 {row['p99_ms']:.1f} ms, loaded in {row['load_seconds']:.1f} s; {row['mismatched']} candidate lists differ, max score difference {row['max_score_diff']:.2g}")
+        case _:
+            parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
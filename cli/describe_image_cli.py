@@ -1,11 +1,8 @@
-import argparse, mimetypes, os
+import argparse, mimetypes
 
-from dotenv import load_dotenv
-from google import genai
+from lib.llm_client import generate_content
+from lib.tracing import add_profile_arguments, start_profiling
 
-load_dotenv()
-api_key = os.getenv("gemini_api_key")
-client = genai.Client(api_key=api_key)
 model = "gemini-2.5-flash"
 
 def main():
@@ -13,7 +10,9 @@ def main():
     parser.add_argument("--image", type=str, help="The path to the image file")
     parser.add_argument("--query", type=str, help="The query to rewrite based on the image")
 
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    start_profiling(args)
 
     mime, _ = mimetypes.guess_type(args.image)
     mime = mime or "image/jpeg"
@@ -28,13 +27,14 @@ def main():
             - Return only the rewritten query, without any additional commentary
             """
 
+    from google.genai import types
     parts = [
         system_prompt,
-        genai.types.Part.from_bytes(data=img, mime_type=mime),
+        types.Part.from_bytes(data=img, mime_type=mime),
         args.query.strip(),
     ]
 
-    response = client.models.generate_content(model=model, contents=parts)
+    response = generate_content(model, parts)
     corrected = (response.text or "").strip().strip('"')
     
     print(f"Rewritten query: {corrected}")
@@ -1,6 +1,10 @@
 import argparse
 
 from lib.evaluation import evaluate_command
+from lib.query_cache import get_query_cache, format_cache_stats
+from lib.llm_client import get_llm_cache
+from lib.llm_cache import format_llm_cache_stats
+from lib.tracing import add_profile_arguments, start_profiling
 
 
 def main() -> None:
@@ -12,7 +16,9 @@ def main() -> None:
         help="Number of results to evaluate (k for precision@k, recall@k)",
     )
 
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    start_profiling(args)
     result = evaluate_command(args.limit)
 
     print(f"k={args.limit}\n")
@@ -24,6 +30,8 @@ def main() -> None:
         print(f"  - Retrieved: {', '.join(res['retrieved'])}")
         print(f"  - Relevant: {', '.join(res['relevant'])}")
         print()
+    print(format_cache_stats(get_query_cache().stats()))
+    print(format_llm_cache_stats(get_llm_cache().stats()))
 
 
 if __name__ == "__main__":
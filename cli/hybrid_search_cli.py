@@ -1,7 +1,9 @@
 import argparse
-from lib.hybrid_search import normalize_command, weighted_search_command, rrf_search_command
-from lib.search_utils import DEFAULT_ALPHA_HYBRID, DEFAULT_SEARCH_LIMIT, RRF_K1
+from lib.hybrid_search import HybridSearch, normalize_command, weighted_search_command, rrf_search_command, branch_timeouts, format_branch_stats
+from lib.search_utils import DEFAULT_ALPHA_HYBRID, DEFAULT_SEARCH_LIMIT, RRF_K1, DEFAULT_SEARCH_SERVER, load_movies
+from lib.search_client import server_request
 from lib.evaluation import llm_evaluation
+from lib.tracing import add_profile_arguments, start_profiling
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="Hybrid Search CLI")
@@ -12,15 +14,34 @@ def main() -> None:
     weighted_search_parser.add_argument("query", type=str, help="Query to search")
     weighted_search_parser.add_argument("--alpha", type=float, nargs='?', default=DEFAULT_ALPHA_HYBRID, help="Constant to control the weighting between scores")
     weighted_search_parser.add_argument("--limit", type=int, nargs='?', default=DEFAULT_SEARCH_LIMIT, help="Limit search")
+    weighted_search_parser.add_argument("--nprobe", type=int, help="Use the chunk ANN index for the semantic branch, probing this many lists")
+    weighted_search_parser.add_argument("--depth", type=int, help="Candidates taken from each retriever before fusion (defaults to limit * 500)")
+    weighted_search_parser.add_argument("--bm25-timeout", type=float, help="Seconds to wait for the BM25 branch before fusing semantic results alone")
+    weighted_search_parser.add_argument("--semantic-timeout", type=float, help="Seconds to wait for the semantic branch before fusing BM25 results alone")
+    weighted_search_parser.add_argument("--sequential", action="store_true", help="Run the retrievers one after the other instead of concurrently")
+    weighted_search_parser.add_argument("--timing", action="store_true", help="Print per-branch latency and the time saved by running branches concurrently")
+    weighted_search_parser.add_argument("--server", type=str, nargs='?', const=DEFAULT_SEARCH_SERVER, help="Send the request to a running search_server_cli.py instead of loading models locally")
     rrf_search_parser = subparsers.add_parser("rrf-search", help="RRF Search")
     rrf_search_parser.add_argument("query", type=str, help="Query to search")
     rrf_search_parser.add_argument("-k", type=float, nargs='?', default=RRF_K1, help="Constant to control the weighting of higher vs lower ranked results")
     rrf_search_parser.add_argument("--limit", type=int, nargs='?', default=DEFAULT_SEARCH_LIMIT, help="Limit search")
     rrf_search_parser.add_argument("--enhance", type=str, nargs='?', choices=["spell", "rewrite", "expand"], help="Query enhancement method")
     rrf_search_parser.add_argument("--rerank-method", type=str, nargs='?', choices=["individual", "batch", "cross_encoder"], help="Re-rank method")
+    rrf_search_parser.add_argument("--rerank-top-n", type=int, help="Re-rank only this many of the fused candidates (defaults to limit * 5)")
     rrf_search_parser.add_argument("--evaluate", action="store_true", help="Enable LLM-based evaluation of search results")
+    rrf_search_parser.add_argument("--nprobe", type=int, help="Use the chunk ANN index for the semantic branch, probing this many lists")
+    rrf_search_parser.add_argument("--depth", type=int, help="Candidates taken from each retriever before fusion (defaults to limit * 500)")
+    rrf_search_parser.add_argument("--bm25-timeout", type=float, help="Seconds to wait for the BM25 branch before fusing semantic results alone")
+    rrf_search_parser.add_argument("--semantic-timeout", type=float, help="Seconds to wait for the semantic branch before fusing BM25 results alone")
+    rrf_search_parser.add_argument("--enhance-timeout", type=float, help="Seconds to wait for query enhancement before searching the original query")
+    rrf_search_parser.add_argument("--sequential", action="store_true", help="Run the retrievers one after the other instead of concurrently")
+    rrf_search_parser.add_argument("--timing", action="store_true", help="Print per-branch latency and the time saved by running branches concurrently")
+    rrf_search_parser.add_argument("--server", type=str, nargs='?', const=DEFAULT_SEARCH_SERVER, help="Send the request to a running search_server_cli.py instead of loading models locally")
+    rrf_search_parser.add_argument("--shards", type=int, help="Run both retrievers in this many shard worker processes (exact chunk scoring, so not with --nprobe)")
 
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    start_profiling(args)
 
     match args.command:
         case "normalize":
@@ -28,11 +49,33 @@ def main() -> None:
             for score in normalized:
                 print(f"* {score:.4f}")
         case "weighted-search":
-            scores = weighted_search_command(args.query, args.alpha, args.limit)
+            timeouts = branch_timeouts(args.bm25_timeout, args.semantic_timeout)
+            hybrid_search = None
+            if args.server:
+                scores = server_request(args.server, "weighted", {"query": args.query, "alpha": args.alpha, "limit": args.limit, "nprobe": args.nprobe, "depth": args.depth, "timeouts": timeouts})
+            else:
+                hybrid_search = HybridSearch(load_movies(), args.nprobe, concurrent=not args.sequential)
+                scores = weighted_search_command(args.query, args.alpha, args.limit, args.nprobe, hybrid_search, args.depth, timeouts)
             for i, score in enumerate(scores):
                 print(f"\n{i}. {score['document']['title']}\nHybrid Score: {score['hybrid_score']:.4f})\nBM25: {score['bm25_score']:.4f}, Semantic: {score['semantic_score']:.4f}\n{score['document']['description'][:123]}...")
+            if args.timing and hybrid_search:
+                print(f"\n{format_branch_stats(hybrid_search.last_search_stats)}")
+            if hybrid_search:
+                hybrid_search.close()
         case "rrf-search":
-            result = rrf_search_command(args.query, args.k, args.enhance, args.rerank_method, args.limit)
+            timeouts = branch_timeouts(args.bm25_timeout, args.semantic_timeout, args.enhance_timeout)
+            hybrid_search = None
+            if args.shards and (args.server or args.nprobe is not None):
+                parser.error("--shards cannot be combined with --server or --nprobe")
+            if args.server:
+                result = server_request(args.server, "rrf", {"query": args.query, "k": args.k, "enhance": args.enhance, "rerank_method": args.rerank_method, "limit": args.limit, "nprobe": args.nprobe, "depth": args.depth, "timeouts": timeouts, "rerank_top_n": args.rerank_top_n})
+            else:
+                if args.shards:
+                    from lib.sharded_search import ShardedHybridSearch
+                    hybrid_search = ShardedHybridSearch(load_movies(), args.shards, concurrent=not args.sequential)
+                else:
+                    hybrid_search = HybridSearch(load_movies(), args.nprobe, concurrent=not args.sequential)
+                result = rrf_search_command(args.query, args.k, args.enhance, args.rerank_method, args.limit, args.nprobe, hybrid_search, args.depth, timeouts, args.rerank_top_n)
             
             if result["enhanced_query"]:
                 print(
@@ -51,11 +94,24 @@ def main() -> None:
                 print(f"\n{i}. {ranking['document']['title']}\n{ranking['document']['description'][:123]}...")
                 if args.rerank_method:
                     print(f"\nRerank: {ranking['llm_rank']:.4f}")
-                print(f"RRF Score: {ranking['rrf_score']:.4f}\nBM25 Rank: {ranking['bm25_rank']:.4f}, Semantic Rank: {ranking['semantic_rank']:.4f}\n")
+                bm25_rank = "-" if ranking['bm25_rank'] is None else f"{ranking['bm25_rank']:.4f}"
+                semantic_rank = "-" if ranking['semantic_rank'] is None else f"{ranking['semantic_rank']:.4f}"
+                print(f"RRF Score: {ranking['rrf_score']:.4f}\nBM25 Rank: {bm25_rank}, Semantic Rank: {semantic_rank}\n")
+            if args.timing and hybrid_search:
+                print(format_branch_stats(hybrid_search.last_search_stats))
+                if args.rerank_method == "cross_encoder":
+                    from lib.rerank import get_reranker, format_rerank_stats
+                    print(format_rerank_stats(get_reranker().last_stats))
+                if args.enhance or args.rerank_method in ("individual", "batch"):
+                    from lib.llm_client import get_llm_cache
+                    from lib.llm_cache import format_llm_cache_stats
+                    print(format_llm_cache_stats(get_llm_cache().stats()))
             if args.evaluate:
-                llm_valuation = llm_evaluation(args.query, result["results"])
+                llm_valuation = llm_evaluation(args.query, result["results"], hybrid_search.semantic_search if hybrid_search else None)
                 for llm_v in llm_valuation:
                     print(llm_v)
+            if hybrid_search:
+                hybrid_search.close()
         case _:
             parser.print_help()
 
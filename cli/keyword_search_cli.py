@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 
 import argparse
-from lib.keyword_search import build_command, search_command, tf_command, idf_command, bm25_idf_command, bm25_tf_command, tfidf_command, bm25search_command
-from lib.search_utils import BM25_K1, BM25_B, DEFAULT_SEARCH_LIMIT
+from lib.keyword_search import convert_command, search_command, tf_command, idf_command, bm25_idf_command, bm25_tf_command, tfidf_command, bm25search_command
+from lib.search_utils import BM25_K1, BM25_B, DEFAULT_SEARCH_LIMIT, BM25_PRUNING_METHODS, DEFAULT_SEARCH_SERVER
+from lib.search_client import server_request
+from lib.sharded_build import add_build_arguments, build_keyword_index, print_build_progress, print_build_stats
+from lib.tracing import add_profile_arguments, start_profiling
 
 def main() -> None:
 
@@ -12,6 +15,8 @@ def main() -> None:
     search_parser = subparsers.add_parser("search", help="Search movies using BM25")
     search_parser.add_argument("query", type=str, help="Search query")
     build_parser = subparsers.add_parser("build", help="Building inverted index")
+    add_build_arguments(build_parser)
+    subparsers.add_parser("convert", help="Convert pickled inverted index files to the compact binary format")
     tf_parser = subparsers.add_parser("tf", help="Get term frequencies")
     tf_parser.add_argument("doc_id", type=int, help="Document ID")
     tf_parser.add_argument("term", type=str, help="Term to get frequency")
@@ -30,14 +35,23 @@ def main() -> None:
     bm25search_parser = subparsers.add_parser("bm25search", help="Search movies using full BM25 scoring")
     bm25search_parser.add_argument("query", type=str, help="Search query")
     bm25search_parser.add_argument("limit", type=int, nargs='?', default=DEFAULT_SEARCH_LIMIT, help="Tunable BM25 search limit parameter")
+    bm25search_parser.add_argument("--k1", type=float, default=BM25_K1, help="Tunable BM25 K1 parameter")
+    bm25search_parser.add_argument("--b", type=float, default=BM25_B, help="Tunable BM25 b parameter")
+    bm25search_parser.add_argument("--pruning", type=str, choices=BM25_PRUNING_METHODS, help="Dynamic pruning for top-k retrieval (WAND or Block-Max WAND)")
+    bm25search_parser.add_argument("--server", type=str, nargs='?', const=DEFAULT_SEARCH_SERVER, help="Send the request to a running search_server_cli.py instead of loading models locally")
     
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    start_profiling(args)
 
     match args.command:
         case "build":
             print(f"Building inverted index...")
-            build_command()
+            print_build_stats(build_keyword_index(args.workers, args.threads, args.shard_size, not args.restart, print_build_progress))
             print("Inverted index built successfully.")
+        case "convert":
+            compact_path = convert_command()
+            print(f"Compact index written to {compact_path}")
         case "search":
             print(f"Searching for: {args.query}")
             result = search_command(args.query)
@@ -60,9 +74,14 @@ def main() -> None:
             print(f"BM25 TF score of '{args.term}' in document '{args.doc_id}': {bm25_tf:.2f}")
         case "bm25search":
             print("Searching for:", args.query)
-            results = bm25search_command(args.query, args.limit)
+            if args.server:
+                response = server_request(args.server, "keyword", {"query": args.query, "limit": args.limit, "k1": args.k1, "b": args.b, "pruning": args.pruning})
+                results, stats = response["results"], response["stats"]
+            else:
+                results, stats = bm25search_command(args.query, args.limit, args.k1, args.b, args.pruning)
             for i, res in enumerate(results, 1):
                 print(f"{i}. ({res['id']}) {res['title']} - Score: {res['score']:.2f}")
+            print(f"Scored {stats['scored']} of {stats['matched']} matching documents ({stats['method']}, skipped {stats['skipped']})")
         case _:
             parser.print_help()
 
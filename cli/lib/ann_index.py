@@ -0,0 +1,85 @@
+import os
+import numpy as np
+
+from .dense_retrieval import normalize_rows
+from .search_utils import top_k_indices, ANN_DEFAULT_NPROBE, ANN_KMEANS_ITERATIONS
+
+IVF_FORMAT_VERSION = 1
+ASSIGN_BATCH_SIZE = 16384
+
+def default_list_count(row_count):
+    return max(1, int(4 * np.sqrt(row_count)))
+
+def assign_to_centroids(vectors, centroids):
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), ASSIGN_BATCH_SIZE):
+        batch = vectors[start:start + ASSIGN_BATCH_SIZE]
+        assignments[start:start + len(batch)] = np.argmax(batch @ centroids.T, axis=1)
+    return assignments
+
+def spherical_kmeans(vectors, n_lists, iterations = ANN_KMEANS_ITERATIONS, seed = 0):
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = assign_to_centroids(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        counts = np.bincount(assignments, minlength=n_lists)
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+        centroids = normalize_rows(sums)
+    return centroids
+
+class IVFIndex:
+    def __init__(self, centroids, list_ptr, list_rows, fingerprint = None):
+        self.centroids = centroids
+        self.list_ptr = list_ptr
+        self.list_rows = list_rows
+        self.fingerprint = fingerprint
+
+    def __len__(self):
+        return len(self.list_rows)
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, embeddings, n_lists = None, iterations = ANN_KMEANS_ITERATIONS, sample_size = None, seed = 0, fingerprint = None):
+        vectors = normalize_rows(embeddings)
+        n_lists = min(n_lists or default_list_count(len(vectors)), len(vectors))
+        rng = np.random.default_rng(seed)
+        sample_size = min(sample_size or 256 * n_lists, len(vectors))
+        sample = vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))]
+        centroids = spherical_kmeans(sample, n_lists, iterations, seed)
+        assignments = assign_to_centroids(vectors, centroids)
+        list_rows = np.argsort(assignments, kind="stable")
+        list_ptr = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=n_lists), out=list_ptr[1:])
+        return cls(centroids, list_ptr, list_rows, fingerprint)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            np.savez(f, version=IVF_FORMAT_VERSION, centroids=self.centroids, list_ptr=self.list_ptr, list_rows=self.list_rows, fingerprint=self.fingerprint or "")
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if int(data["version"]) != IVF_FORMAT_VERSION:
+                raise ValueError(f"Unsupported IVF index version {int(data['version'])}")
+            fingerprint = str(data["fingerprint"]) if "fingerprint" in data.files else None
+            return cls(data["centroids"], data["list_ptr"], data["list_rows"], fingerprint or None)
+
+    def candidates(self, query_embedding, nprobe = ANN_DEFAULT_NPROBE):
+        query = np.asarray(query_embedding, dtype=np.float32)
+        probes = top_k_indices(self.centroids @ query, min(nprobe, self.n_lists))
+        rows = [self.list_rows[self.list_ptr[i]:self.list_ptr[i + 1]] for i in probes]
+        return np.sort(np.concatenate(rows)) if rows else np.array([], dtype=np.int64)
+
+    def search(self, dense_index, query_embedding, limit, nprobe = ANN_DEFAULT_NPROBE):
+        rows = self.candidates(query_embedding, nprobe)
+        scores = dense_index.scores(query_embedding, rows)
+        top = top_k_indices(scores, limit)
+        return rows[top], scores[top]
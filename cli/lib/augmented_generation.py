@@ -1,22 +1,15 @@
-import os
+import time
 
-from dotenv import load_dotenv
-from google import genai
+from .hybrid_search import HybridSearch, rrf_search_command
+from .context_builder import build_context
+from .llm_client import generate_content, generate_content_stream
+from .tracing import traced, span
+from .search_utils import load_movies, RAG_CONTEXT_TOKENS
 
-from .hybrid_search import rrf_search_command
-
-load_dotenv()
-api_key = os.getenv("gemini_api_key")
-client = genai.Client(api_key=api_key)
 model = "gemini-2.5-flash"
 
-def rag_command(query):
-    response = rrf_search_command(query, limit=5)
-    results = response["results"]
-
-    titles, formatted_ranking = formatter_for_llm(results)
-
-    prompt = f"""Answer the question or provide information based on the provided documents. This should be tailored to Hoopla users. Hoopla is a movie streaming service.
+def rag_prompt(query, formatted_ranking):
+    return f"""Answer the question or provide information based on the provided documents. This should be tailored to Hoopla users. Hoopla is a movie streaming service.
 
             Query: {query}
 
@@ -25,19 +18,8 @@ def rag_command(query):
 
             Provide a comprehensive answer that addresses the query:"""
 
-    response = client.models.generate_content(model=model, contents=prompt)
-    corrected = (response.text or "").strip().strip('"')
-    
-    return (titles, corrected)
-
-
-def summarize_command(query, limit):
-    response = rrf_search_command(query, limit = limit)
-    results = response["results"]
-
-    titles, formatted_ranking = formatter_for_llm(results)
-
-    prompt = f"""
+def summarize_prompt(query, formatted_ranking):
+    return f"""
             Provide information useful to this query by synthesizing information from multiple search results in detail.
             The goal is to provide comprehensive information so that users know what their options are.
             Your response should be information-dense and concise, with several key pieces of information about the genre, plot, etc. of each movie.
@@ -48,18 +30,8 @@ def summarize_command(query, limit):
             Provide a comprehensive 3–4 sentence answer that combines information from multiple sources:
             """
 
-    response = client.models.generate_content(model=model, contents=prompt)
-    corrected = (response.text or "").strip().strip('"')
-    return (titles, corrected)
-
-
-def citations_command(query, limit):
-    response = rrf_search_command(query, limit = limit)
-    results = response["results"]
-
-    titles, formatted_ranking = formatter_for_llm(results)
-
-    prompt = f"""Answer the question or provide information based on the provided documents.
+def citations_prompt(query, formatted_ranking):
+    return f"""Answer the question or provide information based on the provided documents.
 
             This should be tailored to Hoopla users. Hoopla is a movie streaming service.
 
@@ -79,17 +51,8 @@ def citations_command(query, limit):
 
             Answer:"""
 
-    response = client.models.generate_content(model=model, contents=prompt)
-    corrected = (response.text or "").strip().strip('"')
-    return (titles, corrected)
-
-
-def question_command(question, limit):
-    response = rrf_search_command(question, limit = limit)
-    results = response["results"]
-
-    titles, formatted_ranking = formatter_for_llm(results)
-    prompt = f"""Answer the user's question based on the provided movies that are available on Hoopla.
+def question_prompt(question, formatted_ranking):
+    return f"""Answer the user's question based on the provided movies that are available on Hoopla.
 
             This should be tailored to Hoopla users. Hoopla is a movie streaming service.
 
@@ -106,9 +69,75 @@ def question_command(question, limit):
 
             Answer:"""
 
-    response = client.models.generate_content(model=model, contents=prompt)
-    corrected = (response.text or "").strip().strip('"')
-    return (titles, corrected)
+PROMPTS = {"rag": rag_prompt, "summarize": summarize_prompt, "citations": citations_prompt, "question": question_prompt}
+
+def retrieve(query, limit, hybrid_search = None, context_tokens = RAG_CONTEXT_TOKENS):
+    # context_tokens=0 puts every result's whole description in the prompt.
+    if hybrid_search is None:
+        hybrid_search = HybridSearch(load_movies())
+    response = rrf_search_command(query, limit = limit, hybrid_search = hybrid_search)
+    if not context_tokens:
+        return formatter_for_llm(response["results"])
+    titles, context, _ = build_context(query, response["results"], hybrid_search.semantic_search, context_tokens)
+    return titles, context
+
+def answer(prompt):
+    response = generate_content(model, prompt)
+    return (response.text or "").strip().strip('"')
+
+@traced("rag.rag")
+def rag_command(query, hybrid_search = None, context_tokens = RAG_CONTEXT_TOKENS):
+    titles, formatted_ranking = retrieve(query, 5, hybrid_search, context_tokens)
+    return (titles, answer(rag_prompt(query, formatted_ranking)))
+
+
+@traced("rag.summarize")
+def summarize_command(query, limit, hybrid_search = None, context_tokens = RAG_CONTEXT_TOKENS):
+    titles, formatted_ranking = retrieve(query, limit, hybrid_search, context_tokens)
+    return (titles, answer(summarize_prompt(query, formatted_ranking)))
+
+
+@traced("rag.citations")
+def citations_command(query, limit, hybrid_search = None, context_tokens = RAG_CONTEXT_TOKENS):
+    titles, formatted_ranking = retrieve(query, limit, hybrid_search, context_tokens)
+    return (titles, answer(citations_prompt(query, formatted_ranking)))
+
+
+@traced("rag.question")
+def question_command(question, limit, hybrid_search = None, context_tokens = RAG_CONTEXT_TOKENS):
+    titles, formatted_ranking = retrieve(question, limit, hybrid_search, context_tokens)
+    return (titles, answer(question_prompt(question, formatted_ranking)))
+
+
+def stream_command(mode, query, limit = 5, hybrid_search = None, context_tokens = RAG_CONTEXT_TOKENS):
+    # Yields ("results", titles) as soon as fusion finishes, then ("text",
+    # chunk) for each chunk of the answer as it is generated, then
+    # ("done", timings) with the retrieval, first-token and total latency.
+    with span("rag.stream", mode=mode):
+        start = time.perf_counter()
+        titles, formatted_ranking = retrieve(query, 5 if mode == "rag" else limit, hybrid_search, context_tokens)
+        retrieved = time.perf_counter()
+        yield "results", titles
+        first_chunk, chunks = None, 0
+        for chunk in generate_content_stream(model, PROMPTS[mode](query, formatted_ranking)):
+            if first_chunk is None:
+                first_chunk = time.perf_counter()
+            chunks += 1
+            yield "text", chunk
+        end = time.perf_counter()
+        yield "done", {
+            "retrieval_ms": (retrieved - start) * 1000,
+            "first_token_ms": ((first_chunk or end) - start) * 1000,
+            "generation_first_token_ms": ((first_chunk or end) - retrieved) * 1000,
+            "total_ms": (end - start) * 1000,
+            "chunks": chunks,
+        }
+
+def format_stream_stats(stats):
+    return (
+        f"Retrieval {stats['retrieval_ms']:.0f} ms, first token {stats['first_token_ms']:.0f} ms "
+        f"({stats['generation_first_token_ms']:.0f} ms after the request), total {stats['total_ms']:.0f} ms over {stats['chunks']} chunks"
+    )
 
 
 def formatter_for_llm(results):
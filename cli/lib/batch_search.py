@@ -0,0 +1,64 @@
+import sys, json
+
+from .search_utils import load_movies, batches, DEFAULT_SEARCH_LIMIT, DEFAULT_ALPHA_HYBRID, RRF_K1, SEARCH_BATCH_SIZE
+
+BATCH_METHODS = ("keyword", "semantic", "chunked", "weighted", "rrf")
+
+def read_queries(lines):
+    # Plain text (one query per line) or JSONL objects with a "query" field;
+    # any other fields are passed through to the output record.
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("{"):
+            record = json.loads(line)
+            if "query" not in record:
+                raise ValueError(f"Query record has no 'query' field: {line}")
+            yield record
+        else:
+            yield {"query": line}
+
+def batch_searcher(method, limit = DEFAULT_SEARCH_LIMIT, nprobe = None, depth = None, alpha = DEFAULT_ALPHA_HYBRID, k = RRF_K1):
+    match method:
+        case "keyword":
+            from .keyword_search import InvertedIndex
+            idx = InvertedIndex()
+            idx.load()
+            return lambda queries: idx.search_many(queries, limit)
+        case "semantic":
+            from .semantic_search import SemanticSearch
+            semantic_search = SemanticSearch()
+            semantic_search.load_or_create_embeddings(load_movies())
+            return lambda queries: semantic_search.search_many(queries, limit)
+        case "chunked":
+            from .semantic_search import ChunkedSemanticSearch
+            chunked_semantic_search = ChunkedSemanticSearch()
+            chunked_semantic_search.load_or_create_chunk_embeddings(load_movies())
+            return lambda queries: chunked_semantic_search.search_chunks_many(queries, limit, nprobe)
+        case "weighted" | "rrf":
+            from .hybrid_search import HybridSearch
+            hybrid_search = HybridSearch(load_movies(), nprobe)
+            return lambda queries: hybrid_search.search_many(queries, method, limit, nprobe, depth, alpha, k)
+        case _:
+            raise ValueError(f"Unknown batch search method '{method}', expected one of {', '.join(BATCH_METHODS)}")
+
+def batch_search_command(input_path, method = "rrf", limit = DEFAULT_SEARCH_LIMIT, output_path = None, batch_size = SEARCH_BATCH_SIZE, nprobe = None, depth = None, alpha = DEFAULT_ALPHA_HYBRID, k = RRF_K1):
+    search_many = batch_searcher(method, limit, nprobe, depth, alpha, k)
+    source = sys.stdin if input_path == "-" else open(input_path, "r", encoding="utf-8")
+    output = sys.stdout if output_path is None else open(output_path, "w", encoding="utf-8")
+    count = 0
+    try:
+        # Results are written and flushed batch by batch, so consumers can
+        # start on the first lines while later batches are still searched.
+        for batch in batches(read_queries(source), batch_size):
+            for record, results in zip(batch, search_many([record["query"] for record in batch])):
+                output.write(json.dumps({**record, "results": results}) + "\n")
+            output.flush()
+            count += len(batch)
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if output is not sys.stdout:
+            output.close()
+    return count
@@ -0,0 +1,500 @@
+import os, re, sys, time, resource, tempfile, subprocess, multiprocessing
+import numpy as np
+
+from .keyword_search import InvertedIndex, Tokenizer, preprocess_text
+from .dense_retrieval import DenseIndex
+from .ann_index import IVFIndex
+from .quantization import QuantizedIndex
+from .hybrid_search import HybridSearch
+from .query_cache import QueryEmbeddingCache
+from .search_utils import load_movies, load_stop_words, load_golden_data, cosine_similarity, BM25_PRUNING_METHODS, CACHE_DIR, ROOT_DIR, HYBRID_CANDIDATE_MULTIPLIER, RRF_K1, DEFAULT_ALPHA_HYBRID, LLM_RATE_LIMITS, LLM_DEFAULT_RATE_LIMIT, LLM_MAX_CONCURRENCY, RAG_CONTEXT_TOKENS, EMBED_BATCH_SIZE, EMBED_SORT_WINDOW, QUANTIZED_RERANK_FACTOR
+
+def legacy_tokenize_text(text):
+    from nltk.stem import PorterStemmer
+    stemmer = PorterStemmer()
+    text = preprocess_text(text)
+    tokens = text.split()
+    valid_tokens = [token for token in tokens if token != ""]
+    stop_words = load_stop_words()
+    filtered_tokens = [token for token in valid_tokens if token not in stop_words]
+    return [stemmer.stem(token) for token in filtered_tokens]
+
+def time_call(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def tokenizer_benchmark(limit = 500, repeat = 3):
+    if repeat < 1:
+        raise ValueError(f"repeat must be at least 1, got {repeat}")
+    movies = load_movies()[:limit]
+    texts = [f'{movie["title"]} {movie["description"]}' for movie in movies]
+
+    legacy_tokens, legacy_seconds = time_call(lambda: [legacy_tokenize_text(text) for text in texts])
+    tokenizer = Tokenizer()
+    new_seconds = []
+    for _ in range(repeat):
+        new_tokens, seconds = time_call(tokenizer.tokenize_many, texts)
+        new_seconds.append(seconds)
+    if new_tokens != legacy_tokens:
+        raise ValueError("Tokenizer output differs from legacy tokenize_text")
+
+    token_count = sum(len(tokens) for tokens in new_tokens)
+    return {
+        "documents": len(texts),
+        "tokens": token_count,
+        "legacy_tokens_per_second": token_count / legacy_seconds,
+        "cold_tokens_per_second": token_count / new_seconds[0],
+        "warm_tokens_per_second": token_count / min(new_seconds),
+        "stem_cache": tokenizer.cache_info(),
+    }
+
+def bm25_pruning_benchmark(limit = 5, queries = None):
+    if queries is None:
+        queries = [test_case["query"] for test_case in load_golden_data()]
+    idx = InvertedIndex()
+    idx.load()
+    report = {}
+    for method in (None,) + BM25_PRUNING_METHODS:
+        totals = {"seconds": 0.0, "matched": 0, "scored": 0, "skipped": 0}
+        results = []
+        for query in queries:
+            result, seconds = time_call(idx.bm25_search, query, limit, pruning=method)
+            results.append(result)
+            totals["seconds"] += seconds
+            for key in ("matched", "scored", "skipped"):
+                totals[key] += idx.last_search_stats[key]
+        report[method or "exhaustive"] = (totals, results)
+    baseline = report["exhaustive"][1]
+    return {
+        "queries": len(queries),
+        "limit": limit,
+        "methods": {method: totals for method, (totals, _) in report.items()},
+        "identical": {method: results == baseline for method, (_, results) in report.items()},
+    }
+
+def legacy_dense_search(embeddings, query_embedding, limit):
+    cosine_similarities = []
+    for i, embedding in enumerate(embeddings):
+        cosine_similarities.append((cosine_similarity(query_embedding, embedding), i))
+    return sorted(cosine_similarities, key=lambda x: x[0], reverse=True)[:limit]
+
+def dense_retrieval_benchmark(sizes = (5_000, 50_000, 250_000, 1_000_000), dim = 384, limit = 5, queries = 20, legacy_max = 50_000, seed = 0):
+    rng = np.random.default_rng(seed)
+    report = []
+    for size in sizes:
+        embeddings = rng.standard_normal((size, dim), dtype=np.float32)
+        query_embeddings = rng.standard_normal((queries, dim), dtype=np.float32)
+        index, build_seconds = time_call(DenseIndex, embeddings)
+        latencies = [time_call(index.search, query, limit)[1] for query in query_embeddings]
+        row = {
+            "size": size,
+            "build_ms": build_seconds * 1000,
+            "dense_p50_ms": float(np.percentile(latencies, 50)) * 1000,
+            "dense_p99_ms": float(np.percentile(latencies, 99)) * 1000,
+            "legacy_ms": None,
+        }
+        if size <= legacy_max:
+            _, legacy_seconds = time_call(legacy_dense_search, embeddings, query_embeddings[0], limit)
+            row["legacy_ms"] = legacy_seconds * 1000
+            expected = [i for _, i in legacy_dense_search(embeddings, query_embeddings[0], limit)]
+            row["same_top_k"] = expected == index.search(query_embeddings[0], limit)[0].tolist()
+        report.append(row)
+        del embeddings, index
+    return report
+
+def clustered_vectors(size, dim, rng, clusters = 256, spread = 0.35):
+    centers = rng.standard_normal((clusters, dim), dtype=np.float32)
+    noise = rng.standard_normal((size, dim), dtype=np.float32) * spread
+    return centers[rng.integers(0, clusters, size)] + noise
+
+def ann_benchmark(size = 200_000, dim = 384, n_lists = None, nprobes = (1, 2, 4, 8, 16, 32, 64), limit = 10, queries = 100, use_cache = False, seed = 0):
+    rng = np.random.default_rng(seed)
+    if use_cache:
+        embeddings = np.load(os.path.join(CACHE_DIR, "chunk_embeddings.npy"))
+    else:
+        embeddings = clustered_vectors(size, dim, rng)
+    query_embeddings = embeddings[rng.choice(len(embeddings), queries, replace=False)]
+    query_embeddings = query_embeddings + rng.standard_normal(query_embeddings.shape, dtype=np.float32) * 0.1
+
+    dense_index = DenseIndex(embeddings)
+    ann_index, build_seconds = time_call(IVFIndex.build, embeddings, n_lists)
+    exact, exact_latencies = [], []
+    for query in query_embeddings:
+        (top, _), seconds = time_call(dense_index.search, query, limit)
+        exact.append(set(top.tolist()))
+        exact_latencies.append(seconds)
+
+    rows = [{"nprobe": "exact", "recall": 1.0, "p50_ms": float(np.percentile(exact_latencies, 50)) * 1000, "p99_ms": float(np.percentile(exact_latencies, 99)) * 1000, "candidates": len(embeddings)}]
+    for nprobe in nprobes:
+        recalls, latencies, candidates = [], [], []
+        for query, expected in zip(query_embeddings, exact):
+            (top, _), seconds = time_call(ann_index.search, dense_index, query, limit, nprobe)
+            recalls.append(len(expected & set(top.tolist())) / len(expected))
+            latencies.append(seconds)
+            candidates.append(len(ann_index.candidates(query, nprobe)))
+        rows.append({
+            "nprobe": nprobe,
+            "recall": float(np.mean(recalls)),
+            "p50_ms": float(np.percentile(latencies, 50)) * 1000,
+            "p99_ms": float(np.percentile(latencies, 99)) * 1000,
+            "candidates": float(np.mean(candidates)),
+        })
+    return {"vectors": len(embeddings), "lists": ann_index.n_lists, "build_seconds": build_seconds, "limit": limit, "rows": rows}
+
+def quantization_benchmark(size = 100_000, dim = 384, limit = 10, queries = 100, embeddings_path = None, seed = 0):
+    rng = np.random.default_rng(seed)
+    if embeddings_path:
+        embeddings = np.load(embeddings_path, mmap_mode="r")
+    else:
+        embeddings = clustered_vectors(size, dim, rng)
+    query_embeddings = np.asarray(embeddings[rng.choice(len(embeddings), queries, replace=False)])
+    query_embeddings = query_embeddings + rng.standard_normal(query_embeddings.shape, dtype=np.float32) * 0.1
+
+    dense_index = DenseIndex(embeddings)
+    exact, latencies = [], []
+    for query in query_embeddings:
+        (top, _), seconds = time_call(dense_index.search, query, limit)
+        exact.append(set(top.tolist()))
+        latencies.append(seconds)
+    full_bytes = dense_index.embeddings.nbytes
+    rows = [{"encoding": "float32", "bytes": full_bytes, "saved": 0.0, "recall": 1.0, "rerank_recall": 1.0, "p50_ms": float(np.percentile(latencies, 50)) * 1000, "build_seconds": 0.0}]
+
+    for encoding in ("float16", "int8", "pq"):
+        index, build_seconds = time_call(QuantizedIndex.build, embeddings, encoding, embeddings)
+        recalls, rerank_recalls, latencies = [], [], []
+        for query, expected in zip(query_embeddings, exact):
+            index.rerank_factor = 0
+            top, _ = index.search(query, limit)
+            recalls.append(len(expected & set(top.tolist())) / len(expected))
+            index.rerank_factor = QUANTIZED_RERANK_FACTOR
+            (top, _), seconds = time_call(index.search, query, limit)
+            rerank_recalls.append(len(expected & set(top.tolist())) / len(expected))
+            latencies.append(seconds)
+        rows.append({
+            "encoding": encoding,
+            "bytes": index.nbytes,
+            "saved": 1 - index.nbytes / full_bytes,
+            "recall": float(np.mean(recalls)),
+            "rerank_recall": float(np.mean(rerank_recalls)),
+            "p50_ms": float(np.percentile(latencies, 50)) * 1000,
+            "build_seconds": build_seconds,
+        })
+    return {"vectors": len(embeddings), "dim": embeddings.shape[1], "limit": limit, "rows": rows}
+
+def evict_page_cache(directories):
+    # Best effort: POSIX_FADV_DONTNEED drops clean cached pages of each file,
+    # so the next open has to read it back from disk.
+    evicted = 0
+    for directory in directories:
+        for root, _, files in os.walk(directory):
+            for name in files:
+                path = os.path.join(root, name)
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+                    evicted += os.fstat(fd).st_size
+                finally:
+                    os.close(fd)
+    return evicted
+
+def startup_benchmark(query = "family movie about bears", runs = 5, limit = 5):
+    cli_path = os.path.join(ROOT_DIR, "cli", "hybrid_search_cli.py")
+    command = [sys.executable, cli_path, "rrf-search", query, "--limit", str(limit)]
+    cache_dirs = [CACHE_DIR, os.path.join(ROOT_DIR, "data")]
+    subprocess.run(command, check=True, capture_output=True)
+    report = {"command": " ".join(command[1:]), "runs": runs, "evicted_bytes": 0}
+    for mode in ("cold", "warm"):
+        seconds = []
+        for _ in range(runs):
+            if mode == "cold":
+                report["evicted_bytes"] = evict_page_cache(cache_dirs)
+            _, elapsed = time_call(subprocess.run, command, check=True, capture_output=True)
+            seconds.append(elapsed)
+        report[f"{mode}_p50_seconds"] = float(np.percentile(seconds, 50))
+        report[f"{mode}_min_seconds"] = float(min(seconds))
+    return report
+
+CLI_ENTRY_POINTS = (
+    "keyword_search_cli.py",
+    "semantic_search_cli.py",
+    "hybrid_search_cli.py",
+    "multimodal_search_cli.py",
+    "augmented_generation_cli.py",
+    "evaluation_cli.py",
+    "describe_image_cli.py",
+    "search_server_cli.py",
+    "benchmark_cli.py",
+)
+
+def parse_import_times(stderr):
+    # -X importtime lines look like "import time:   self | cumulative | name";
+    # top-level imports are the ones whose name is not indented.
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not name.startswith("  "):
+            imports.append((name.strip(), int(cumulative)))
+    return imports
+
+def import_time_benchmark(entry_points = CLI_ENTRY_POINTS, runs = 3, top = 5):
+    cli_dir = os.path.join(ROOT_DIR, "cli")
+    report = []
+    for entry_point in entry_points:
+        command = [sys.executable, "-X", "importtime", os.path.join(cli_dir, entry_point), "--help"]
+        best = None
+        for _ in range(runs):
+            completed, seconds = time_call(subprocess.run, command, capture_output=True, text=True, cwd=cli_dir)
+            imports = parse_import_times(completed.stderr)
+            import_us = sum(cumulative for _, cumulative in imports)
+            if best is None or import_us < best["import_us"]:
+                best = {
+                    "entry_point": entry_point,
+                    "returncode": completed.returncode,
+                    "wall_seconds": seconds,
+                    "import_us": import_us,
+                    "heaviest": sorted(imports, key=lambda item: item[1], reverse=True)[:top],
+                }
+        report.append(best)
+    return report
+
+def hybrid_stage_benchmark(limit = 5, depth = None, queries = None):
+    hybrid, load_seconds = time_call(HybridSearch, load_movies())
+    queries = queries or [case["query"] for case in load_golden_data()]
+    depth = depth or limit * HYBRID_CANDIDATE_MULTIPLIER
+    semantic_search = hybrid.semantic_search
+    stages = {name: [] for name in ("query embedding", "bm25 candidates", "semantic candidates", "branches sequential", "branches concurrent", "branches sequential (uncached embedding)", "branches concurrent (uncached embedding)", "rrf search", "weighted search", "formatted candidates (previous)")}
+    saved = {"cached": [], "uncached": []}
+    query_cache = semantic_search.query_cache
+    # A cache that keeps nothing, so the semantic branch pays for encoding
+    # the query as it does the first time a query is seen.
+    no_cache = QueryEmbeddingCache(memory_size=0, disk_size=0)
+    for query in queries:
+        q_embedding, seconds = time_call(semantic_search._encode_query, query)
+        stages["query embedding"].append(seconds)
+        semantic_search.generate_embedding(query)
+        stages["bm25 candidates"].append(time_call(hybrid.bm25_candidates, query, depth)[1])
+        stages["semantic candidates"].append(time_call(semantic_search.chunk_candidates, q_embedding, depth)[1])
+        for cache, suffix in ((query_cache, ""), (no_cache, " (uncached embedding)")):
+            semantic_search.query_cache = cache
+            for concurrent in (False, True):
+                hybrid.concurrent = concurrent
+                stages[f"branches {'concurrent' if concurrent else 'sequential'}{suffix}"].append(time_call(hybrid.candidates, query, depth)[1])
+            saved["uncached" if suffix else "cached"].append(hybrid.last_search_stats["saved_ms"])
+        semantic_search.query_cache = query_cache
+        stages["rrf search"].append(time_call(hybrid.rrf_search, query, RRF_K1, limit, None, depth)[1])
+        stages["weighted search"].append(time_call(hybrid.weighted_search, query, DEFAULT_ALPHA_HYBRID, limit, None, depth)[1])
+        # What both retrievers cost when they format every candidate as a
+        # result dict, as hybrid search did before fusing on id arrays.
+        stages["formatted candidates (previous)"].append(time_call(lambda: (hybrid.idx.bm25_search(query, depth), semantic_search.search_chunks(query, depth)))[1])
+    return {
+        "queries": len(queries),
+        "limit": limit,
+        "depth": depth,
+        "load_seconds": load_seconds,
+        "saved_ms": {name: {"p50": float(np.percentile(values, 50)), "mean": float(np.mean(values))} for name, values in saved.items()},
+        "stages": {name: {"p50_ms": float(np.percentile(values, 50)) * 1000, "p99_ms": float(np.percentile(values, 99)) * 1000} for name, values in stages.items()},
+    }
+
+
+def rerank_benchmark(top_n = 25, batch_sizes = (8, 16, 32, 64), queries = None):
+    from .rerank import CrossEncoderReranker
+    hybrid = HybridSearch(load_movies())
+    queries = queries or [case["query"] for case in load_golden_data()]
+    candidates = [(query, hybrid.rrf_search(query, RRF_K1, top_n)) for query in queries]
+    model, load_seconds = time_call(lambda: CrossEncoderReranker().model)
+    # What cross_encoder did before the reranker: every call predicts every
+    # pair, built from the stringified document dict.
+    previous_pairs, previous_seconds = 0, 0.0
+    for query, results in candidates:
+        pairs = [[query, f"{result['document']} - {result['document']['title']}"] for result in results]
+        previous_seconds += time_call(model.predict, pairs)[1]
+        previous_pairs += len(pairs)
+    rows = {}
+    for batch_size in batch_sizes:
+        reranker = CrossEncoderReranker(batch_size=batch_size)
+        cold = time_call(lambda: [reranker.score(query, [result["document"] for result in results]) for query, results in candidates])[1]
+        cold_stats = reranker.stats()
+        warm = time_call(lambda: [reranker.score(query, [result["document"] for result in results]) for query, results in candidates])[1]
+        stats = reranker.stats()
+        rows[batch_size] = {
+            "pairs_per_second": cold_stats["pairs_per_second"],
+            "cold_ms_per_query": cold / len(candidates) * 1000,
+            "warm_ms_per_query": warm / len(candidates) * 1000,
+            "hit_rate": (stats["cache_hits"] - cold_stats["cache_hits"]) / (stats["pairs"] - cold_stats["pairs"]) if stats["pairs"] > cold_stats["pairs"] else 0.0,
+        }
+    return {
+        "queries": len(candidates),
+        "top_n": top_n,
+        "load_seconds": load_seconds,
+        "previous_pairs_per_second": previous_pairs / previous_seconds if previous_seconds else 0.0,
+        "batch_sizes": rows,
+    }
+
+def llm_scheduler_benchmark(candidates = 25, requests_per_minute = None, tokens_per_minute = None, latency = 0.5, failure_rate = 0.1, max_concurrency = LLM_MAX_CONCURRENCY):
+    # individual_rerank's request pattern against the offline stub client,
+    # paced by the scheduler instead of a fixed sleep between calls.
+    from .llm_scheduler import LLMScheduler, StubClient
+    from .rerank import individual_rerank_prompt, model
+    default_rpm, default_tpm = LLM_RATE_LIMITS.get(model, LLM_DEFAULT_RATE_LIMIT)
+    requests_per_minute = requests_per_minute or default_rpm
+    tokens_per_minute = tokens_per_minute or default_tpm
+    client = StubClient(latency, failure_rate)
+    scheduler = LLMScheduler(lambda model, contents, config: client.models.generate_content(model=model, contents=contents, config=config), requests_per_minute, tokens_per_minute, max_concurrency)
+    results = [{"document": movie} for movie in load_movies()[:candidates]]
+    prompts = [individual_rerank_prompt(result, "family movie about a bear") for result in results]
+    responses, seconds = time_call(scheduler.generate_many, model, prompts)
+    return {
+        "candidates": len(prompts),
+        "requests_per_minute": requests_per_minute,
+        "tokens_per_minute": tokens_per_minute,
+        "max_concurrency": max_concurrency,
+        "seconds": seconds,
+        "previous_seconds": (len(prompts) - 1) * 60 + len(prompts) * latency,
+        "scores": [int(response.text) for response in responses],
+        "stub_calls": client.calls,
+        **scheduler.stats(),
+    }
+
+def context_benchmark(limit = 5, budgets = (RAG_CONTEXT_TOKENS,), judge = True):
+    # RAG prompts for the golden queries with whole descriptions (what
+    # formatter_for_llm sends) against token-budgeted passages: prompt size,
+    # how many of the relevant movies still reach the prompt, and, with
+    # judge, the LLM-rated relevance of the answers each prompt produces.
+    from .augmented_generation import rag_prompt, formatter_for_llm, model
+    from .context_builder import build_context
+    from .evaluation import answer_relevance_many
+    from .llm_client import generate_content_many
+    from .llm_scheduler import estimate_tokens
+    hybrid = HybridSearch(load_movies())
+    cases = load_golden_data()
+    variants = {"full descriptions": 0, **{f"{budget} token budget": budget for budget in budgets}}
+    rows = {name: {"prompts": [], "prompt_tokens": [], "relevant_in_context": [], "pack_ms": []} for name in variants}
+    for case in cases:
+        query = case["query"]
+        results = hybrid.rrf_search(query, RRF_K1, limit)
+        for name, budget in variants.items():
+            if budget:
+                (_, context, _), seconds = time_call(build_context, query, results, hybrid.semantic_search, budget)
+            else:
+                (_, context), seconds = time_call(formatter_for_llm, results)
+            prompt = rag_prompt(query, context)
+            relevant = case["relevant_docs"]
+            rows[name]["prompts"].append(prompt)
+            rows[name]["prompt_tokens"].append(estimate_tokens(prompt))
+            rows[name]["relevant_in_context"].append(sum(f"Title: {title} " in str(context) for title in relevant) / len(relevant) if relevant else 1.0)
+            rows[name]["pack_ms"].append(seconds * 1000)
+    baseline = np.mean(rows["full descriptions"]["prompt_tokens"])
+    report = {"queries": len(cases), "limit": limit, "variants": {}}
+    for name, row in rows.items():
+        tokens = float(np.mean(row["prompt_tokens"]))
+        report["variants"][name] = {
+            "prompt_tokens": tokens,
+            "saved": 1 - tokens / baseline if baseline else 0.0,
+            "relevant_in_context": float(np.mean(row["relevant_in_context"])),
+            "pack_ms": float(np.mean(row["pack_ms"])),
+        }
+        if judge:
+            answers = [(response.text or "").strip() for response in generate_content_many(model, row["prompts"])]
+            report["variants"][name]["answer_relevance"] = float(np.mean(answer_relevance_many([case["query"] for case in cases], answers)))
+    return report
+
+def scaled_corpus(documents, scale):
+    # scale copies of the corpus in which every sentence of copy i gets a
+    # marker, so no chunk repeats and both builds encode every chunk.
+    copies = []
+    for i in range(scale):
+        for doc in documents:
+            description = doc["description"] if i == 0 else re.sub(r"([.!?])(\s|$)", f" v{i}\\1\\2", doc["description"])
+            copies.append({**doc, "description": description})
+    return copies
+
+def _embedding_build(semantic_search, documents, streaming, batch_size, window, results):
+    from .embedding_store import EmbeddingStore
+    from .semantic_search import stream_chunks
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    with tempfile.TemporaryDirectory() as directory:
+        store = EmbeddingStore(os.path.join(directory, "chunk_embeddings.npy"), semantic_search.model_name)
+        started = time.perf_counter()
+        if streaming:
+            embeddings = store.refresh_stream((chunk for *_, chunk in stream_chunks(documents)), semantic_search.encode_batch, batch_size, window, None, reuse=False)
+        else:
+            # The previous build: every chunk and its metadata in lists, one
+            # encode call over all of them, the whole matrix normalized and
+            # saved at the end.
+            chunks, _ = semantic_search.chunk_documents(documents)
+            embeddings = store.refresh(chunks, lambda texts: semantic_search.model.encode(texts, show_progress_bar=False), None, reuse=False)
+        seconds = time.perf_counter() - started
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        results.put({"chunks": len(embeddings), "seconds": seconds, "chunks_per_second": len(embeddings) / seconds if seconds else 0.0, "peak_rss_bytes": peak_rss, "rss_growth_bytes": peak_rss - start_rss})
+
+def embedding_build_benchmark(scales = (1, 2, 4), batch_size = EMBED_BATCH_SIZE, window = EMBED_SORT_WINDOW, limit = None):
+    # Each build runs in a forked child (model already loaded) so its peak
+    # RSS is its own; growth is the peak minus the RSS at the fork.
+    from .semantic_search import ChunkedSemanticSearch
+    semantic_search = ChunkedSemanticSearch()
+    semantic_search.model.encode(["warm up"])
+    documents = load_movies()[:limit] if limit else load_movies()
+    context = multiprocessing.get_context("fork")
+    rows = []
+    for scale in scales:
+        corpus = scaled_corpus(documents, scale)
+        for name, streaming in (("previous", False), ("streaming", True)):
+            results = context.Queue()
+            process = context.Process(target=_embedding_build, args=(semantic_search, corpus, streaming, batch_size, window, results))
+            process.start()
+            row = results.get()
+            process.join()
+            rows.append({"scale": scale, "documents": len(corpus), "build": name, **row})
+    return {"batch_size": batch_size, "window": window, "rows": rows}
+
+def _timed_queries(search, queries, limit, concurrency):
+    # Queries are issued from `concurrency` client threads; returns the wall
+    # time and each query's latency.
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        started = time.perf_counter()
+        latencies = list(pool.map(lambda query: time_call(search.rrf_search, query, RRF_K1, limit)[1], queries))
+        return time.perf_counter() - started, latencies
+
+def sharded_search_benchmark(shard_counts = (1, 2, 4, 8), limit = 5, concurrency = 8, repeat = 5, queries = None):
+    # Throughput and tail latency of hybrid RRF search with the retrievers
+    # in 1..8 shard processes, against the single-process HybridSearch, and
+    # whether each shard count returns exactly the unsharded candidates.
+    from .sharded_search import ShardedHybridSearch
+    documents = load_movies()
+    queries = queries or [case["query"] for case in load_golden_data()]
+    workload = queries * repeat
+    depth = limit * HYBRID_CANDIDATE_MULTIPLIER
+    baseline, load_seconds = time_call(HybridSearch, documents)
+    expected = [baseline.candidates(query, depth) for query in queries]
+    rows = []
+    for shards in (0, *shard_counts):
+        search, load_seconds = (baseline, load_seconds) if shards == 0 else time_call(ShardedHybridSearch, documents, shards)
+        try:
+            mismatched, max_diff = 0, 0.0
+            for query, want in zip(queries, expected):
+                got = search.candidates(query, depth)
+                for name in ("bm25", "semantic"):
+                    if not np.array_equal(got[name][0], want[name][0]):
+                        mismatched += 1
+                    elif len(want[name][1]):
+                        max_diff = max(max_diff, float(np.max(np.abs(got[name][1] - want[name][1]))))
+            _timed_queries(search, queries, limit, concurrency)
+            seconds, latencies = _timed_queries(search, workload, limit, concurrency)
+        finally:
+            if shards:
+                search.close()
+        rows.append({
+            "shards": shards,
+            "load_seconds": load_seconds,
+            "queries_per_second": len(workload) / seconds,
+            "p50_ms": float(np.percentile(latencies, 50)) * 1000,
+            "p99_ms": float(np.percentile(latencies, 99)) * 1000,
+            "mismatched": mismatched,
+            "max_score_diff": max_diff,
+        })
+    return {"queries": len(workload), "limit": limit, "depth": depth, "concurrency": concurrency, "cpus": os.cpu_count(), "rows": rows}
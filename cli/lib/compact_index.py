@@ -0,0 +1,273 @@
+import os, json, bisect
+import numpy as np
+
+from functools import lru_cache
+from collections.abc import Mapping
+
+COMPACT_INDEX_MAGIC = b"RSEINDEX"
+COMPACT_INDEX_VERSION = 1
+SECTION_ALIGNMENT = 8
+DECODED_POSTINGS_CACHE_SIZE = 4096
+
+# Layout: magic (8 bytes) | version (uint32) | header length (uint32) |
+# JSON header with corpus statistics and a section table | sections, each
+# aligned to SECTION_ALIGNMENT bytes and stored little-endian. Sections in
+# NARROWED_SECTIONS use the smallest unsigned width that fits their values.
+NARROWED_SECTIONS = ("doc_lengths", "doc_deltas", "tfs")
+SECTION_DTYPES = {
+    "doc_ids": "<i8",
+    "doc_lengths": "<u4",
+    "sorted_doc_ids": "<i8",
+    "sorted_doc_positions": "<i8",
+    "doc_offsets": "<u8",
+    "doc_bytes": "u1",
+    "term_offsets": "<u8",
+    "term_bytes": "u1",
+    "postings_ptr": "<u8",
+    "doc_deltas": "<u4",
+    "tfs": "<u4",
+}
+
+def write_compact_index(path, docmap, index, term_frequencies, doc_lengths):
+    doc_ids = list(docmap)
+    doc_positions = {doc_id: i for i, doc_id in enumerate(doc_ids)}
+    lengths = [doc_lengths.get(doc_id, 0) for doc_id in doc_ids]
+
+    doc_blobs = [json.dumps(docmap[doc_id]).encode("utf-8") for doc_id in doc_ids]
+    terms = sorted(index)
+    term_blobs = [term.encode("utf-8") for term in terms]
+
+    postings_ptr = [0]
+    doc_deltas, tfs = [], []
+    for term in terms:
+        positions = sorted(doc_positions[doc_id] for doc_id in index[term])
+        previous = 0
+        for pos in positions:
+            doc_deltas.append(pos - previous)
+            tfs.append(term_frequencies[doc_ids[pos]][term])
+            previous = pos
+        postings_ptr.append(len(doc_deltas))
+
+    order = np.argsort(np.array(doc_ids, dtype=np.int64), kind="stable")
+    sections = {
+        "doc_ids": np.array(doc_ids, dtype=np.int64),
+        "doc_lengths": np.array(lengths, dtype=np.uint32),
+        "sorted_doc_ids": np.array(doc_ids, dtype=np.int64)[order],
+        "sorted_doc_positions": order.astype(np.int64),
+        "doc_offsets": _offsets(doc_blobs),
+        "doc_bytes": np.frombuffer(b"".join(doc_blobs), dtype=np.uint8),
+        "term_offsets": _offsets(term_blobs),
+        "term_bytes": np.frombuffer(b"".join(term_blobs), dtype=np.uint8),
+        "postings_ptr": np.array(postings_ptr, dtype=np.uint64),
+        "doc_deltas": np.array(doc_deltas, dtype=np.uint32),
+        "tfs": np.array(tfs, dtype=np.uint32),
+    }
+    header = {
+        "format_version": COMPACT_INDEX_VERSION,
+        "doc_count": len(doc_ids),
+        "term_count": len(terms),
+        "posting_count": len(doc_deltas),
+        "total_doc_length": int(sum(lengths)),
+        "sections": {},
+    }
+
+    relative_offsets = {}
+    relative_offset = 0
+    for name, array in sections.items():
+        dtype = _narrowest_dtype(array) if name in NARROWED_SECTIONS else SECTION_DTYPES[name]
+        array = array.astype(dtype, copy=False)
+        sections[name] = array
+        relative_offsets[name] = relative_offset
+        relative_offset = _align(relative_offset + array.nbytes)
+
+    # Section offsets are absolute, so they grow with the header that stores
+    # them; lay the header out until the data start no longer moves.
+    data_start = 16
+    while True:
+        header["sections"] = {name: [data_start + relative_offsets[name], len(array), array.dtype.str] for name, array in sections.items()}
+        header_bytes = json.dumps(header).encode("utf-8")
+        if _align(16 + len(header_bytes)) <= data_start:
+            break
+        data_start = _align(16 + len(header_bytes))
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(COMPACT_INDEX_MAGIC)
+        f.write(np.array([COMPACT_INDEX_VERSION, len(header_bytes)], dtype="<u4").tobytes())
+        f.write(header_bytes)
+        for name, array in sections.items():
+            f.seek(header["sections"][name][0])
+            f.write(array.tobytes())
+        f.truncate(max(data_start, f.tell()))
+    os.replace(tmp_path, path)
+
+def _offsets(blobs):
+    offsets = np.zeros(len(blobs) + 1, dtype=np.uint64)
+    np.cumsum([len(blob) for blob in blobs], out=offsets[1:])
+    return offsets
+
+def _narrowest_dtype(array):
+    largest = int(array.max()) if len(array) else 0
+    for dtype in ("u1", "<u2", "<u4"):
+        if largest <= np.iinfo(dtype).max:
+            return dtype
+    return "<u8"
+
+def _align(offset):
+    return (offset + SECTION_ALIGNMENT - 1) // SECTION_ALIGNMENT * SECTION_ALIGNMENT
+
+class CompactIndex:
+    def __init__(self, path):
+        self.path = path
+        self.buffer = np.memmap(path, dtype=np.uint8, mode="r")
+        if bytes(self.buffer[:8]) != COMPACT_INDEX_MAGIC:
+            raise ValueError(f"{path} is not a compact index file")
+        version, header_len = np.frombuffer(self.buffer[8:16], dtype="<u4")
+        if version != COMPACT_INDEX_VERSION:
+            raise ValueError(f"Unsupported compact index version {version} (expected {COMPACT_INDEX_VERSION})")
+        self.header = json.loads(bytes(self.buffer[16:16 + header_len]))
+        for name, (offset, count, dtype) in self.header["sections"].items():
+            dtype = np.dtype(dtype)
+            setattr(self, name, self.buffer[offset:offset + count * dtype.itemsize].view(dtype))
+        self.doc_count = self.header["doc_count"]
+        self.term_count = self.header["term_count"]
+        self.total_doc_length = self.header["total_doc_length"]
+        self.terms = _TermList(self)
+        self.term_positions = lru_cache(maxsize=DECODED_POSTINGS_CACHE_SIZE)(self._decode_positions)
+
+    def avg_doc_length(self):
+        if self.doc_count == 0:
+            return 0.0
+        return self.total_doc_length / self.doc_count
+
+    def term_id(self, term):
+        i = bisect.bisect_left(self.terms, term)
+        if i < self.term_count and self.terms[i] == term:
+            return i
+        return None
+
+    def doc_freq(self, term):
+        term_id = self.term_id(term)
+        if term_id is None:
+            return 0
+        return int(self.postings_ptr[term_id + 1] - self.postings_ptr[term_id])
+
+    def postings(self, term):
+        term_id = self.term_id(term)
+        if term_id is None:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+        start, end = int(self.postings_ptr[term_id]), int(self.postings_ptr[term_id + 1])
+        positions = np.cumsum(self.doc_deltas[start:end], dtype=np.int64)
+        return positions, self.tfs[start:end].astype(np.float64)
+
+    def _decode_positions(self, term_id):
+        start, end = int(self.postings_ptr[term_id]), int(self.postings_ptr[term_id + 1])
+        return np.cumsum(self.doc_deltas[start:end], dtype=np.int64)
+
+    def term_frequency(self, term, pos):
+        # Positions are delta-encoded; each term's list is decoded once and
+        # then binary-searched for the document.
+        term_id = self.term_id(term)
+        if term_id is None:
+            return 0
+        positions = self.term_positions(term_id)
+        i = int(positions.searchsorted(pos))
+        if i < len(positions) and positions[i] == pos:
+            return int(self.tfs[int(self.postings_ptr[term_id]) + i])
+        return 0
+
+    def doc_position(self, doc_id):
+        i = int(self.sorted_doc_ids.searchsorted(doc_id))
+        if i < self.doc_count and self.sorted_doc_ids[i] == doc_id:
+            return int(self.sorted_doc_positions[i])
+        return None
+
+    def document(self, pos):
+        start, end = int(self.doc_offsets[pos]), int(self.doc_offsets[pos + 1])
+        return json.loads(bytes(self.doc_bytes[start:end]))
+
+class _TermList:
+    def __init__(self, compact):
+        self.compact = compact
+
+    def __len__(self):
+        return self.compact.term_count
+
+    def __getitem__(self, i):
+        start, end = int(self.compact.term_offsets[i]), int(self.compact.term_offsets[i + 1])
+        return bytes(self.compact.term_bytes[start:end]).decode("utf-8")
+
+class CompactDocMap(Mapping):
+    def __init__(self, compact):
+        self.compact = compact
+
+    def __getitem__(self, doc_id):
+        pos = self.compact.doc_position(doc_id)
+        if pos is None:
+            raise KeyError(doc_id)
+        return self.compact.document(pos)
+
+    def __iter__(self):
+        return (int(doc_id) for doc_id in self.compact.doc_ids)
+
+    def __len__(self):
+        return self.compact.doc_count
+
+class CompactPostingsMap(Mapping):
+    def __init__(self, compact):
+        self.compact = compact
+
+    def __getitem__(self, term):
+        if self.compact.term_id(term) is None:
+            raise KeyError(term)
+        positions, _ = self.compact.postings(term)
+        return set(self.compact.doc_ids[positions].tolist())
+
+    def __contains__(self, term):
+        return self.compact.term_id(term) is not None
+
+    def __iter__(self):
+        return (self.compact.terms[i] for i in range(self.compact.term_count))
+
+    def __len__(self):
+        return self.compact.term_count
+
+class CompactDocLengths(Mapping):
+    def __init__(self, compact):
+        self.compact = compact
+
+    def __getitem__(self, doc_id):
+        pos = self.compact.doc_position(doc_id)
+        if pos is None:
+            raise KeyError(doc_id)
+        return int(self.compact.doc_lengths[pos])
+
+    def __iter__(self):
+        return iter(CompactDocMap(self.compact))
+
+    def __len__(self):
+        return self.compact.doc_count
+
+class CompactTermFrequencies(Mapping):
+    def __init__(self, compact):
+        self.compact = compact
+
+    def __getitem__(self, doc_id):
+        pos = self.compact.doc_position(doc_id)
+        if pos is None:
+            raise KeyError(doc_id)
+        return _DocTermFrequencies(self.compact, pos)
+
+    def __iter__(self):
+        return iter(CompactDocMap(self.compact))
+
+    def __len__(self):
+        return self.compact.doc_count
+
+class _DocTermFrequencies:
+    def __init__(self, compact, pos):
+        self.compact = compact
+        self.pos = pos
+
+    def __getitem__(self, term):
+        return self.compact.term_frequency(term, self.pos)
@@ -0,0 +1,91 @@
+import numpy as np
+
+from .dense_retrieval import normalize_rows
+from .llm_scheduler import estimate_tokens
+from .semantic_search import semantic_chunk
+from .tracing import span
+from .search_utils import RAG_CONTEXT_TOKENS, CONTEXT_DUPLICATE_SIMILARITY, SEMANTIC_CHUNK_SIZE, SEMANTIC_CHUNK_OVERLAP
+
+def document_chunks(semantic_search, results):
+    # The chunk rows of every result document, in result order, with the
+    # passage text recovered by re-chunking the description the same way
+    # the chunk index was built.
+    rows, owners, texts = [], [], []
+    for owner, result in enumerate(results):
+        doc = result["document"]
+        doc_rows = range(*semantic_search.chunk_ranges.get(semantic_search.doc_positions[doc["id"]], (0, 0)))
+        chunks = semantic_chunk(doc["description"], SEMANTIC_CHUNK_SIZE, SEMANTIC_CHUNK_OVERLAP)
+        for row in doc_rows:
+            rows.append(row)
+            owners.append(owner)
+            texts.append(chunks[int(semantic_search.chunk_metadata[row]["chunk_idx"])])
+    return np.array(rows, dtype=np.int64), np.array(owners, dtype=np.int64), texts
+
+def numbered_header(i, doc):
+    return f"{i}. Title: {doc['title']}"
+
+def pack_context(query, results, semantic_search, budget = RAG_CONTEXT_TOKENS, every_document = False, header = numbered_header):
+    # Picks passages for an LLM prompt instead of whole descriptions: the
+    # result documents' chunks are scored against the query, passages that
+    # nearly repeat a better one are dropped, and the rest fill the token
+    # budget greedily by score per token. With every_document, each result
+    # keeps at least its best passage (rerank and judge prompts must list
+    # every candidate) even if that overruns the budget.
+    with span("rag.pack_context", budget=budget) as s:
+        rows, owners, texts = document_chunks(semantic_search, results)
+        packed = [[] for _ in results]
+        if len(rows) == 0:
+            return packed, {"budget": budget, "tokens": 0, "passages": 0, "candidates": 0, "duplicates": 0}
+        embeddings = normalize_rows(np.asarray(semantic_search.chunk_embeddings[rows], dtype=np.float32))
+        q = np.asarray(semantic_search.generate_embedding(query), dtype=np.float32)
+        scores = embeddings @ (q / (np.linalg.norm(q) or 1.0))
+
+        kept, duplicates = [], 0
+        for i in np.argsort(-scores, kind="stable"):
+            if kept and float(np.max(embeddings[kept] @ embeddings[i])) >= CONTEXT_DUPLICATE_SIMILARITY:
+                duplicates += 1
+                continue
+            kept.append(int(i))
+
+        header_tokens = [estimate_tokens(header(owner, result["document"])) for owner, result in enumerate(results)]
+        passage_tokens = np.array([estimate_tokens(text) for text in texts])
+        used, selected = 0, set()
+        if every_document:
+            # Best non-duplicate passage first, the best passage at all for
+            # a document whose passages were all duplicates.
+            for i in kept + np.argsort(-scores, kind="stable").tolist():
+                if not packed[owners[i]]:
+                    packed[owners[i]].append(i)
+                    selected.add(i)
+                    used += header_tokens[owners[i]] + passage_tokens[i]
+        ratio = np.maximum(scores, 0) / passage_tokens
+        for i in sorted(kept, key=lambda i: -ratio[i]):
+            if i in selected or scores[i] <= 0:
+                continue
+            cost = passage_tokens[i] + (0 if packed[owners[i]] else header_tokens[owners[i]])
+            if used + cost > budget:
+                continue
+            packed[owners[i]].append(i)
+            selected.add(i)
+            used += cost
+
+        # Passages are shown in description order under their document.
+        chunk_order = lambda i: int(semantic_search.chunk_metadata[rows[i]]["chunk_idx"])
+        packed = [[texts[i] for i in sorted(passages, key=chunk_order)] for passages in packed]
+        s.count("passages", len(selected))
+        s.count("prompt_tokens", int(used))
+        return packed, {"budget": budget, "tokens": int(used), "passages": len(selected), "candidates": len(rows), "duplicates": duplicates}
+
+def format_context(results, packed, header = numbered_header, every_document = False):
+    # One line per document that won a passage (or per result), in result order.
+    return "\n".join(
+        header(i, result["document"]) + (f"  Passages: {' ... '.join(passages)}" if passages else "")
+        for i, (result, passages) in enumerate(zip(results, packed)) if passages or every_document
+    )
+
+def build_context(query, results, semantic_search, budget = RAG_CONTEXT_TOKENS):
+    # Drop-in for formatter_for_llm: (titles, context text). Documents that
+    # won no passage are left out of the context but still listed as titles.
+    packed, stats = pack_context(query, results, semantic_search, budget)
+    titles = [f"  - Title: {result['document']['title']}" for result in results]
+    return titles, format_context(results, packed), stats
@@ -0,0 +1,47 @@
+import numpy as np
+
+from .search_utils import top_k_indices, SEARCH_BATCH_SIZE
+
+def normalize_rows(matrix):
+    matrix = np.array(matrix, dtype=np.float32)
+    norms = np.sqrt(np.einsum("ij,ij->i", matrix, matrix))
+    norms[norms == 0] = 1.0
+    matrix /= norms[:, None]
+    return matrix
+
+class DenseIndex:
+    def __init__(self, embeddings, normalized = False):
+        # Pre-normalized (e.g. memory-mapped cache) rows are used in place.
+        self.embeddings = embeddings if normalized else normalize_rows(embeddings)
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def scores(self, query_embedding, rows = None):
+        embeddings = self.embeddings if rows is None else self.embeddings[rows]
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm == 0:
+            return np.zeros(len(embeddings), dtype=np.float32)
+        return embeddings @ (query / norm)
+
+    def scores_many(self, query_embeddings, rows = None):
+        # One row of scores per query from a single matrix-matrix product.
+        embeddings = self.embeddings if rows is None else self.embeddings[rows]
+        queries = np.array(query_embeddings, dtype=np.float32)
+        norms = np.linalg.norm(queries, axis=1)
+        norms[norms == 0] = 1.0
+        return (queries / norms[:, None]) @ embeddings.T
+
+    def search(self, query_embedding, limit):
+        scores = self.scores(query_embedding)
+        top = top_k_indices(scores, limit)
+        return top, scores[top]
+
+    def search_many(self, query_embeddings, limit):
+        results = []
+        for start in range(0, len(query_embeddings), SEARCH_BATCH_SIZE):
+            for scores in self.scores_many(query_embeddings[start:start + SEARCH_BATCH_SIZE]):
+                top = top_k_indices(scores, limit)
+                results.append((top, scores[top]))
+        return results
@@ -0,0 +1,296 @@
+import os, json, time, hashlib, resource
+import numpy as np
+from contextlib import contextmanager
+
+from .dense_retrieval import normalize_rows
+from .search_utils import batches, EMBED_BATCH_SIZE, EMBED_SORT_WINDOW
+
+EMBEDDING_MANIFEST_VERSION = 1
+
+def content_hash(text):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+def source_hash(parts):
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def manifest_path(embeddings_path):
+    root, _ = os.path.splitext(embeddings_path)
+    return f"{root}.manifest.json"
+
+class NpyWriter:
+    # Appends float32 rows to a .npy file whose length is not known up
+    # front: the header is written for a placeholder row count of the same
+    # width and rewritten with the real count on close.
+    PLACEHOLDER_ROWS = 10 ** 12
+
+    def __init__(self, path, dim):
+        self.path = path
+        self.dim = dim
+        self.rows = 0
+        self.file = open(path, "wb")
+        self.header_size = self._write_header(self.PLACEHOLDER_ROWS)
+
+    def _write_header(self, rows):
+        np.lib.format.write_array_header_1_0(self.file, {"descr": np.lib.format.dtype_to_descr(np.dtype(np.float32)), "fortran_order": False, "shape": (rows, self.dim)})
+        return self.file.tell()
+
+    def append(self, rows):
+        np.ascontiguousarray(rows, dtype=np.float32).tofile(self.file)
+        self.rows += len(rows)
+
+    def read(self, indices):
+        # Rows already appended, read back from the file being written.
+        self.file.flush()
+        rows = np.memmap(self.path, dtype=np.float32, mode="r", offset=self.header_size, shape=(self.rows, self.dim))
+        return np.array(rows[indices])
+
+    def close(self):
+        self.file.seek(0)
+        if self._write_header(self.rows) != self.header_size:
+            raise ValueError(f"Header of {self.path} changed size when finalized")
+        self.file.close()
+
+class PartsOutput:
+    # The rows written so far by EmbeddingStore._writing; the file is only
+    # created once the first rows (and so the dimension) are known.
+    def __init__(self, path):
+        self.path = path
+        self.writer = None
+        self.hashes = []
+
+    def append(self, rows, hashes):
+        if len(hashes):
+            self.writer = self.writer or NpyWriter(self.path, rows.shape[1])
+            self.writer.append(rows)
+            self.hashes += hashes
+
+    def read(self, indices):
+        return self.writer.read(indices)
+
+def encode_sorted(texts, encode, batch_size = EMBED_BATCH_SIZE):
+    # Texts are encoded in fixed-size batches of similar length so each
+    # batch pads to a near neighbour instead of the longest text overall;
+    # rows come back in the input order.
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    vectors = None
+    for batch in batches(order, batch_size):
+        encoded = np.asarray(encode([texts[i] for i in batch]), dtype=np.float32)
+        if vectors is None:
+            vectors = np.empty((len(texts), encoded.shape[1]), dtype=np.float32)
+        vectors[batch] = encoded
+    return vectors
+
+class EmbeddingStore:
+    # One L2-normalized row per text in the order given; the manifest records
+    # the model and the content hash of every row so a refresh can reuse
+    # unchanged vectors and a cache written for other texts or another model
+    # is never served. A source hash of the inputs lets open() skip hashing
+    # (and chunking) every text on startup when nothing has changed.
+    def __init__(self, embeddings_path, model_name):
+        self.embeddings_path = embeddings_path
+        self.manifest_path = manifest_path(embeddings_path)
+        self.model_name = model_name
+        self.last_refresh = None
+
+    def load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return None
+        with open(self.manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("format_version") != EMBEDDING_MANIFEST_VERSION:
+            return None
+        return manifest
+
+    def _usable(self, manifest):
+        return (
+            manifest is not None
+            and manifest["model"] == self.model_name
+            and manifest.get("normalized", False)
+            and os.path.exists(self.embeddings_path)
+        )
+
+    def fingerprint(self, manifest = None):
+        # Identifies the rows on disk (model and every row's content hash),
+        # for artifacts derived from them such as the IVF and quantized indexes.
+        manifest = manifest or self.load_manifest()
+        if not self._usable(manifest):
+            return None
+        return source_hash([manifest["model"]] + manifest["hashes"])
+
+    def is_fresh(self, hashes, manifest = None):
+        manifest = manifest or self.load_manifest()
+        return self._usable(manifest) and manifest["hashes"] == hashes
+
+    def open(self, source, mmap_mode = "r"):
+        manifest = self.load_manifest()
+        if not self._usable(manifest) or manifest.get("source") != source:
+            return None
+        embeddings = np.load(self.embeddings_path, mmap_mode=mmap_mode)
+        if len(embeddings) != manifest["count"]:
+            return None
+        self.last_refresh = {"changed": False, "encoded": 0, "reused": len(embeddings), "dropped": 0, "duplicates": 0}
+        return embeddings
+
+    def refresh(self, texts, encode, mmap_mode = "r", reuse = True, source = None):
+        hashes = [content_hash(text) for text in texts]
+        manifest = self.load_manifest()
+        if reuse and self.is_fresh(hashes, manifest):
+            embeddings = np.load(self.embeddings_path, mmap_mode=mmap_mode)
+            if len(embeddings) == len(hashes):
+                if manifest.get("source") != source:
+                    self.write_manifest(hashes, embeddings.shape, source)
+                self.last_refresh = {"changed": False, "encoded": 0, "reused": len(hashes), "dropped": 0, "duplicates": len(hashes) - len(set(hashes))}
+                return embeddings
+
+        cached_rows, cached = self._cached_rows(manifest) if reuse else ({}, None)
+
+        unique_texts = dict(zip(hashes, texts))
+        missing = [h for h in unique_texts if h not in cached_rows]
+        encoded = np.asarray(encode([unique_texts[h] for h in missing]), dtype=np.float32) if missing else None
+        encoded_rows = {h: i for i, h in enumerate(missing)}
+
+        dim = encoded.shape[1] if encoded is not None else cached.shape[1] if cached is not None else 0
+        embeddings = np.empty((len(hashes), dim), dtype=np.float32)
+        from_cache = [i for i, h in enumerate(hashes) if h in cached_rows]
+        from_encoded = [i for i, h in enumerate(hashes) if h not in cached_rows]
+        if from_cache:
+            embeddings[from_cache] = cached[[cached_rows[hashes[i]] for i in from_cache]]
+        if from_encoded:
+            embeddings[from_encoded] = encoded[[encoded_rows[hashes[i]] for i in from_encoded]]
+
+        embeddings = normalize_rows(embeddings)
+        self.save(embeddings, hashes, source)
+        self.last_refresh = {
+            "changed": True,
+            "encoded": len(missing),
+            "reused": len(from_cache),
+            "dropped": len(set(cached_rows) - set(unique_texts)),
+            "duplicates": len(hashes) - len(unique_texts),
+        }
+        if mmap_mode is not None:
+            return np.load(self.embeddings_path, mmap_mode=mmap_mode)
+        return embeddings
+
+    def _cached_rows(self, manifest):
+        if manifest is None or manifest["model"] != self.model_name or not manifest.get("normalized", False) or not os.path.exists(self.embeddings_path):
+            return {}, None
+        cached = np.load(self.embeddings_path, mmap_mode="r")
+        if len(cached) != len(manifest["hashes"]):
+            return {}, None
+        return {h: i for i, h in enumerate(manifest["hashes"])}, cached
+
+    def refresh_stream(self, texts, encode, batch_size = EMBED_BATCH_SIZE, window = EMBED_SORT_WINDOW, mmap_mode = "r", reuse = True, source = None, before_manifest = None):
+        # refresh for a generator of texts: a window of texts at a time is
+        # hashed, its new texts encoded by length (encode_sorted) and the
+        # rows appended to the array on disk, so memory holds one window of
+        # texts and vectors instead of the whole corpus. Only the row hashes
+        # (needed for the manifest) grow with the corpus. A text already
+        # encoded in an earlier window is copied from the rows written.
+        started = time.perf_counter()
+        manifest = self.load_manifest()
+        cached_rows, cached = self._cached_rows(manifest) if reuse else ({}, None)
+        encoded_rows = {}
+        encoded = reused = 0
+        with self._writing(source, cached.shape[1] if cached is not None else 0, before_manifest) as output:
+            for window_texts in batches(texts, window):
+                window_hashes = [content_hash(text) for text in window_texts]
+                missing = {h: text for h, text in zip(window_hashes, window_texts) if h not in cached_rows and h not in encoded_rows}
+                vectors = encode_sorted(list(missing.values()), encode, batch_size) if missing else None
+                missing_rows = {h: i for i, h in enumerate(missing)}
+                dim = vectors.shape[1] if vectors is not None else cached.shape[1] if cached is not None else output.writer.dim
+                block = np.zeros((len(window_hashes), dim), dtype=np.float32)
+                from_cache = [i for i, h in enumerate(window_hashes) if h in cached_rows]
+                from_encoded = [i for i, h in enumerate(window_hashes) if h in missing_rows]
+                from_output = [i for i, h in enumerate(window_hashes) if h in encoded_rows]
+                if from_encoded:
+                    block[from_encoded] = vectors[[missing_rows[window_hashes[i]] for i in from_encoded]]
+                # Only new vectors are normalized; cached and copied rows
+                # already are, and are kept bit for bit.
+                block = normalize_rows(block)
+                if from_cache:
+                    block[from_cache] = cached[[cached_rows[window_hashes[i]] for i in from_cache]]
+                if from_output:
+                    block[from_output] = output.read([encoded_rows[window_hashes[i]] for i in from_output])
+                for i in from_encoded:
+                    encoded_rows.setdefault(window_hashes[i], len(output.hashes) + i)
+                output.append(block, window_hashes)
+                encoded += len(missing)
+                reused += len(from_cache)
+        hashes = output.hashes
+        seconds = time.perf_counter() - started
+        self.last_refresh = {
+            "changed": manifest is None or manifest.get("hashes") != hashes or manifest["model"] != self.model_name,
+            "encoded": encoded,
+            "reused": reused,
+            "dropped": len(set(cached_rows) - set(hashes)),
+            "duplicates": len(hashes) - len(set(hashes)),
+            "seconds": seconds,
+            "texts_per_second": len(hashes) / seconds if seconds else 0.0,
+            "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        }
+        return np.load(self.embeddings_path, mmap_mode=mmap_mode)
+
+    def write_parts(self, parts, source = None, dim = 0, before_manifest = None):
+        # Appends (normalized rows, hashes) parts to a new array on disk, so
+        # only one part is in memory at a time, then writes the manifest.
+        # Returns the row hashes.
+        with self._writing(source, dim, before_manifest) as output:
+            for rows, part_hashes in parts:
+                output.append(rows, part_hashes)
+        return output.hashes
+
+    @contextmanager
+    def _writing(self, source = None, dim = 0, before_manifest = None):
+        # The manifest is removed first and written last, so a crash at any
+        # point leaves a cache that is rebuilt. before_manifest writes the
+        # files that must match the rows (the chunk metadata) in between.
+        os.makedirs(os.path.dirname(self.embeddings_path), exist_ok=True)
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+        tmp_path = f"{self.embeddings_path}.tmp"
+        output = PartsOutput(tmp_path)
+        try:
+            yield output
+            writer = output.writer or NpyWriter(tmp_path, dim)
+            writer.close()
+        except BaseException:
+            if output.writer is not None:
+                output.writer.file.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, self.embeddings_path)
+        if before_manifest is not None:
+            before_manifest()
+        self.write_manifest(output.hashes, (len(output.hashes), writer.dim), source)
+
+    def save(self, embeddings, hashes, source = None):
+        os.makedirs(os.path.dirname(self.embeddings_path), exist_ok=True)
+        # Drop the manifest first so a crash between the two writes leaves a
+        # cache that is rebuilt rather than one that looks fresh.
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+        tmp_path = f"{self.embeddings_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, embeddings)
+        os.replace(tmp_path, self.embeddings_path)
+        self.write_manifest(hashes, embeddings.shape, source)
+
+    def write_manifest(self, hashes, shape, source = None):
+        manifest = {
+            "format_version": EMBEDDING_MANIFEST_VERSION,
+            "model": self.model_name,
+            "count": len(hashes),
+            "dimension": int(shape[1]) if len(shape) == 2 else 0,
+            "normalized": True,
+            "source": source,
+            "hashes": hashes,
+        }
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.manifest_path)
\ No newline at end of file
@@ -1,17 +1,14 @@
-import os, json
+import json
 
-from dotenv import load_dotenv
-from google import genai
 from .hybrid_search import HybridSearch
 from .search_utils import (
     load_golden_data,
     load_movies,
 )
 from .semantic_search import SemanticSearch
+from .llm_client import generate_content, generate_content_many
+from .context_builder import pack_context, format_context
 
-load_dotenv()
-api_key = os.getenv("gemini_api_key")
-client = genai.Client(api_key=api_key)
 model = "gemini-2.5-flash"
 
 
@@ -43,10 +40,10 @@ def evaluate_command(limit = 5):
 
     total_precision = 0
     results_by_query = {}
-    for test_case in golden_data_tests:
+    batch_results = hybrid_search.search_many([test_case["query"] for test_case in golden_data_tests], "rrf", limit, k=60)
+    for test_case, search_results in zip(golden_data_tests, batch_results):
         query = test_case["query"]
         relevant_docs = set(test_case["relevant_docs"])
-        search_results = hybrid_search.rrf_search(query, k=60, limit=limit)
         retrieved_docs = []
         for result in search_results:
             title = result["document"].get("title", "")
@@ -55,7 +52,7 @@ def evaluate_command(limit = 5):
         
         precision = precision_at_k(retrieved_docs, relevant_docs, limit)
         recall = recall_at_k(search_results, relevant_docs, limit)
-        f1 = 2 * (precision * recall) / (precision + recall)
+        f1 = 2 * (precision * recall) / (precision + recall) if precision + recall else 0.0
 
         results_by_query[query] = {
             "precision": precision,
@@ -73,10 +70,14 @@ def evaluate_command(limit = 5):
         "results": results_by_query,
     }
 
-def llm_evaluation(query, results):
-    formatted_ranking = []
-    for i, ranking in enumerate(results):
-        formatted_ranking.append(f'{i}. Title: {ranking['document']['title']}  Description": {ranking['document']['description']}')
+def llm_evaluation(query, results, semantic_search = None):
+    if semantic_search is None:
+        formatted_ranking = []
+        for i, ranking in enumerate(results):
+            formatted_ranking.append(f'{i}. Title: {ranking['document']['title']}  Description": {ranking['document']['description']}')
+    else:
+        packed, _ = pack_context(query, results, semantic_search, every_document=True)
+        formatted_ranking = format_context(results, packed, every_document=True).splitlines()
     prompt = f"""Rate how relevant each result is to this query on a 0-3 scale:
 
             Query: "{query}"
@@ -95,7 +96,7 @@ def llm_evaluation(query, results):
 
             [2, 0, 3, 2, 0, 1]"""
 
-    response = client.models.generate_content(model=model, contents=prompt)
+    response = generate_content(model, prompt, parse=json.loads)
     corrected = (response.text or "").strip().strip('"')
     scores = json.loads(corrected)
 
@@ -107,4 +108,30 @@ def llm_evaluation(query, results):
 
     raise ValueError(
         f"LLM response parsing error. Expected {len(results)} scores, got {len(scores)}. Response: {scores}"
-    )
\ No newline at end of file
+    )
+
+def answer_relevance_prompt(query, answer):
+    return f"""Rate how well this answer addresses the user's query about movies on Hoopla.
+
+            Query: "{query}"
+            Answer: {answer}
+
+            Consider:
+            - Does it answer what was asked
+            - Is it grounded in specific movies rather than generic
+            - Is it concise and free of irrelevant detail
+
+            Rate 0-10 (10 = perfect answer).
+            Give me ONLY the number in your response, no other text or explanation.
+
+            Score:"""
+
+def answer_relevance_many(queries, answers):
+    # A request that failed after its retries, or a reply that is not a
+    # number, scores 0 rather than discarding the other answers' scores.
+    responses = generate_content_many(model, [answer_relevance_prompt(query, answer) for query, answer in zip(queries, answers)], return_exceptions=True, parse=int)
+    scores = []
+    for response in responses:
+        corrected = "" if isinstance(response, Exception) else (response.text or "").strip().strip('"')
+        scores.append(int(corrected) if corrected.isdigit() else 0)
+    return scores
@@ -1,78 +1,308 @@
-import os
+import time, queue, threading
+import numpy as np
+
+from concurrent.futures import Future, TimeoutError as FuturesTimeoutError
 
 from .keyword_search import InvertedIndex
 from .semantic_search import ChunkedSemanticSearch
-from .search_utils import DEFAULT_ALPHA_HYBRID, DEFAULT_SEARCH_LIMIT, RRF_K1, load_movies
-from lib.query_enhancement import enhance_query
-from lib.rerank import rerank_result
+from .tracing import span, traced, bind
+from .search_utils import DEFAULT_ALPHA_HYBRID, DEFAULT_SEARCH_LIMIT, RRF_K1, HYBRID_CANDIDATE_MULTIPLIER, HYBRID_BRANCH_WORKERS, SCORE_PRECISION, load_movies, top_k_indices
+
+class BranchExecutor:
+    # A small thread pool with daemon workers. ThreadPoolExecutor joins its
+    # workers at interpreter exit, so a branch abandoned at its timeout would
+    # still keep the CLI running until it finished; here it is dropped.
+    def __init__(self, max_workers = HYBRID_BRANCH_WORKERS, thread_name_prefix = "hybrid-branch"):
+        self.max_workers = max_workers
+        self.thread_name_prefix = thread_name_prefix
+        self.tasks = queue.SimpleQueue()
+        self.threads = []
+        self.idle = 0
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("cannot submit branches after the executor was shut down")
+            self.tasks.put((future, fn, args))
+            if self.idle:
+                self.idle -= 1
+            elif len(self.threads) < self.max_workers:
+                thread = threading.Thread(target=self._work, name=f"{self.thread_name_prefix}_{len(self.threads)}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+        return future
+
+    def _work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            future, fn, args = task
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args))
+                except BaseException as e:
+                    future.set_exception(e)
+            with self.lock:
+                self.idle += 1
+
+    def shutdown(self, wait = True, cancel_futures = False):
+        with self.lock:
+            self.closed = True
+            threads = list(self.threads)
+        if cancel_futures:
+            while True:
+                try:
+                    task = self.tasks.get_nowait()
+                except queue.Empty:
+                    break
+                if task is not None:
+                    task[0].cancel()
+        for _ in threads:
+            self.tasks.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
 
 class HybridSearch:
-    def __init__(self, documents):
+    @traced("hybrid.load")
+    def __init__(self, documents, nprobe = None, semantic_search = None, idx = None, concurrent = True, timeouts = None):
         self.documents = documents
-        self.semantic_search = ChunkedSemanticSearch()
-        self.semantic_search.load_or_create_chunk_embeddings(documents)
-
-        self.idx = InvertedIndex()
-        if not os.path.exists(self.idx.idx_path):
-            self.idx.build()
-            self.idx.save()
-
-    def _bm25_search(self, query, limit = DEFAULT_SEARCH_LIMIT):
-        self.idx.load()
-        return self.idx.bm25_search(query, limit)
-
-    def weighted_search(self, query, alpha, limit=5):
-        bm25_results = self._bm25_search(query, limit * 500)
-        semantic_results = self.semantic_search.search_chunks(query, limit * 500)
-        bm25_scores = [result["score"] for result in bm25_results]
-        semantic_scores = [result["score"] for result in semantic_results]
-        bm_norm_scores = normalize_command(bm25_scores)
-        sem_norm_scores = normalize_command(semantic_scores)
-        ids_to_k_scores = {}
-        ids_to_sem_scores = {}
-        for i, result in enumerate(bm25_results):
-            ids_to_k_scores[result["id"]] = bm_norm_scores[i]
-        for i, result in enumerate(semantic_results):
-            ids_to_sem_scores[result["id"]] = sem_norm_scores[i]
-        all_ids = set(ids_to_k_scores.keys()) | set(ids_to_sem_scores.keys())
-        doc_scores = {}
-        for id in all_ids:
-            doc_scores[id] = {
-                "document": self.semantic_search.document_map[id],
-                "bm25_score": ids_to_k_scores.get(id, 0.0),
-                "semantic_score": ids_to_sem_scores.get(id, 0.0),
-                "hybrid_score": hybrid_score(ids_to_k_scores.get(id, 0.0), ids_to_sem_scores.get(id, 0.0), alpha)
-            }
-        sorted_scores = sorted(doc_scores.items(), key=lambda item: item[1]["hybrid_score"], reverse=True)
-        sorted_scores = [score[1] for score in sorted_scores] 
-        return sorted_scores
-
-    def rrf_search(self, query, k, limit=10):
-        bm25_results = self._bm25_search(query, limit * 500)
-        semantic_results = self.semantic_search.search_chunks(query, limit * 500)
-        ids_to_k_ranks = {}
-        ids_to_sem_ranks = {}
-        for i, result in enumerate(bm25_results, start=1):
-            ids_to_k_ranks[result["id"]] = i
-        for i, result in enumerate(semantic_results, start=1):
-            ids_to_sem_ranks[result["id"]] = i
-        all_ids = set(ids_to_k_ranks.keys()) | set(ids_to_sem_ranks.keys())
-        doc_rankings = {}        
-        for i, id in enumerate(all_ids):
-            doc_rankings[id] = {
-                "document": self.semantic_search.document_map[id],
-                "bm25_rank": ids_to_k_ranks.get(id),
-                "semantic_rank": ids_to_sem_ranks.get(id),
-                "rrf_score": 0.0
-            }
-            if doc_rankings[id]["bm25_rank"] is not None:
-                doc_rankings[id]["rrf_score"] += rrf_score(doc_rankings[id]["bm25_rank"], k)
-            if doc_rankings[id]["semantic_rank"] is not None:
-                doc_rankings[id]["rrf_score"] += rrf_score(doc_rankings[id]["semantic_rank"], k)
-        sorted_rankings = sorted(doc_rankings.items(), key=lambda item: item[1]["rrf_score"], reverse=True)
-        sorted_rankings = [ranking[1] for ranking in sorted_rankings]
-        return sorted_rankings
-    
+        self.nprobe = nprobe
+        self.concurrent = concurrent
+        self.timeouts = timeouts or {}
+        self.executor = None
+        self._executor_lock = threading.Lock()
+        self.last_search_stats = None
+        if semantic_search is None:
+            semantic_search = ChunkedSemanticSearch()
+            semantic_search.load_or_create_chunk_embeddings(documents)
+        self.semantic_search = semantic_search
+
+        if idx is None:
+            idx = InvertedIndex()
+            if idx.exists():
+                idx.load()
+            else:
+                idx.build()
+                idx.save()
+        self.idx = idx
+
+    def _nprobe(self, nprobe):
+        return self.nprobe if nprobe is None else nprobe
+
+    def _depth(self, limit, depth):
+        return limit * HYBRID_CANDIDATE_MULTIPLIER if depth is None else depth
+
+    @traced("hybrid.bm25_branch")
+    def bm25_candidates(self, query, depth):
+        return self.idx.bm25_candidates(query, depth)
+
+    @traced("hybrid.semantic_branch")
+    def semantic_candidates(self, query, depth, nprobe = None):
+        q_embedding = self.semantic_search.generate_embedding(query)
+        movie_idx, scores, _ = self.semantic_search.chunk_candidates(q_embedding, depth, self._nprobe(nprobe))
+        return self.semantic_search.doc_ids[movie_idx], scores
+
+    @traced("hybrid.semantic_branch")
+    def semantic_candidates_many(self, queries, depth, nprobe = None):
+        q_embeddings = self.semantic_search.generate_embeddings(queries)
+        results = self.semantic_search.chunk_candidates_many(q_embeddings, depth, self._nprobe(nprobe))
+        return [(self.semantic_search.doc_ids[movie_idx], scores) for movie_idx, scores, _ in results]
+
+    def _executor(self):
+        if self.executor is None:
+            with self._executor_lock:
+                if self.executor is None:
+                    self.executor = BranchExecutor()
+        return self.executor
+
+    def close(self):
+        # Queued branches are cancelled; a branch still running past its
+        # timeout finishes in the background without delaying exit.
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, fn, *args):
+        return self._executor().submit(bind(fn), *args)
+
+    def submit_branches(self, query, depth, nprobe = None):
+        # BM25 scoring holds the GIL, but query encoding and the chunk matrix
+        # product mostly release it, so the two retrievers overlap.
+        return {
+            "bm25": self.submit(_timed, self.bm25_candidates, query, depth),
+            "semantic": self.submit(_timed, self.semantic_candidates, query, depth, nprobe),
+        }
+
+    def _timeouts(self, timeouts):
+        return {**self.timeouts, **(timeouts or {})}
+
+    @traced("hybrid.retrieve")
+    def candidates(self, query, depth, nprobe = None, timeouts = None, branches = None):
+        started = time.perf_counter()
+        timeouts = self._timeouts(timeouts)
+        if not self.concurrent and branches is None:
+            return self._finish(self._sequential_outcomes(query, depth, nprobe, timeouts, started), started)
+        branches = branches or self.submit_branches(query, depth, nprobe)
+        outcomes = {}
+        for name, future in branches.items():
+            deadline = timeouts.get(name)
+            remaining = None if deadline is None else max(0.0, started + deadline - time.perf_counter())
+            try:
+                outcomes[name] = future.result(timeout=remaining)
+            except FuturesTimeoutError:
+                outcomes[name] = None
+        return self._finish(outcomes, started)
+
+    def _sequential_outcomes(self, query, depth, nprobe, timeouts, started):
+        # The same deadlines as the concurrent path, measured from the start
+        # of retrieval: a branch whose deadline has passed is skipped and one
+        # that overran it is dropped. A running branch cannot be interrupted.
+        outcomes = {}
+        for name, fn, args in (("bm25", self.bm25_candidates, (query, depth)), ("semantic", self.semantic_candidates, (query, depth, nprobe))):
+            deadline = timeouts.get(name)
+            if deadline is not None and time.perf_counter() - started >= deadline:
+                outcomes[name] = None
+                continue
+            outcome = _timed(fn, *args)
+            outcomes[name] = outcome if deadline is None or time.perf_counter() - started <= deadline else None
+        return outcomes
+
+    async def acandidates(self, query, depth, nprobe = None, timeouts = None):
+        import asyncio
+        started = time.perf_counter()
+        timeouts = self._timeouts(timeouts)
+        branches = {name: asyncio.wrap_future(future) for name, future in self.submit_branches(query, depth, nprobe).items()}
+        outcomes = {}
+        for name, future in branches.items():
+            deadline = timeouts.get(name)
+            remaining = None if deadline is None else max(0.0, started + deadline - time.perf_counter())
+            try:
+                outcomes[name] = await asyncio.wait_for(asyncio.shield(future), remaining)
+            except asyncio.TimeoutError:
+                outcomes[name] = None
+        return self._finish(outcomes, started)
+
+    def _finish(self, outcomes, started):
+        wall = time.perf_counter() - started
+        timed_out = [name for name, outcome in outcomes.items() if outcome is None]
+        if len(timed_out) == len(outcomes):
+            raise TimeoutError(f"Hybrid search timed out in every branch ({', '.join(timed_out)})")
+        branch_seconds = {name: outcome[1] for name, outcome in outcomes.items() if outcome is not None}
+        sequential = sum(branch_seconds.values())
+        self.last_search_stats = {
+            "concurrent": self.concurrent,
+            "branch_ms": {name: seconds * 1000 for name, seconds in branch_seconds.items()},
+            "sequential_ms": sequential * 1000,
+            "wall_ms": wall * 1000,
+            "saved_ms": max(0.0, sequential - wall) * 1000,
+            "timed_out": timed_out,
+        }
+        # A branch that missed its deadline contributes no candidates, so
+        # fusion falls back to the other retriever alone.
+        return {name: outcome[0] if outcome is not None else (np.empty(0, dtype=np.int64), np.empty(0)) for name, outcome in outcomes.items()}
+
+    def _document(self, doc_id):
+        return self.semantic_search.document_map[int(doc_id)]
+
+    def weighted_search(self, query, alpha, limit=5, nprobe=None, depth=None, timeouts=None):
+        candidates = self.candidates(query, self._depth(limit, depth), nprobe, timeouts)
+        return self.fuse_weighted(candidates, alpha, limit)
+
+    def rrf_search(self, query, k, limit=10, nprobe=None, depth=None, timeouts=None, branches=None):
+        candidates = self.candidates(query, self._depth(limit, depth), nprobe, timeouts, branches)
+        return self.fuse_rrf(candidates, k, limit)
+
+    async def asearch(self, query, method = "rrf", limit = DEFAULT_SEARCH_LIMIT, nprobe = None, depth = None, timeouts = None, alpha = DEFAULT_ALPHA_HYBRID, k = RRF_K1):
+        candidates = await self.acandidates(query, self._depth(limit, depth), nprobe, timeouts)
+        return self.fuse(candidates, method, limit, alpha, k)
+
+    @traced("hybrid.search_many")
+    def search_many(self, queries, method = "rrf", limit = DEFAULT_SEARCH_LIMIT, nprobe = None, depth = None, alpha = DEFAULT_ALPHA_HYBRID, k = RRF_K1):
+        # Each retriever handles the whole batch at once (one encoder pass,
+        # one score matrix); the two batches still run concurrently.
+        queries = list(queries)
+        depth = self._depth(limit, depth)
+        if self.concurrent:
+            semantic = self.submit(self.semantic_candidates_many, queries, depth, nprobe)
+            with span("hybrid.bm25_branch"):
+                bm25 = self.idx.bm25_candidates_many(queries, depth)
+            semantic = semantic.result()
+        else:
+            with span("hybrid.bm25_branch"):
+                bm25 = self.idx.bm25_candidates_many(queries, depth)
+            semantic = self.semantic_candidates_many(queries, depth, nprobe)
+        return [self.fuse({"bm25": bm25_candidates, "semantic": semantic_candidates}, method, limit, alpha, k) for bm25_candidates, semantic_candidates in zip(bm25, semantic)]
+
+    def fuse(self, candidates, method, limit, alpha = DEFAULT_ALPHA_HYBRID, k = RRF_K1):
+        match method:
+            case "rrf":
+                return self.fuse_rrf(candidates, k, limit)
+            case "weighted":
+                return self.fuse_weighted(candidates, alpha, limit)
+            case _:
+                raise ValueError(f"Unknown hybrid search method '{method}', expected 'rrf' or 'weighted'")
+
+    @traced("hybrid.fuse")
+    def fuse_weighted(self, candidates, alpha, limit):
+        bm25_ids, bm25_scores = candidates["bm25"]
+        semantic_ids, semantic_scores = candidates["semantic"]
+        ids, inverse = np.unique(np.concatenate([bm25_ids, semantic_ids]), return_inverse=True)
+        bm25_norm = np.zeros(len(ids))
+        semantic_norm = np.zeros(len(ids))
+        bm25_norm[inverse[:len(bm25_ids)]] = normalize_scores(bm25_scores)
+        semantic_norm[inverse[len(bm25_ids):]] = normalize_scores(semantic_scores)
+        hybrid_scores = hybrid_score(bm25_norm, semantic_norm, alpha)
+        results = []
+        for i in top_k_indices(hybrid_scores, limit):
+            results.append({
+                "document": self._document(ids[i]),
+                "bm25_score": float(bm25_norm[i]),
+                "semantic_score": float(semantic_norm[i]),
+                "hybrid_score": float(hybrid_scores[i]),
+            })
+        return results
+
+    @traced("hybrid.fuse")
+    def fuse_rrf(self, candidates, k, limit):
+        bm25_ids, _ = candidates["bm25"]
+        semantic_ids, _ = candidates["semantic"]
+        ids, inverse = np.unique(np.concatenate([bm25_ids, semantic_ids]), return_inverse=True)
+        bm25_ranks = np.zeros(len(ids), dtype=np.int64)
+        semantic_ranks = np.zeros(len(ids), dtype=np.int64)
+        bm25_ranks[inverse[:len(bm25_ids)]] = np.arange(1, len(bm25_ids) + 1)
+        semantic_ranks[inverse[len(bm25_ids):]] = np.arange(1, len(semantic_ids) + 1)
+        scores = np.zeros(len(ids))
+        scores += np.where(bm25_ranks > 0, rrf_score(bm25_ranks, k), 0.0)
+        scores += np.where(semantic_ranks > 0, rrf_score(semantic_ranks, k), 0.0)
+        results = []
+        for i in top_k_indices(scores, limit):
+            results.append({
+                "document": self._document(ids[i]),
+                "bm25_rank": int(bm25_ranks[i]) or None,
+                "semantic_rank": int(semantic_ranks[i]) or None,
+                "rrf_score": float(scores[i]),
+            })
+        return results
+
+def _timed(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - started
+
+def normalize_scores(scores):
+    # Array form of normalize_command over scores rounded as the formatted
+    # search results round them.
+    scores = np.round(np.asarray(scores, dtype=np.float64), SCORE_PRECISION)
+    if len(scores) == 0:
+        return scores
+    minimum, maximum = scores.min(), scores.max()
+    if minimum == maximum:
+        return np.ones(len(scores))
+    return np.round((scores - minimum) / (maximum - minimum), 4)
 
 def normalize_command(scores):
     if not scores:
@@ -93,34 +323,54 @@ def normalize_command(scores):
         return normalized_scores
 
 
-def weighted_search_command(query, alpha = DEFAULT_ALPHA_HYBRID, limit = DEFAULT_SEARCH_LIMIT):
-    movies = load_movies()
-    hybrid_search = HybridSearch(movies)
-    scores = hybrid_search.weighted_search(query, alpha, limit)
+def weighted_search_command(query, alpha = DEFAULT_ALPHA_HYBRID, limit = DEFAULT_SEARCH_LIMIT, nprobe = None, hybrid_search = None, depth = None, timeouts = None):
+    if hybrid_search is None:
+        hybrid_search = HybridSearch(load_movies(), nprobe)
+    scores = hybrid_search.weighted_search(query, alpha, limit, nprobe, depth, timeouts)
     return scores[:limit]
 
 def hybrid_score(bm25_score, semantic_score, alpha=0.5):
     return alpha * bm25_score + (1 - alpha) * semantic_score
 
-def rrf_search_command(query, k = RRF_K1, enhance = None, rerank_method = None, limit = DEFAULT_SEARCH_LIMIT):
-    movies = load_movies()
-    hybrid_search = HybridSearch(movies)
+def rrf_search_command(query, k = RRF_K1, enhance = None, rerank_method = None, limit = DEFAULT_SEARCH_LIMIT, nprobe = None, hybrid_search = None, depth = None, timeouts = None, rerank_top_n = None):
+    if hybrid_search is None:
+        hybrid_search = HybridSearch(load_movies(), nprobe)
     
     original_query = query
+    new_limit = max(limit, rerank_top_n or limit * 5) if rerank_method else limit
     # print(f"Original Query: {original_query}") 
     enhanced_query = None
+    branches = None
     if enhance:
-        enhanced_query = enhance_query(query, method=enhance)
-        query = enhanced_query
+        from lib.query_enhancement import enhance_query
+        from lib.query_cache import normalize_query
+        enhancement = hybrid_search.submit(enhance_query, query, enhance)
+        # Retrieve for the original query while the LLM call is in flight;
+        # the candidates are kept when enhancement leaves the query unchanged
+        # (common for spell) or misses its deadline.
+        speculative = hybrid_search.submit_branches(query, hybrid_search._depth(new_limit, depth), nprobe) if hybrid_search.concurrent else None
+        try:
+            with span("hybrid.wait_enhancement", method=enhance):
+                enhanced_query = enhancement.result(timeout=hybrid_search._timeouts(timeouts).get("enhance"))
+        except FuturesTimeoutError:
+            enhanced_query = None
+        if enhanced_query is None or normalize_query(enhanced_query) == normalize_query(query):
+            branches = speculative
+        elif speculative:
+            # BM25 scoring is thread-safe, but there is no point finishing
+            # retrieval for a query that was replaced.
+            for future in speculative.values():
+                future.cancel()
+        if enhanced_query is not None:
+            query = enhanced_query
     # print(f"Enhanced Query: {enhanced_query}") 
 
-    new_limit = limit * 5 if rerank_method else limit
-
-    results = hybrid_search.rrf_search(query, k, new_limit)
+    results = hybrid_search.rrf_search(query, k, new_limit, nprobe, depth, timeouts, branches)
 
     # print(f"Results after rrf search: {results[:20]}\n") 
     if rerank_method:
-        results = rerank_result(results, query, rerank_method)
+        from lib.rerank import rerank_result
+        results = rerank_result(results, query, rerank_method, rerank_top_n, hybrid_search.semantic_search)
     # print(f"Results after re-ranking: {results}\n") 
     return {
         "original_query": original_query,
@@ -132,5 +382,16 @@ def rrf_search_command(query, k = RRF_K1, enhance = None, rerank_method = None,
         "results": results[:limit],
     }
 
+def branch_timeouts(bm25 = None, semantic = None, enhance = None):
+    timeouts = {"bm25": bm25, "semantic": semantic, "enhance": enhance}
+    return {name: seconds for name, seconds in timeouts.items() if seconds is not None}
+
+def format_branch_stats(stats):
+    branches = ", ".join(f"{name} {ms:.1f} ms" for name, ms in stats["branch_ms"].items())
+    line = f"Branches: {branches}; wall {stats['wall_ms']:.1f} ms, saved {stats['saved_ms']:.1f} ms vs sequential ({stats['sequential_ms']:.1f} ms)"
+    if stats["timed_out"]:
+        line += f"; timed out: {', '.join(stats['timed_out'])}"
+    return line
+
 def rrf_score(rank, k=60):
     return 1 / (k + rank)
\ No newline at end of file
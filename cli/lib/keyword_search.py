@@ -1,8 +1,56 @@
-import string, math, pickle, os
+import string, math, pickle, os, heapq, bisect, threading
+import numpy as np
 
-from nltk.stem import PorterStemmer
+from functools import lru_cache
 from collections import Counter
-from .search_utils import load_movies, load_stop_words, DEFAULT_SEARCH_LIMIT, CACHE_DIR, BM25_K1, BM25_B, single_token, SCORE_PRECISION
+from .tracing import span, traced
+from .compact_index import CompactIndex, CompactDocMap, CompactPostingsMap, CompactTermFrequencies, CompactDocLengths, write_compact_index
+from .search_utils import load_movies, load_stop_words, DEFAULT_SEARCH_LIMIT, CACHE_DIR, BM25_K1, BM25_B, single_token, top_k_indices, SCORE_PRECISION, STEM_CACHE_SIZE, BM25_BLOCK_SIZE, BM25_PRUNING_METHODS, SEARCH_BATCH_SIZE
+
+class Tokenizer:
+    def __init__(self, stop_words = None, stem_cache_size = STEM_CACHE_SIZE):
+        if stop_words is None:
+            stop_words = load_stop_words()
+        self.stop_words = frozenset(stop_words)
+        from nltk.stem import PorterStemmer
+        self.stemmer = PorterStemmer()
+        self.stem = lru_cache(maxsize=stem_cache_size)(self.stemmer.stem)
+        self.punctuation_table = str.maketrans('', '', string.punctuation)
+
+    def tokenize(self, text):
+        tokens = text.lower().translate(self.punctuation_table).split()
+        stop_words, stem = self.stop_words, self.stem
+        return [stem(token) for token in tokens if token not in stop_words]
+
+    def tokenize_many(self, texts):
+        return [self.tokenize(text) for text in texts]
+
+    def cache_info(self):
+        return self.stem.cache_info()
+
+    def fingerprint(self):
+        # Everything that decides the tokens, for hashing into the inputs
+        # of a cached or checkpointed index.
+        import nltk
+        return [type(self.stemmer).__name__, self.stemmer.mode, nltk.__version__, string.punctuation, *sorted(self.stop_words)]
+
+@lru_cache(maxsize=1)
+def get_tokenizer():
+    with span("bm25.load_tokenizer"):
+        return Tokenizer()
+
+def document_texts(movies):
+    return [f'{movie["title"]} {movie["description"]}' for movie in movies]
+
+class CorpusStats:
+    # Collection-wide BM25 statistics for an index holding only part of the
+    # corpus (a search shard), so its scores equal the unsharded index's.
+    # doc_freqs only needs the terms being scored; the scoring methods also
+    # take the frequencies of their query terms per call.
+    def __init__(self, documents, avg_doc_length, doc_freqs = None):
+        self.documents = documents
+        self.avg_doc_length = avg_doc_length
+        self.doc_freqs = doc_freqs or {}
 
 class InvertedIndex:
     def __init__(self):
@@ -12,16 +60,35 @@ class InvertedIndex:
         self.docmap_path = os.path.join(CACHE_DIR, "docmap.pkl")
         self.term_frequencies_path = os.path.join(CACHE_DIR, "term_frequencies.pkl")
         self.doc_lengths_path = os.path.join(CACHE_DIR, "doc_lengths.pkl")
+        self.compact_path = os.path.join(CACHE_DIR, "index.bin")
         self.term_frequencies = {}
         self.doc_lengths = {}
+        self.compact = None
+        self.corpus_stats = None
+        self.tokenizer = get_tokenizer()
+        self._scoring_lock = threading.Lock()
+        self._reset_scoring()
 
+    @traced("bm25.build_index")
     def build(self):
         movies = load_movies()
-        for movie in movies:
-            self.docmap[movie["id"]] = movie  
-            self.__add_document(movie["id"], f'{movie["title"]} {movie["description"]}')          
+        self.add_documents(movies, self.tokenizer.tokenize_many(document_texts(movies)))
+
+    def add_documents(self, movies, token_lists):
+        # token_lists come from the tokenizer, here or in the sharded build's
+        # worker processes.
+        self._reset_scoring()
+        self.compact = None
+        for movie, tokens in zip(movies, token_lists):
+            self.docmap[movie["id"]] = movie
+            self.__add_document(movie["id"], tokens)
 
     def save(self):
+        if not os.path.exists(CACHE_DIR):
+            os.mkdir(CACHE_DIR)
+        write_compact_index(self.compact_path, self.docmap, self.index, self.term_frequencies, self.doc_lengths)
+
+    def save_pickles(self):
         if not os.path.exists(CACHE_DIR):
             os.mkdir(CACHE_DIR)
         with open(self.idx_path, "wb") as f:
@@ -33,7 +100,27 @@ class InvertedIndex:
         with open(self.doc_lengths_path, "wb") as f:
             pickle.dump(self.doc_lengths, f)
 
+    def exists(self):
+        return os.path.exists(self.compact_path) or os.path.exists(self.idx_path)
+
+    @traced("bm25.load_index")
     def load(self):
+        if os.path.exists(self.compact_path):
+            self.load_compact()
+        else:
+            self.load_pickles()
+
+    def load_compact(self):
+        self._reset_scoring()
+        self.compact = CompactIndex(self.compact_path)
+        self.index = CompactPostingsMap(self.compact)
+        self.docmap = CompactDocMap(self.compact)
+        self.term_frequencies = CompactTermFrequencies(self.compact)
+        self.doc_lengths = CompactDocLengths(self.compact)
+
+    def load_pickles(self):
+        self._reset_scoring()
+        self.compact = None
         with open(self.idx_path, "rb") as f:
             self.index = pickle.load(f)
         with open(self.docmap_path, "rb") as f:
@@ -43,8 +130,7 @@ class InvertedIndex:
         with open(self.doc_lengths_path, "rb") as f:
             self.doc_lengths = pickle.load(f)
 
-    def __add_document(self, doc_id, text):
-        tokens = tokenize_text(text)
+    def __add_document(self, doc_id, tokens):
         self.doc_lengths[doc_id] = len(tokens)
         
         for token in set(tokens):
@@ -65,14 +151,14 @@ class InvertedIndex:
         return doc_ids
    
     def get_tf(self, doc_id, term):
-        tokens = tokenize_text(term)
+        tokens = self.tokenizer.tokenize(term)
         single_token(tokens)
         if doc_id not in self.term_frequencies:
             return 0
         return self.term_frequencies[doc_id][tokens[0]]
 
     def get_idf(self, term):
-        tokens = tokenize_text(term)
+        tokens = self.tokenizer.tokenize(term)
         single_token(tokens)
         total_doc_count = len(self.docmap)
         term_doc_count = len(self.index[tokens[0]])
@@ -80,7 +166,7 @@ class InvertedIndex:
         return term_idf
 
     def get_bm25_idf(self, term):
-        tokens = tokenize_text(term)        
+        tokens = self.tokenizer.tokenize(term)
         single_token(tokens)
         total_docs = len(self.docmap)
         if tokens[0] not in self.index:
@@ -104,47 +190,343 @@ class InvertedIndex:
         return tf * idf
 
     def __get_avg_doc_length(self):
+        if self.compact is not None:
+            return self.compact.avg_doc_length()
         if not len(self.doc_lengths) or len(self.doc_lengths) == 0:
             return 0.0
         total = sum(self.doc_lengths.values())
         avg_doc_len = total / len(self.doc_lengths)
         return avg_doc_len
 
-    def bm25(self, doc_id, term):
+    def bm25(self, doc_id, term, k1=BM25_K1, b=BM25_B):
         bm25_idf = self.get_bm25_idf(term)
-        bm25_tf = self.get_bm25_tf(doc_id, term)
+        bm25_tf = self.get_bm25_tf(doc_id, term, k1, b)
         return bm25_idf * bm25_tf
 
-    def bm25_search(self, query, limit = DEFAULT_SEARCH_LIMIT):
-        tokens = tokenize_text(query)
-        scores = {}
-        for doc_id in self.docmap:
-            score = 0.0
+    def _reset_scoring(self):
+        self._doc_ids = None
+        self._doc_id_array = None
+        self._doc_positions = None
+        self._doc_length_array = None
+        self._avg_doc_length = None
+        self._postings = {}
+        self._k1_len_norms = {}
+        self._k1_len_norm_lists = {}
+        self._score_bounds = {}
+        self.last_search_stats = None
+
+    def _prepare_scoring(self):
+        # The index is shared by concurrent searches (the search server,
+        # hybrid branches): the scoring arrays are built once under a lock
+        # and _doc_ids, which marks them ready, is published last. The
+        # caches below are filled with setdefault, so a value computed by
+        # two threads at once is stored once and never seen half-built.
+        if self._doc_ids is not None:
+            return
+        with self._scoring_lock:
+            if self._doc_ids is not None:
+                return
+            if self.compact is not None:
+                doc_ids = self.compact.doc_ids
+                doc_id_array, doc_positions = doc_ids, None
+                doc_length_array = self.compact.doc_lengths.astype(np.float64)
+                avg_doc_length = self.compact.avg_doc_length()
+            else:
+                doc_ids = list(self.docmap)
+                doc_id_array = np.array(doc_ids, dtype=np.int64)
+                doc_positions = {doc_id: i for i, doc_id in enumerate(doc_ids)}
+                doc_length_array = np.array([self.doc_lengths.get(doc_id, 0) for doc_id in doc_ids], dtype=np.float64)
+                avg_doc_length = self.__get_avg_doc_length()
+            if self.corpus_stats is not None:
+                avg_doc_length = self.corpus_stats.avg_doc_length
+            self._doc_id_array = doc_id_array
+            self._doc_positions = doc_positions
+            self._doc_length_array = doc_length_array
+            self._avg_doc_length = avg_doc_length
+            self._doc_ids = doc_ids
+
+    def _get_postings(self, token):
+        postings = self._postings.get(token)
+        if postings is not None:
+            return postings
+        if self.compact is not None:
+            postings = self.compact.postings(token)
+        else:
+            doc_ids = self.index.get(token, ())
+            positions = np.array(sorted(self._doc_positions[doc_id] for doc_id in doc_ids), dtype=np.int64)
+            tfs = np.array([self.term_frequencies[self._doc_ids[pos]][token] for pos in positions], dtype=np.float64)
+            postings = (positions, tfs)
+        return self._postings.setdefault(token, postings)
+
+    def _token_bm25_idf(self, token, doc_freqs = None):
+        if self.corpus_stats is None:
+            total_docs, term_in_docs = len(self.docmap), len(self._get_postings(token)[0])
+        else:
+            total_docs, term_in_docs = self.corpus_stats.documents, (self.corpus_stats.doc_freqs if doc_freqs is None else doc_freqs).get(token, 0)
+        if term_in_docs == 0:
+            return 0
+        return math.log((total_docs - term_in_docs + 0.5) / (term_in_docs + 0.5) + 1)
+
+    def _length_norms(self, k1, b):
+        k1_len_norms = self._k1_len_norms.get((k1, b))
+        if k1_len_norms is not None:
+            return k1_len_norms
+        if self._avg_doc_length > 0:
+            len_norm = 1 - b + b * (self._doc_length_array / self._avg_doc_length)
+        else:
+            len_norm = np.ones_like(self._doc_length_array)
+        return self._k1_len_norms.setdefault((k1, b), k1 * len_norm)
+
+    def _get_score_bounds(self, token, k1, b, doc_freqs = None):
+        idf = self._token_bm25_idf(token, doc_freqs)
+        key = (token, k1, b, idf)
+        bounds = self._score_bounds.get(key)
+        if bounds is not None:
+            return bounds
+        positions, tfs = self._get_postings(token)
+        scores = idf * ((tfs * (k1 + 1)) / (tfs + self._length_norms(k1, b)[positions]))
+        block_starts = np.arange(0, len(positions), BM25_BLOCK_SIZE)
+        block_ends = np.minimum(block_starts + BM25_BLOCK_SIZE, len(positions)) - 1
+        # Bounds are padded by a relative epsilon so that summing them in a
+        # different order than the exact scorer can never prune a winner.
+        block_max = np.maximum.reduceat(scores, block_starts) * (1 + 1e-9)
+        bounds = (float(block_max.max()), block_max.tolist(), positions[block_ends].tolist(), positions.tolist(), tfs.tolist())
+        return self._score_bounds.setdefault(key, bounds)
+
+    def bm25_scores(self, tokens, k1=BM25_K1, b=BM25_B, doc_freqs=None):
+        self._prepare_scoring()
+        scores = np.zeros(len(self._doc_ids), dtype=np.float64)
+        if not tokens:
+            return scores
+        k1_len_norms = self._length_norms(k1, b)
+        idfs = {token: self._token_bm25_idf(token, doc_freqs) for token in set(tokens)}
+        for token in tokens:
+            positions, tfs = self._get_postings(token)
+            if len(positions) == 0:
+                continue
+            bm25_tf = (tfs * (k1 + 1)) / (tfs + k1_len_norms[positions])
+            scores[positions] += idfs[token] * bm25_tf
+        return scores
+
+    def bm25_top_k(self, tokens, limit = DEFAULT_SEARCH_LIMIT, k1=BM25_K1, b=BM25_B, pruning=None):
+        top, scores, self.last_search_stats = self.bm25_top_k_stats(tokens, limit, k1, b, pruning)
+        return top, scores
+
+    def bm25_top_k_stats(self, tokens, limit = DEFAULT_SEARCH_LIMIT, k1=BM25_K1, b=BM25_B, pruning=None, doc_freqs=None):
+        # Returns the search stats with the results. last_search_stats is
+        # only meaningful to a single-threaded caller; threads sharing the
+        # index use the *_stats methods.
+        with span("bm25.score", pruning=pruning) as s:
+            top, scores, stats = self._bm25_top_k(tokens, limit, k1, b, pruning, doc_freqs)
+            s.count("documents_scored", stats["scored"])
+            return top, scores, stats
+
+    def _bm25_top_k(self, tokens, limit, k1, b, pruning, doc_freqs = None):
+        self._prepare_scoring()
+        if pruning is None:
+            scores = self.bm25_scores(tokens, k1, b, doc_freqs)
+            top = top_k_indices(scores, limit)
+            matched = int(np.count_nonzero(scores))
+            return top, scores[top], {"method": "exhaustive", "matched": matched, "scored": matched, "skipped": 0}
+        if pruning not in BM25_PRUNING_METHODS:
+            raise ValueError(f"Unknown pruning method: {pruning}")
+        top, top_scores, scored = self._wand_top_k(tokens, limit, k1, b, block_max=pruning == "bmw", doc_freqs=doc_freqs)
+        posting_lists = [self._get_postings(token)[0] for token in set(tokens)]
+        matched = len(np.unique(np.concatenate(posting_lists))) if posting_lists else 0
+        return top, top_scores, {"method": pruning, "matched": matched, "scored": scored, "skipped": matched - scored}
+
+    def bm25_scores_many(self, token_lists, k1=BM25_K1, b=BM25_B, doc_freqs=None):
+        # One row per query. Each distinct token's BM25 contribution is
+        # computed once and shared by every query containing it; rows are
+        # accumulated in the same token order as bm25_scores.
+        self._prepare_scoring()
+        scores = np.zeros((len(token_lists), len(self._doc_ids)), dtype=np.float64)
+        k1_len_norms = self._length_norms(k1, b)
+        contributions = {}
+        for token in dict.fromkeys(token for tokens in token_lists for token in tokens):
+            positions, tfs = self._get_postings(token)
+            if len(positions):
+                contributions[token] = (positions, self._token_bm25_idf(token, doc_freqs) * ((tfs * (k1 + 1)) / (tfs + k1_len_norms[positions])))
+        for row, tokens in enumerate(token_lists):
             for token in tokens:
-                score += self.bm25(doc_id, token)
-            scores[doc_id] = score
-        sorted_docs = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+                if token in contributions:
+                    positions, contribution = contributions[token]
+                    scores[row, positions] += contribution
+        return scores
+
+    def bm25_top_k_many(self, token_lists, limit = DEFAULT_SEARCH_LIMIT, k1=BM25_K1, b=BM25_B, pruning=None, doc_freqs=None):
+        if pruning is not None:
+            results = [self.bm25_top_k_stats(tokens, limit, k1, b, pruning, doc_freqs)[:2] for tokens in token_lists]
+            self.last_search_stats = {"method": pruning, "queries": len(token_lists)}
+            return results
+        results, matched = [], 0
+        with span("bm25.score_many", queries=len(token_lists)) as s:
+            for start in range(0, len(token_lists), SEARCH_BATCH_SIZE):
+                for scores in self.bm25_scores_many(token_lists[start:start + SEARCH_BATCH_SIZE], k1, b, doc_freqs):
+                    top = top_k_indices(scores, limit)
+                    matched += int(np.count_nonzero(scores))
+                    results.append((top, scores[top]))
+            s.count("documents_scored", matched)
+        self.last_search_stats = {"method": "exhaustive", "queries": len(token_lists), "matched": matched, "scored": matched, "skipped": 0}
+        return results
+
+    def _wand_top_k(self, tokens, limit, k1, b, block_max=False, doc_freqs=None):
+        k1_len_norms = self._k1_len_norm_lists.get((k1, b))
+        if k1_len_norms is None:
+            k1_len_norms = self._k1_len_norm_lists.setdefault((k1, b), self._length_norms(k1, b).tolist())
+        cursors = []
+        for order, token in enumerate(tokens):
+            if len(self._get_postings(token)[0]) == 0:
+                continue
+            max_score, block_maxes, block_lasts, positions, tfs = self._get_score_bounds(token, k1, b, doc_freqs)
+            cursors.append(_PostingCursor(order, positions, tfs, self._token_bm25_idf(token, doc_freqs), max_score, block_maxes, block_lasts))
+
+        heap, scored = [], 0
+        while limit > 0:
+            cursors = [cursor for cursor in cursors if not cursor.exhausted()]
+            if not cursors:
+                break
+            cursors.sort(key=lambda cursor: cursor.doc)
+            threshold = heap[0][0] if len(heap) >= limit else 0.0
+            upper_bound, pivot = 0.0, None
+            for i, cursor in enumerate(cursors):
+                upper_bound += cursor.max_score
+                if upper_bound > threshold:
+                    pivot = i
+                    break
+            if pivot is None:
+                break
+            pivot_doc = cursors[pivot].doc
+            while pivot + 1 < len(cursors) and cursors[pivot + 1].doc == pivot_doc:
+                pivot += 1
+
+            if block_max and sum(cursor.block_max(pivot_doc) for cursor in cursors[:pivot + 1]) <= threshold:
+                next_doc = min(cursor.block_last(pivot_doc) for cursor in cursors[:pivot + 1]) + 1
+                if pivot + 1 < len(cursors):
+                    next_doc = min(next_doc, cursors[pivot + 1].doc)
+                for cursor in cursors[:pivot + 1]:
+                    cursor.advance(next_doc)
+                continue
+
+            if cursors[0].doc == pivot_doc:
+                score = 0.0
+                for cursor in sorted(cursors[:pivot + 1], key=lambda cursor: cursor.order):
+                    score += cursor.score(k1, k1_len_norms)
+                scored += 1
+                if len(heap) < limit:
+                    heapq.heappush(heap, (score, -pivot_doc))
+                elif score > heap[0][0]:
+                    heapq.heapreplace(heap, (score, -pivot_doc))
+                for cursor in cursors[:pivot + 1]:
+                    cursor.advance(pivot_doc + 1)
+            else:
+                for cursor in cursors[:pivot]:
+                    cursor.advance(pivot_doc)
+
+        ranked = sorted(((score, -neg_pos) for score, neg_pos in heap), key=lambda item: (-item[0], item[1]))
+        top = [pos for _, pos in ranked]
+        top_scores = [score for score, _ in ranked]
+        if len(top) < limit:
+            seen = set(top)
+            for pos in range(len(self._doc_ids)):
+                if len(top) >= limit:
+                    break
+                if pos not in seen:
+                    top.append(pos)
+                    top_scores.append(0.0)
+        return np.array(top, dtype=np.int64), np.array(top_scores, dtype=np.float64), scored
+
+    def tokenize(self, query):
+        with span("bm25.tokenize"):
+            return self.tokenizer.tokenize(query)
+
+    def tokenize_many(self, queries):
+        with span("bm25.tokenize", queries=len(queries)):
+            return self.tokenizer.tokenize_many(queries)
+
+    def bm25_candidates(self, query, depth = DEFAULT_SEARCH_LIMIT, k1=BM25_K1, b=BM25_B, pruning=None):
+        top, scores, _ = self.bm25_top_k_stats(self.tokenize(query), depth, k1, b, pruning)
+        return self._doc_id_array[top], scores
+
+    def bm25_candidates_many(self, queries, depth = DEFAULT_SEARCH_LIMIT, k1=BM25_K1, b=BM25_B, pruning=None):
+        results = self.bm25_top_k_many(self.tokenize_many(queries), depth, k1, b, pruning)
+        return [(self._doc_id_array[top], scores) for top, scores in results]
+
+    def bm25_search(self, query, limit = DEFAULT_SEARCH_LIMIT, k1=BM25_K1, b=BM25_B, pruning=None):
+        results, self.last_search_stats = self.bm25_search_stats(query, limit, k1, b, pruning)
+        return results
+
+    def bm25_search_stats(self, query, limit = DEFAULT_SEARCH_LIMIT, k1=BM25_K1, b=BM25_B, pruning=None):
+        tokens = self.tokenize(query)
+        top, scores, stats = self.bm25_top_k_stats(tokens, limit, k1, b, pruning)
+        return self._format_results(top, scores), stats
+
+    def search_many(self, queries, limit = DEFAULT_SEARCH_LIMIT, k1=BM25_K1, b=BM25_B, pruning=None):
+        results = self.bm25_top_k_many(self.tokenize_many(queries), limit, k1, b, pruning)
+        return [self._format_results(top, scores) for top, scores in results]
+
+    def _format_results(self, top, scores):
         results = []
-        for doc_id, score in sorted_docs:
-            doc = self.docmap[doc_id]
+        for pos, score in zip(top, scores):
+            doc = self.docmap[self._doc_ids[pos]]
             formatted = {
                 "id": doc["id"],
                 "title": doc["title"],
                 "document": doc["description"],
-                "score": round(score, SCORE_PRECISION),
+                "score": round(float(score), SCORE_PRECISION),
             }
             results.append(formatted)
         return results
 
+class _PostingCursor:
+    def __init__(self, order, positions, tfs, idf, max_score, block_maxes, block_lasts):
+        self.order = order
+        self.positions = positions
+        self.tfs = tfs
+        self.idf = idf
+        self.max_score = max_score
+        self.block_maxes = block_maxes
+        self.block_lasts = block_lasts
+        self.ptr = 0
+        self.doc = self.positions[0]
+
+    def exhausted(self):
+        return self.ptr >= len(self.positions)
+
+    def advance(self, target):
+        if self.doc >= target:
+            return
+        self.ptr = bisect.bisect_left(self.positions, target, self.ptr)
+        self.doc = self.positions[self.ptr] if self.ptr < len(self.positions) else math.inf
+
+    def _block(self, doc):
+        return min(bisect.bisect_left(self.block_lasts, doc, self.ptr // BM25_BLOCK_SIZE), len(self.block_lasts) - 1)
+
+    def block_max(self, doc):
+        return self.block_maxes[self._block(doc)]
+
+    def block_last(self, doc):
+        return self.block_lasts[self._block(doc)]
+
+    def score(self, k1, k1_len_norms):
+        tf = self.tfs[self.ptr]
+        return self.idf * ((tf * (k1 + 1)) / (tf + k1_len_norms[self.doc]))
+
 def build_command():
     idx = InvertedIndex()
     idx.build()
     idx.save()
 
+def convert_command():
+    idx = InvertedIndex()
+    idx.load_pickles()
+    idx.save()
+    return idx.compact_path
+
 def search_command(query, limit = DEFAULT_SEARCH_LIMIT):
     idx = InvertedIndex()
     idx.load()
-    query_tokens = tokenize_text(query)
+    query_tokens = idx.tokenizer.tokenize(query)
     seen_ids, result = set(), []
 
     for q_token in query_tokens:
@@ -165,14 +547,7 @@ def preprocess_text(text):
     return text
 
 def tokenize_text(text):
-    stemmer = PorterStemmer() 
-    text = preprocess_text(text)
-    tokens = text.split()
-    valid_tokens = [token for token in tokens if token != ""]
-    stop_words = load_stop_words()
-    filtered_tokens = [token for token in valid_tokens if token not in stop_words]
-    stemmed_tokens = [stemmer.stem(token) for token in filtered_tokens]
-    return stemmed_tokens
+    return get_tokenizer().tokenize(text)
 
 def tf_command(doc_id, term):
     idx = InvertedIndex()
@@ -199,7 +574,7 @@ def tfidf_command(doc_id, term):
     idx.load()
     return idx.get_tf_idf(doc_id, term)
 
-def bm25search_command(query, limit = DEFAULT_SEARCH_LIMIT):
+def bm25search_command(query, limit = DEFAULT_SEARCH_LIMIT, k1 = BM25_K1, b = BM25_B, pruning = None):
     idx = InvertedIndex()
     idx.load()
-    return idx.bm25_search(query, limit)
\ No newline at end of file
+    return idx.bm25_search_stats(query, limit, k1, b, pruning)
\ No newline at end of file
@@ -0,0 +1,209 @@
+import os, json, time, sqlite3, hashlib, threading
+from types import SimpleNamespace
+
+from .tracing import count
+from .search_utils import CACHE_DIR, LLM_CACHE_TTL, LLM_CACHE_SIZE, SQLITE_BATCH_SIZE
+
+LLM_CACHE_MODES = ("readwrite", "replay", "off")
+
+class LLMCacheMiss(LookupError):
+    pass
+
+def _canonical(value):
+    # Prompts mix plain strings with SDK objects (image parts, generation
+    # configs); everything is reduced to JSON so equal requests hash equally.
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, bytes):
+        return {"sha256": hashlib.sha256(value).hexdigest()}
+    if isinstance(value, dict):
+        return {str(k): _canonical(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    if hasattr(value, "model_dump"):
+        return _canonical(value.model_dump(exclude_none=True))
+    return repr(value)
+
+def request_key(model, contents, config = None):
+    payload = json.dumps({"model": model, "contents": _canonical(contents), "config": _canonical(config)}, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def _usage(response):
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return None
+    return {
+        "prompt_token_count": usage.prompt_token_count,
+        "candidates_token_count": usage.candidates_token_count,
+        "total_token_count": usage.total_token_count,
+    }
+
+def _response(text, usage):
+    usage = json.loads(usage) if usage else None
+    return SimpleNamespace(text=text, usage_metadata=SimpleNamespace(**usage) if usage else None, cached=True)
+
+class LLMResponseCache:
+    # Content-addressed: the key is a hash of the model, the full prompt and
+    # the generation config, so any change to a prompt template is a miss.
+    # "replay" never calls the model and raises LLMCacheMiss instead, which
+    # keeps offline benchmark runs deterministic.
+    def __init__(self, path = os.path.join(CACHE_DIR, "llm_responses.sqlite"), mode = "readwrite", ttl = LLM_CACHE_TTL, max_entries = LLM_CACHE_SIZE):
+        if mode not in LLM_CACHE_MODES:
+            raise ValueError(f"Unknown LLM cache mode '{mode}', expected one of {', '.join(LLM_CACHE_MODES)}")
+        self.path = path
+        self.mode = mode
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.counts = {"hits": 0, "misses": 0, "expired": 0, "writes": 0, "evictions": 0}
+        self.disk_available = True
+        self._db = None
+
+    # The database is best effort: every access catches sqlite3.Error and
+    # OSError. One that cannot be opened (e.g. an unwritable cache
+    # directory) leaves every request going to the model for the rest of
+    # the process; a locked one only costs that lookup or write.
+    def _connection(self):
+        if self._db is None:
+            db = None
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS llm_responses ("
+                    "key TEXT PRIMARY KEY, model TEXT NOT NULL, text TEXT NOT NULL, usage TEXT, "
+                    "created REAL NOT NULL, last_used REAL NOT NULL)"
+                )
+                db.execute("CREATE INDEX IF NOT EXISTS llm_responses_last_used ON llm_responses (last_used)")
+                db.commit()
+            except (sqlite3.Error, OSError):
+                self.disk_available = False
+                if db is not None:
+                    db.close()
+                raise
+            self._db = db
+        return self._db
+
+    def _enabled(self):
+        return self.mode != "off" and self.disk_available
+
+    def get_many(self, keys):
+        # Returns {key: response} for the cached keys; in replay mode a
+        # missing key is an error rather than a miss.
+        if self.mode == "off" or not keys:
+            return {}
+        found, expired = {}, []
+        with self.lock:
+            if self.disk_available:
+                try:
+                    db = self._connection()
+                    unique = list(dict.fromkeys(keys))
+                    rows = []
+                    for start in range(0, len(unique), SQLITE_BATCH_SIZE):
+                        batch = unique[start:start + SQLITE_BATCH_SIZE]
+                        rows += db.execute(
+                            f"SELECT key, text, usage, created FROM llm_responses WHERE key IN ({', '.join('?' * len(batch))})",
+                            batch,
+                        ).fetchall()
+                    now = time.time()
+                    for key, text, usage, created in rows:
+                        # Replay runs ignore the TTL so a recorded run stays replayable.
+                        if self.ttl and now - created > self.ttl and self.mode != "replay":
+                            expired.append(key)
+                        else:
+                            found[key] = _response(text, usage)
+                    if found:
+                        db.executemany("UPDATE llm_responses SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+                    if expired:
+                        db.executemany("DELETE FROM llm_responses WHERE key = ?", [(key,) for key in expired])
+                    if found or expired:
+                        db.commit()
+                except (sqlite3.Error, OSError):
+                    found, expired = {}, []
+            hits = sum(key in found for key in keys)
+            self.counts["hits"] += hits
+            self.counts["misses"] += len(keys) - hits
+            self.counts["expired"] += len(expired)
+        count("llm_cache_hits", hits)
+        count("llm_cache_misses", len(keys) - hits)
+        if self.mode == "replay" and hits < len(keys):
+            raise LLMCacheMiss(f"{len(keys) - hits} LLM request(s) not in the replay cache {self.path}")
+        return found
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def put_many(self, model, items):
+        # Failed requests have no text and are never stored.
+        items = [(key, response) for key, response in items if getattr(response, "text", None) is not None]
+        if self.mode != "readwrite" or not self.disk_available or not items:
+            return
+        with self.lock:
+            try:
+                self._insert(model, items)
+            except (sqlite3.Error, OSError):
+                pass
+
+    def put(self, key, model, response):
+        self.put_many(model, [(key, response)])
+
+    def _insert(self, model, items):
+        db = self._connection()
+        now = time.time()
+        db.executemany(
+            "INSERT OR REPLACE INTO llm_responses (key, model, text, usage, created, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+            [(key, model, response.text, json.dumps(_usage(response)) if _usage(response) else None, now, now) for key, response in items],
+        )
+        self.counts["writes"] += len(items)
+        entries = db.execute("SELECT COUNT(*) FROM llm_responses").fetchone()[0]
+        if entries > self.max_entries:
+            if self.ttl:
+                entries -= db.execute("DELETE FROM llm_responses WHERE created < ?", (now - self.ttl,)).rowcount
+            if entries > self.max_entries:
+                keep = max(1, int(self.max_entries * 0.9))
+                self.counts["evictions"] += db.execute(
+                    "DELETE FROM llm_responses WHERE rowid IN (SELECT rowid FROM llm_responses ORDER BY last_used LIMIT ?)",
+                    (entries - keep,),
+                ).rowcount
+        db.commit()
+
+    def clear(self):
+        with self.lock:
+            if not self._enabled():
+                return
+            try:
+                db = self._connection()
+                db.execute("DELETE FROM llm_responses")
+                db.commit()
+            except (sqlite3.Error, OSError):
+                pass
+
+    def _entries(self):
+        if not self._enabled():
+            return 0
+        try:
+            return self._connection().execute("SELECT COUNT(*) FROM llm_responses").fetchone()[0]
+        except (sqlite3.Error, OSError):
+            return 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.counts["hits"] + self.counts["misses"]
+            entries = self._entries()
+            return {
+                **self.counts,
+                "mode": self.mode,
+                "disk_available": self.disk_available,
+                "lookups": lookups,
+                "hit_rate": self.counts["hits"] / lookups if lookups else 0.0,
+                "entries": entries,
+            }
+
+def format_llm_cache_stats(stats):
+    return (
+        f"LLM response cache ({stats['mode']}): {stats['hit_rate']:.1%} hit rate over {stats['lookups']} lookups "
+        f"({stats['hits']} hits, {stats['misses']} misses, {stats['expired']} expired); "
+        f"{stats['entries']} entries, {stats['writes']} written, {stats['evictions']} evicted"
+        + ("" if stats["disk_available"] else " (database unavailable, nothing cached)")
+    )
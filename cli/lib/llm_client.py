@@ -0,0 +1,143 @@
+import os, re
+from types import SimpleNamespace
+from functools import lru_cache
+from .tracing import span
+from .llm_cache import LLMResponseCache, request_key
+from .search_utils import CACHE_DIR, LLM_RATE_LIMITS, LLM_DEFAULT_RATE_LIMIT
+
+DEFAULT_API_KEY_ENV = "gemini_api_key"
+STUB_ENV = "LLM_STUB"
+CACHE_MODE_ENV = "LLM_CACHE"
+
+@lru_cache
+def get_client(api_key_env = DEFAULT_API_KEY_ENV):
+    # The Gemini SDK is slow to import, so it is only loaded (and the client
+    # only built) the first time a code path actually calls the model.
+    from dotenv import load_dotenv
+    load_dotenv()
+    if os.getenv(STUB_ENV):
+        from .llm_scheduler import StubClient
+        return StubClient()
+    from google import genai
+    return genai.Client(api_key=os.getenv(api_key_env))
+
+@lru_cache
+def get_scheduler(api_key_env = DEFAULT_API_KEY_ENV, model = None):
+    # Quotas are per key and per model, so each pair gets its own buckets.
+    from .llm_scheduler import LLMScheduler
+    requests_per_minute, tokens_per_minute = LLM_RATE_LIMITS.get(model, LLM_DEFAULT_RATE_LIMIT)
+    call = lambda model, contents, config: get_client(api_key_env).models.generate_content(model=model, contents=contents, config=config)
+    return LLMScheduler(call, requests_per_minute, tokens_per_minute)
+
+@lru_cache(maxsize=1)
+def get_llm_cache():
+    # LLM_CACHE=replay answers only from the cache, LLM_CACHE=off bypasses it.
+    # Stub responses go to their own file so they never replay as real ones.
+    name = "llm_responses.stub.sqlite" if os.getenv(STUB_ENV) else "llm_responses.sqlite"
+    return LLMResponseCache(os.path.join(CACHE_DIR, name), os.getenv(CACHE_MODE_ENV) or "readwrite")
+
+def _count_usage(s, response):
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None and not getattr(response, "cached", False):
+        s.count("prompt_tokens", usage.prompt_token_count or 0)
+        s.count("output_tokens", usage.candidates_token_count or 0)
+
+def _parses(response, parse):
+    # With a parse callable only answers the caller can use are cached, so a
+    # malformed reply is asked again next time instead of being replayed.
+    if parse is None:
+        return True
+    try:
+        parse((response.text or "").strip().strip('"'))
+    except ValueError:
+        return False
+    return True
+
+def generate_content(model, contents, api_key_env = DEFAULT_API_KEY_ENV, deadline = None, config = None, parse = None):
+    with span("llm.generate", model=model) as s:
+        cache = get_llm_cache()
+        key = request_key(model, contents, config)
+        response = cache.get(key)
+        if response is None:
+            response = get_scheduler(api_key_env, model).generate(model, contents, deadline, config)
+            if _parses(response, parse):
+                cache.put(key, model, response)
+        _count_usage(s, response)
+        return response
+
+def generate_content_many(model, contents_list, api_key_env = DEFAULT_API_KEY_ENV, deadline = None, config = None, return_exceptions = False, parse = None):
+    # Cached prompts are answered locally; the rest are issued together
+    # (once per distinct prompt) and paced by the scheduler's quota. The
+    # answers that came back are cached even when others failed. With
+    # return_exceptions a failed prompt gets its exception in place of a
+    # response, like LLMScheduler.generate_many; otherwise the first
+    # failure is raised.
+    with span("llm.generate_many", model=model, requests=len(contents_list)) as s:
+        cache = get_llm_cache()
+        keys = [request_key(model, contents, config) for contents in contents_list]
+        found = cache.get_many(keys)
+        missing = {key: contents for key, contents in zip(keys, contents_list) if key not in found}
+        if missing:
+            responses = get_scheduler(api_key_env, model).generate_many(model, list(missing.values()), deadline, config, return_exceptions=True)
+            fetched = dict(zip(missing, responses))
+            cache.put_many(model, [(key, response) for key, response in fetched.items() if not isinstance(response, Exception) and _parses(response, parse)])
+            found.update(fetched)
+        responses = [found[key] for key in keys]
+        for response in responses:
+            if not isinstance(response, Exception):
+                _count_usage(s, response)
+        if not return_exceptions:
+            for response in responses:
+                if isinstance(response, Exception):
+                    raise response
+        return responses
+
+def _normalized(chunks):
+    # Applies the blocking callers' .strip().strip('"') to a stream: the
+    # leading whitespace and quotes are dropped, and trailing ones are held
+    # back until more text follows them.
+    pending, started = "", False
+    for chunk in chunks:
+        pending += chunk
+        if not started:
+            if not re.search(r'[^\s"]', pending):
+                continue
+            pending, started = pending.lstrip().lstrip('"'), True
+        end = re.search(r'[\s"]*\Z', pending).start()
+        if end:
+            yield pending[:end]
+        pending = pending[end:]
+    pending = pending.rstrip().rstrip('"') if started else pending.strip().strip('"')
+    if pending:
+        yield pending
+
+def generate_content_stream(model, contents, api_key_env = DEFAULT_API_KEY_ENV, deadline = None, config = None):
+    # Yields the answer's text chunks as they arrive, stripped like the
+    # blocking callers strip the whole text. The joined text is cached once
+    # the stream completes; a cached answer comes back as one chunk.
+    # Opening the stream is retried within the deadline.
+    with span("llm.generate_stream", model=model) as s:
+        cache = get_llm_cache()
+        key = request_key(model, contents, config)
+        response = cache.get(key)
+        if response is not None:
+            yield from _normalized([response.text])
+            return
+        scheduler = get_scheduler(api_key_env, model)
+        open_stream = lambda: get_client(api_key_env).models.generate_content_stream(model=model, contents=contents, config=config)
+        estimated, stream = scheduler.open_stream(open_stream, contents, deadline)
+        usage = None
+        def texts():
+            nonlocal usage
+            for chunk in stream:
+                usage = getattr(chunk, "usage_metadata", None) or usage
+                if chunk.text:
+                    yield chunk.text
+        chunks = []
+        for text in _normalized(texts()):
+            chunks.append(text)
+            yield text
+        response = SimpleNamespace(text="".join(chunks), usage_metadata=usage)
+        scheduler.settle(estimated, usage)
+        _count_usage(s, response)
+        cache.put(key, model, response)
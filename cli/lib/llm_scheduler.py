@@ -0,0 +1,271 @@
+import re, time, random, asyncio, hashlib, functools, itertools, threading
+from types import SimpleNamespace
+
+from .search_utils import LLM_MAX_CONCURRENCY, LLM_MAX_RETRIES, LLM_REQUEST_DEADLINE, LLM_RETRY_BASE_DELAY, LLM_RETRY_MAX_DELAY, LLM_IMAGE_TOKENS
+
+RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+def estimate_tokens(contents):
+    # Rough prompt size used to reserve TPM quota before the call; the
+    # reservation is corrected with the real usage once the response arrives.
+    parts = contents if isinstance(contents, list) else [contents]
+    return sum(len(part) // 4 + 1 if isinstance(part, str) else LLM_IMAGE_TOKENS for part in parts)
+
+def is_retryable(error):
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    code = getattr(error, "code", None) or getattr(error, "status_code", None)
+    return code in RETRYABLE_STATUS_CODES
+
+class TokenBucket:
+    def __init__(self, per_minute, capacity = None):
+        self.rate = per_minute / 60
+        self.capacity = capacity or per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount):
+        self._refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+    def adjust(self, amount):
+        # Positive amounts charge extra usage, negative ones refund an
+        # over-estimate; the balance may go negative and delays later calls.
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+class LLMScheduler:
+    # Every request runs on one private event loop thread, so the buckets
+    # and the semaphore need no locks and sync callers on any thread (CLI,
+    # search server handlers) share the same quota.
+    def __init__(self, call, requests_per_minute, tokens_per_minute, max_concurrency = LLM_MAX_CONCURRENCY, max_retries = LLM_MAX_RETRIES, deadline = LLM_REQUEST_DEADLINE, base_delay = LLM_RETRY_BASE_DELAY, max_delay = LLM_RETRY_MAX_DELAY):
+        self.call = call
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.deadline = deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.counts = {"requests": 0, "retries": 0, "failures": 0, "throttled_seconds": 0.0, "backoff_seconds": 0.0}
+        self._loop = None
+        self._semaphore = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_loop(self):
+        if self._loop is None:
+            with self._start_lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(target=loop.run_forever, name="llm-scheduler", daemon=True).start()
+                    self._semaphore = asyncio.Semaphore(self.max_concurrency)
+                    self._loop = loop
+        return self._loop
+
+    async def _acquire(self, estimated_tokens, deadline = None):
+        while True:
+            wait = max(self.requests.delay(1), self.tokens.delay(estimated_tokens))
+            if wait == 0:
+                self.requests.take(1)
+                self.tokens.take(estimated_tokens)
+                return
+            if deadline is not None and time.monotonic() + wait > deadline:
+                raise TimeoutError(f"LLM request would exceed its deadline waiting {wait:.1f}s for rate limit quota")
+            self.counts["throttled_seconds"] += wait
+            await asyncio.sleep(wait)
+
+    async def _request(self, model, contents, deadline, config):
+        # The deadline bounds a request's calls and retries and starts once
+        # it first holds quota and a concurrency slot, so time queued behind
+        # the rest of a large batch is not counted against it.
+        budget = self.deadline if deadline is None else deadline
+        estimated = estimate_tokens(contents)
+        deadline, attempt = None, 0
+        while True:
+            try:
+                await self._acquire(estimated, deadline)
+                await self._semaphore.acquire()
+                if deadline is None:
+                    deadline = time.monotonic() + budget
+                response = await self._call(model, contents, config, deadline - time.monotonic())
+            except Exception as e:
+                backoff = self._backoff(e, attempt, deadline)
+                if backoff is None:
+                    self._count(failures=1)
+                    raise e
+                attempt += 1
+                self._count(retries=1, backoff_seconds=backoff)
+                await asyncio.sleep(backoff)
+                continue
+            self._settle(estimated, getattr(response, "usage_metadata", None))
+            return response
+
+    def _backoff(self, error, attempt, deadline):
+        # The delay before retrying a failed attempt, or None when it should
+        # not be retried.
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if attempt >= self.max_retries or not is_retryable(error) or deadline is None or time.monotonic() + backoff >= deadline:
+            return None
+        return backoff
+
+    def _count(self, **amounts):
+        for name, amount in amounts.items():
+            self.counts[name] += amount
+
+    async def _call(self, model, contents, config, remaining):
+        # Runs holding a concurrency slot, which is released when the worker
+        # thread returns. A call abandoned at its deadline keeps the slot
+        # until then: the thread cannot be stopped, and a retry started
+        # beside it would put more than max_concurrency calls in flight.
+        if remaining <= 0:
+            self._semaphore.release()
+            raise TimeoutError("LLM request exceeded its deadline")
+        self.counts["requests"] += 1
+        call = asyncio.ensure_future(asyncio.to_thread(self.call, model, contents, config))
+        call.add_done_callback(self._release)
+        done, _ = await asyncio.wait({call}, timeout=remaining)
+        if not done:
+            raise TimeoutError("LLM request exceeded its deadline")
+        return call.result()
+
+    def _release(self, call):
+        self._semaphore.release()
+        if not call.cancelled():
+            # Retrieved so an abandoned call's error is not logged as unhandled.
+            call.exception()
+
+    def _settle(self, estimated, usage):
+        if usage is not None and usage.total_token_count:
+            self.tokens.adjust(usage.total_token_count - estimated)
+
+    def submit(self, model, contents, deadline = None, config = None):
+        return asyncio.run_coroutine_threadsafe(self._request(model, contents, deadline, config), self._ensure_loop())
+
+    def generate(self, model, contents, deadline = None, config = None):
+        return self.submit(model, contents, deadline, config).result()
+
+    def generate_many(self, model, contents_list, deadline = None, config = None, return_exceptions = False):
+        # Waits for every request. With return_exceptions a failed request
+        # is returned as its exception in place of a response; otherwise the
+        # first failure is raised once the others have finished.
+        futures = [self.submit(model, contents, deadline, config) for contents in contents_list]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        if not return_exceptions:
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        return results
+
+    def open_stream(self, open_stream, contents, deadline = None):
+        # Streaming calls run on the caller's thread and are not counted
+        # against max_concurrency. Each attempt waits for quota; opening the
+        # stream, up to its first chunk, is retried like a blocking request
+        # within the deadline, while an error after that reaches the caller.
+        # Counters are only touched on the loop thread. Returns the estimate
+        # to pass to settle() and the chunks.
+        estimated = estimate_tokens(contents)
+        budget = self.deadline if deadline is None else deadline
+        loop = self._ensure_loop()
+        deadline, attempt = None, 0
+        while True:
+            asyncio.run_coroutine_threadsafe(self._acquire(estimated, deadline), loop).result()
+            if deadline is None:
+                deadline = time.monotonic() + budget
+            loop.call_soon_threadsafe(functools.partial(self._count, requests=1))
+            try:
+                chunks = iter(open_stream())
+                first = next(chunks, None)
+            except Exception as e:
+                backoff = self._backoff(e, attempt, deadline)
+                if backoff is None:
+                    loop.call_soon_threadsafe(functools.partial(self._count, failures=1))
+                    raise
+                attempt += 1
+                loop.call_soon_threadsafe(functools.partial(self._count, retries=1, backoff_seconds=backoff))
+                time.sleep(backoff)
+                continue
+            return estimated, itertools.chain([] if first is None else [first], chunks)
+
+    def settle(self, estimated, usage):
+        self._ensure_loop().call_soon_threadsafe(self._settle, estimated, usage)
+
+    async def agenerate(self, model, contents, deadline = None, config = None):
+        return await asyncio.wrap_future(self.submit(model, contents, deadline, config))
+
+    async def _snapshot(self):
+        return dict(self.counts)
+
+    def stats(self):
+        # Read on the loop thread, after any counter updates already queued.
+        if self._loop is None:
+            return dict(self.counts)
+        return asyncio.run_coroutine_threadsafe(self._snapshot(), self._loop).result()
+
+class StubAPIError(Exception):
+    def __init__(self, code, message):
+        super().__init__(f"{code} {message}")
+        self.code = code
+
+class StubClient:
+    # Offline stand-in for genai.Client: same generate_content call shape,
+    # configurable latency and transient failures, no network.
+    def __init__(self, latency = 0.05, failure_rate = 0.0, responder = None, seed = 0, chunk_latency = 0.02):
+        self.latency = latency
+        self.chunk_latency = chunk_latency
+        self.failure_rate = failure_rate
+        self.responder = responder or stub_response
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.models = SimpleNamespace(generate_content=self.generate_content, generate_content_stream=self.generate_content_stream)
+
+    def generate_content(self, model, contents, config = None):
+        with self.lock:
+            self.calls += 1
+            fail = self.random.random() < self.failure_rate
+        time.sleep(self.latency)
+        if fail:
+            raise StubAPIError(429, "RESOURCE_EXHAUSTED (stub)")
+        text = self.responder(model, contents)
+        return SimpleNamespace(text=text, usage_metadata=self._usage(contents, text))
+
+    def generate_content_stream(self, model, contents, config = None):
+        # latency is the time to the first chunk; the answer then arrives a
+        # word at a time, with usage on the last chunk like the real API.
+        response = self.generate_content(model, contents, config)
+        words = response.text.split(" ")
+        for i, word in enumerate(words):
+            if i:
+                time.sleep(self.chunk_latency)
+            last = i == len(words) - 1
+            yield SimpleNamespace(text=word if i == 0 else " " + word, usage_metadata=response.usage_metadata if last else None)
+
+    def _usage(self, contents, text):
+        prompt_tokens = estimate_tokens(contents)
+        output_tokens = len(text) // 4 + 1
+        return SimpleNamespace(prompt_token_count=prompt_tokens, candidates_token_count=output_tokens, total_token_count=prompt_tokens + output_tokens)
+
+def stub_response(model, contents):
+    # A deterministic 0-10 score for the rerank prompts, which parse one;
+    # anything else gets an answer echoing the prompt's documents.
+    prompt = contents if isinstance(contents, str) else " ".join(part for part in contents if isinstance(part, str))
+    digest = int(hashlib.md5(prompt.encode("utf-8")).hexdigest(), 16)
+    if prompt.rstrip().endswith("Score:"):
+        return str(digest % 11)
+    titles = re.findall(r"Title: (.*?)\s+(?:Description|Passages)", prompt)
+    return f"Stub answer {digest % 1000:03d} drawing on {len(titles)} documents: " + "; ".join(titles or [" ".join(prompt.split()[:20])])
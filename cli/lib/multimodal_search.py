@@ -1,50 +1,74 @@
-import numpy as np
 import os
-from PIL import Image
-from sentence_transformers import SentenceTransformer
-from .search_utils import cosine_similarity, load_movies, CACHE_DIR
+from functools import lru_cache
+from .search_utils import load_movies, CACHE_DIR
+from .quantization import open_dense_index
+from .embedding_store import EmbeddingStore, source_hash
+from .query_cache import get_query_cache
+
+@lru_cache
+def get_clip_model(model_name):
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name, model_kwargs={"use_fast": True})
 
 class MultimodalSearch():
-    def __init__(self, documents, model_name="clip-ViT-B-32"):
-        self.model = SentenceTransformer(model_name, model_kwargs={"use_fast": True})
+    def __init__(self, documents, model_name="clip-ViT-B-32", encoding="float32", rerank=True):
+        self.model_name = model_name
+        self.query_cache = get_query_cache()
+        self.encoding = encoding
+        self.rerank = rerank
         self.documents = documents
         self.texts = [f"{doc['title']}: {doc['description']}" for doc in self.documents]
         self.text_embeddings = []
+        self.dense_index = None
         self.embeddings_path = os.path.join(CACHE_DIR, "movie_embeddings2.npy")
+        self.embedding_store = EmbeddingStore(self.embeddings_path, model_name)
+
+    @property
+    def model(self):
+        return get_clip_model(self.model_name)
 
     def embed_image(self, img_path):    
+        from PIL import Image
         image = Image.open(img_path)
         image_embedding = self.model.encode([image])
         return image_embedding[0]
 
+    def embed_text(self, text):
+        if not text.strip():
+            raise ValueError("The text cannot be empty.")
+        return self.query_cache.get(self.model_name, text, lambda query: self.model.encode([query])[0])
+
+    def encode_texts(self, texts):
+        return self.model.encode(texts, show_progress_bar = True)
+
     def build_embeddings(self):
-        self.text_embeddings = self.model.encode(self.texts, show_progress_bar = True)
-        os.makedirs(CACHE_DIR, exist_ok=True)
-        np.save(self.embeddings_path, self.text_embeddings)
+        return self.load_or_create_embeddings(reuse=False)
+
+    def load_or_create_embeddings(self, reuse = True):
+        source = source_hash(self.texts)
+        self.text_embeddings = self.embedding_store.open(source) if reuse else None
+        if self.text_embeddings is None:
+            self.text_embeddings = self.embedding_store.refresh(self.texts, self.encode_texts, "r", reuse, source)
+        self.dense_index = None
         return self.text_embeddings
 
-    def load_or_create_embeddings(self):
-        if os.path.exists(self.embeddings_path):
-            self.text_embeddings = np.load(self.embeddings_path)
-            if len(self.text_embeddings) == len(self.documents):
-                return self.text_embeddings
-         
-        return self.build_embeddings()
-
-    def search_with_image(self, img_path):
-        image_embedding = self.embed_image(img_path)
-        cosine_similarities = []
-        for i, text_embedding in enumerate(self.text_embeddings):
-            similarity_score = cosine_similarity(text_embedding, image_embedding)
-            cosine_similarities.append((similarity_score, self.documents[i]))
-        sorted_cosine_similarities = sorted(cosine_similarities, key=lambda x: x[0], reverse=True)
+    def search_with_image(self, img_path, limit = 5):
+        return self._search(self.embed_image(img_path), limit)
+
+    def search_with_text(self, query, limit = 5):
+        return self._search(self.embed_text(query), limit)
+
+    def _search(self, query_embedding, limit):
+        if self.dense_index is None:
+            self.dense_index = open_dense_index(self.text_embeddings, self.embeddings_path, self.encoding, self.rerank, normalized=True, fingerprint=self.embedding_store.fingerprint())
+        top, scores = self.dense_index.search(query_embedding, limit)
         results = []
-        for _, result in enumerate(sorted_cosine_similarities[:5]):
+        for i, score in zip(top, scores):
             results.append({
-                "similarity_score": result[0],
-                "id": result[1]["id"],
-                "title": result[1]["title"],
-                "description": result[1]["description"],
+                "similarity_score": float(score),
+                "id": self.documents[i]["id"],
+                "title": self.documents[i]["title"],
+                "description": self.documents[i]["description"],
             })
         return results
 
@@ -53,9 +77,15 @@ def verify_image_embedding_command(img_path):
     embedded_img = multimodal_search.embed_image(img_path)
     print(f"Embedding shape: {embedded_img.shape[0]} dimensions")
 
-def image_search_command(img_path):
+def image_search_command(img_path, encoding = "float32"):
     movies = load_movies()
-    multimodal_search = MultimodalSearch(movies)
+    multimodal_search = MultimodalSearch(movies, encoding=encoding)
     multimodal_search.load_or_create_embeddings()
     return multimodal_search.search_with_image(img_path)
+
+def text_search_command(query, limit = 5, encoding = "float32"):
+    movies = load_movies()
+    multimodal_search = MultimodalSearch(movies, encoding=encoding)
+    multimodal_search.load_or_create_embeddings()
+    return multimodal_search.search_with_text(query, limit)
     
\ No newline at end of file
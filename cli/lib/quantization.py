@@ -0,0 +1,223 @@
+import os
+import numpy as np
+
+from .dense_retrieval import DenseIndex, normalize_rows
+from .search_utils import top_k_indices, QUANTIZED_RERANK_FACTOR, PQ_SUBSPACES
+
+SCORE_BLOCK_SIZE = 65536
+PQ_CENTROIDS = 256
+PQ_KMEANS_ITERATIONS = 15
+
+class Float16Codec:
+    name = "float16"
+
+    def fit(self, vectors):
+        return self
+
+    def encode(self, vectors):
+        return vectors.astype(np.float16)
+
+    def decode(self, codes):
+        return codes.astype(np.float32)
+
+    def scores(self, codes, query):
+        return _blockwise(codes, lambda block: block.astype(np.float32) @ query)
+
+    def state(self):
+        return {}
+
+    @classmethod
+    def from_state(cls, state):
+        return cls()
+
+class Int8Codec:
+    name = "int8"
+
+    def __init__(self, scales = None):
+        self.scales = scales
+
+    def fit(self, vectors):
+        scales = np.zeros(vectors.shape[1], dtype=np.float32)
+        for block in _unit_blocks(vectors):
+            np.maximum(scales, np.abs(block).max(axis=0), out=scales)
+        scales /= 127
+        scales[scales == 0] = 1.0
+        self.scales = scales
+        return self
+
+    def encode(self, vectors):
+        return np.clip(np.rint(vectors / self.scales), -127, 127).astype(np.int8)
+
+    def decode(self, codes):
+        return codes.astype(np.float32) * self.scales
+
+    def scores(self, codes, query):
+        scaled_query = query * self.scales
+        return _blockwise(codes, lambda block: block.astype(np.float32) @ scaled_query)
+
+    def state(self):
+        return {"scales": self.scales}
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(state["scales"])
+
+class PQCodec:
+    name = "pq"
+
+    def __init__(self, centroids = None, subspaces = PQ_SUBSPACES):
+        self.centroids = centroids
+        self.subspaces = subspaces if centroids is None else len(centroids)
+
+    def fit(self, vectors, sample_size = 65536, seed = 0):
+        dim = vectors.shape[1]
+        if dim % self.subspaces:
+            raise ValueError(f"Embedding dimension {dim} is not divisible into {self.subspaces} PQ subspaces")
+        rng = np.random.default_rng(seed)
+        sample = normalize_rows(vectors[rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False)])
+        n_centroids = min(PQ_CENTROIDS, len(sample))
+        self.centroids = np.stack([
+            _kmeans(part, n_centroids, rng) for part in np.split(sample, self.subspaces, axis=1)
+        ])
+        return self
+
+    def encode(self, vectors):
+        codes = np.empty((len(vectors), self.subspaces), dtype=np.uint8)
+        for j, part in enumerate(np.split(vectors, self.subspaces, axis=1)):
+            codes[:, j] = _nearest(part, self.centroids[j])
+        return codes
+
+    def decode(self, codes):
+        return np.concatenate([self.centroids[j][codes[:, j]] for j in range(self.subspaces)], axis=1)
+
+    def scores(self, codes, query):
+        # Asymmetric distance computation: one lookup table per subspace,
+        # then a gather-and-sum over the codes.
+        tables = np.einsum("mkd,md->mk", self.centroids, query.reshape(self.subspaces, -1))
+        subspace_ids = np.arange(self.subspaces)
+        return _blockwise(codes, lambda block: tables[subspace_ids, block].sum(axis=1))
+
+    def state(self):
+        return {"centroids": self.centroids}
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(state["centroids"])
+
+CODECS = {codec.name: codec for codec in (Float16Codec, Int8Codec, PQCodec)}
+
+def _unit_blocks(vectors):
+    for start in range(0, len(vectors), SCORE_BLOCK_SIZE):
+        yield normalize_rows(vectors[start:start + SCORE_BLOCK_SIZE])
+
+def _blockwise(codes, score_block):
+    scores = np.empty(len(codes), dtype=np.float32)
+    for start in range(0, len(codes), SCORE_BLOCK_SIZE):
+        scores[start:start + SCORE_BLOCK_SIZE] = score_block(codes[start:start + SCORE_BLOCK_SIZE])
+    return scores
+
+def _nearest(vectors, centroids):
+    distances = (centroids ** 2).sum(axis=1) - 2 * vectors @ centroids.T
+    return np.argmin(distances, axis=1)
+
+def _kmeans(vectors, n_centroids, rng, iterations = PQ_KMEANS_ITERATIONS):
+    centroids = vectors[rng.choice(len(vectors), n_centroids, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = _nearest(vectors, centroids)
+        counts = np.bincount(assignments, minlength=n_centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+    return centroids
+
+def quantized_path(embeddings_path, encoding):
+    root, _ = os.path.splitext(embeddings_path)
+    return f"{root}.{encoding}.npz"
+
+class QuantizedIndex:
+    def __init__(self, codec, codes, full_embeddings = None, rerank_factor = QUANTIZED_RERANK_FACTOR, fingerprint = None):
+        self.codec = codec
+        self.codes = codes
+        self.full_embeddings = full_embeddings
+        self.rerank_factor = rerank_factor
+        self.fingerprint = fingerprint
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + sum(value.nbytes for value in self.codec.state().values())
+
+    @classmethod
+    def build(cls, embeddings, encoding, full_embeddings = None, rerank_factor = QUANTIZED_RERANK_FACTOR, fingerprint = None):
+        # Rows are normalized and encoded a block at a time (codecs fit on
+        # a sample or a running maximum), so a memory-mapped matrix is never
+        # copied whole into float32.
+        codec = CODECS[encoding]().fit(embeddings)
+        blocks = [codec.encode(block) for block in _unit_blocks(embeddings)]
+        codes = np.concatenate(blocks) if blocks else codec.encode(np.empty((0, embeddings.shape[1]), dtype=np.float32))
+        return cls(codec, codes, full_embeddings, rerank_factor, fingerprint)
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            np.savez(f, encoding=self.codec.name, codes=self.codes, fingerprint=self.fingerprint or "", **self.codec.state())
+
+    @classmethod
+    def load(cls, path, full_embeddings = None, rerank_factor = QUANTIZED_RERANK_FACTOR):
+        with np.load(path) as data:
+            state = {key: data[key] for key in data.files if key not in ("encoding", "codes", "fingerprint")}
+            codec = CODECS[str(data["encoding"])].from_state(state)
+            fingerprint = str(data["fingerprint"]) if "fingerprint" in data.files else None
+            return cls(codec, data["codes"], full_embeddings, rerank_factor, fingerprint or None)
+
+    def scores(self, query_embedding, rows = None):
+        query = _unit(query_embedding)
+        codes = self.codes if rows is None else self.codes[rows]
+        return self.codec.scores(codes, query)
+
+    def scores_many(self, query_embeddings, rows = None):
+        # Codes are scored with per-query lookup tables or scales, so there is
+        # no shared product to batch; queries are scored one at a time.
+        return np.stack([self.scores(query_embedding, rows) for query_embedding in query_embeddings])
+
+    def exact_scores(self, query_embedding, rows):
+        vectors = normalize_rows(self.full_embeddings[rows])
+        return vectors @ _unit(query_embedding)
+
+    def search(self, query_embedding, limit):
+        scores = self.scores(query_embedding)
+        if self.full_embeddings is None or not self.rerank_factor:
+            top = top_k_indices(scores, limit)
+            return top, scores[top]
+        shortlist = np.sort(top_k_indices(scores, limit * self.rerank_factor))
+        exact = self.exact_scores(query_embedding, shortlist)
+        top = top_k_indices(exact, limit)
+        return shortlist[top], exact[top]
+
+    def search_many(self, query_embeddings, limit):
+        return [self.search(query_embedding, limit) for query_embedding in query_embeddings]
+
+def _unit(query_embedding):
+    query = np.asarray(query_embedding, dtype=np.float32)
+    norm = np.linalg.norm(query)
+    return query / norm if norm else query
+
+def open_dense_index(embeddings, embeddings_path, encoding = "float32", rerank = True, normalized = False, fingerprint = None):
+    # Saved codes are reused only for the embeddings they were built from
+    # (the store's fingerprint); file times say nothing about the contents.
+    # Without a fingerprint the codes could never be matched on a later
+    # open, so they are built in memory and not written.
+    if encoding == "float32":
+        return DenseIndex(embeddings, normalized)
+    full_embeddings = embeddings if rerank else None
+    path = quantized_path(embeddings_path, encoding)
+    if fingerprint is not None and os.path.exists(path):
+        index = QuantizedIndex.load(path, full_embeddings)
+        if len(index) == len(embeddings) and index.fingerprint == fingerprint:
+            return index
+    index = QuantizedIndex.build(embeddings, encoding, full_embeddings, fingerprint=fingerprint)
+    if fingerprint is not None:
+        index.save(path)
+    return index
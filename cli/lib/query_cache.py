@@ -0,0 +1,217 @@
+import os, time, sqlite3, threading, unicodedata
+import numpy as np
+
+from collections import OrderedDict
+from functools import lru_cache
+from .tracing import count
+from .search_utils import CACHE_DIR, QUERY_CACHE_MEMORY_SIZE, QUERY_CACHE_DISK_SIZE, SQLITE_BATCH_SIZE
+
+def normalize_query(text):
+    # Both bundled text encoders are uncased, so case and spacing variants
+    # share one entry; the normalized text is also what gets embedded, so a
+    # hit and a miss always return the same vector.
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+class QueryEmbeddingCache:
+    def __init__(self, path = os.path.join(CACHE_DIR, "query_embeddings.sqlite"), memory_size = QUERY_CACHE_MEMORY_SIZE, disk_size = QUERY_CACHE_DISK_SIZE):
+        self.path = path
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.counts = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        self.disk_available = True
+        self._db = None
+
+    # The disk tier is best effort: every disk access catches sqlite3.Error
+    # and OSError. A database that cannot be opened (e.g. an unwritable
+    # cache directory) turns the cache memory-only for the rest of the
+    # process; a locked one only loses that read or write.
+    def _connection(self):
+        if self._db is None:
+            db = None
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS query_embeddings ("
+                    "model TEXT NOT NULL, query TEXT NOT NULL, dtype TEXT NOT NULL, embedding BLOB NOT NULL, "
+                    "last_used REAL NOT NULL, PRIMARY KEY (model, query))"
+                )
+                db.execute("CREATE INDEX IF NOT EXISTS query_embeddings_last_used ON query_embeddings (last_used)")
+                db.commit()
+            except (sqlite3.Error, OSError):
+                self.disk_available = False
+                if db is not None:
+                    db.close()
+                raise
+            self._db = db
+        return self._db
+
+    def _disk_enabled(self):
+        return bool(self.disk_size) and self.disk_available
+
+    def get(self, model_name, text, encode):
+        query = normalize_query(text)
+        key = (model_name, query)
+        with self.lock:
+            embedding = self.memory.get(key)
+            if embedding is not None:
+                self.memory.move_to_end(key)
+                self.counts["memory_hits"] += 1
+                count("query_cache_hits")
+                return embedding
+            embedding = self._disk_get(key)
+            if embedding is not None:
+                self.counts["disk_hits"] += 1
+                self._remember(key, embedding)
+                count("query_cache_hits")
+                return embedding
+            self.counts["misses"] += 1
+            count("query_cache_misses")
+        # Encode outside the lock so concurrent misses are not serialized.
+        embedding = np.array(encode(query))
+        embedding.setflags(write=False)
+        with self.lock:
+            self._remember(key, embedding)
+            self._disk_put(key, embedding)
+        return embedding
+
+    def get_many(self, model_name, texts, encode_many):
+        queries = [normalize_query(text) for text in texts]
+        unique = list(dict.fromkeys(queries))
+        found = {}
+        with self.lock:
+            for query in unique:
+                embedding = self.memory.get((model_name, query))
+                if embedding is not None:
+                    self.memory.move_to_end((model_name, query))
+                    self.counts["memory_hits"] += 1
+                    found[query] = embedding
+            from_disk = self._disk_get_many(model_name, [query for query in unique if query not in found])
+            for query, embedding in from_disk.items():
+                self.counts["disk_hits"] += 1
+                self._remember((model_name, query), embedding)
+                found[query] = embedding
+            missing = [query for query in unique if query not in found]
+            self.counts["misses"] += len(missing)
+            count("query_cache_hits", len(found))
+            count("query_cache_misses", len(missing))
+        if missing:
+            # One batched forward pass for every query not already cached.
+            encoded = np.asarray(encode_many(missing))
+            with self.lock:
+                for query, embedding in zip(missing, encoded):
+                    embedding = np.array(embedding)
+                    embedding.setflags(write=False)
+                    self._remember((model_name, query), embedding)
+                    found[query] = embedding
+                self._disk_put_many(model_name, [(query, found[query]) for query in missing])
+        return np.stack([found[query] for query in queries]) if queries else np.empty((0, 0), dtype=np.float32)
+
+    def _remember(self, key, embedding):
+        self.memory[key] = embedding
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def _disk_get(self, key):
+        return self._disk_get_many(key[0], [key[1]]).get(key[1])
+
+    def _disk_get_many(self, model_name, queries):
+        if not self._disk_enabled() or not queries:
+            return {}
+        found = {}
+        try:
+            db = self._connection()
+            for start in range(0, len(queries), SQLITE_BATCH_SIZE):
+                batch = queries[start:start + SQLITE_BATCH_SIZE]
+                rows = db.execute(
+                    f"SELECT query, dtype, embedding FROM query_embeddings WHERE model = ? AND query IN ({', '.join('?' * len(batch))})",
+                    (model_name, *batch),
+                ).fetchall()
+                for query, dtype, embedding in rows:
+                    found[query] = np.frombuffer(embedding, dtype=dtype)
+            if found:
+                now = time.time()
+                db.executemany("UPDATE query_embeddings SET last_used = ? WHERE model = ? AND query = ?", [(now, model_name, query) for query in found])
+                db.commit()
+        except (sqlite3.Error, OSError):
+            return {}
+        return found
+
+    def _disk_put(self, key, embedding):
+        self._disk_put_many(key[0], [(key[1], embedding)])
+
+    def _disk_put_many(self, model_name, items):
+        if not self._disk_enabled() or not items:
+            return
+        try:
+            self._disk_insert(model_name, items)
+        except (sqlite3.Error, OSError):
+            pass
+
+    def _disk_insert(self, model_name, items):
+        db = self._connection()
+        now = time.time()
+        db.executemany(
+            "INSERT OR REPLACE INTO query_embeddings (model, query, dtype, embedding, last_used) VALUES (?, ?, ?, ?, ?)",
+            [(model_name, query, embedding.dtype.str, embedding.tobytes(), now) for query, embedding in items],
+        )
+        # Evict least recently used rows in batches of ~10% so the table is
+        # not trimmed on every insert once it is full.
+        count = db.execute("SELECT COUNT(*) FROM query_embeddings").fetchone()[0]
+        if count > self.disk_size:
+            keep = max(1, int(self.disk_size * 0.9))
+            db.execute(
+                "DELETE FROM query_embeddings WHERE rowid IN (SELECT rowid FROM query_embeddings ORDER BY last_used LIMIT ?)",
+                (count - keep,),
+            )
+        db.commit()
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            if not self._disk_enabled():
+                return
+            try:
+                db = self._connection()
+                db.execute("DELETE FROM query_embeddings")
+                db.commit()
+            except (sqlite3.Error, OSError):
+                pass
+
+    def _disk_entries(self):
+        if not self._disk_enabled():
+            return 0
+        try:
+            return self._connection().execute("SELECT COUNT(*) FROM query_embeddings").fetchone()[0]
+        except (sqlite3.Error, OSError):
+            return 0
+
+    def stats(self):
+        with self.lock:
+            lookups = sum(self.counts.values())
+            hits = self.counts["memory_hits"] + self.counts["disk_hits"]
+            disk_entries = self._disk_entries()
+            return {
+                **self.counts,
+                "lookups": lookups,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "memory_entries": len(self.memory),
+                "disk_entries": disk_entries,
+                "disk_available": self.disk_available,
+            }
+
+@lru_cache(maxsize=1)
+def get_query_cache():
+    return QueryEmbeddingCache()
+
+def format_cache_stats(stats):
+    return (
+        f"Query embedding cache: {stats['hit_rate']:.1%} hit rate over {stats['lookups']} lookups "
+        f"({stats['memory_hits']} memory, {stats['disk_hits']} disk, {stats['misses']} misses); "
+        f"{stats['memory_entries']} in memory, {stats['disk_entries']} on disk"
+        + ("" if stats["disk_available"] else " (disk tier unavailable, memory only)")
+    )
\ No newline at end of file
@@ -1,11 +1,6 @@
-import os
+from .llm_client import generate_content
+from .tracing import span
 
-from dotenv import load_dotenv
-from google import genai
-
-load_dotenv()
-api_key = os.getenv("gemini_api_key")
-client = genai.Client(api_key=api_key)
 model = "gemini-2.5-flash"
 
 
@@ -19,7 +14,7 @@ Query: "{query}"
 If no errors, return the original query.
 Corrected:"""
 
-    response = client.models.generate_content(model=model, contents=prompt)
+    response = generate_content(model, prompt)
     corrected = (response.text or "").strip().strip('"')
     return corrected if corrected else query
 
@@ -44,7 +39,7 @@ Examples:
 
 Rewritten query:"""
 
-    response = client.models.generate_content(model=model, contents=prompt)
+    response = generate_content(model, prompt)
     rewritten = (response.text or "").strip().strip('"')
     return rewritten if rewritten else query
 
@@ -65,13 +60,17 @@ Examples:
 Query: "{query}"
 """
 
-    response = client.models.generate_content(model=model, contents=prompt)
+    response = generate_content(model, prompt)
     expanded_terms = (response.text or "").strip().strip('"')
 
     return f"{query} {expanded_terms}"
 
 
 def enhance_query(query, method):
+    with span(f"enhance.{method}"):
+        return _enhance_query(query, method)
+
+def _enhance_query(query, method):
     match method:
         case "spell":
             return spell_correct(query)
@@ -1,20 +1,19 @@
-import os, time, json
-
-from dotenv import load_dotenv
-from google import genai
-from sentence_transformers import CrossEncoder
-
-load_dotenv()
-api_key = os.getenv("GEMINI_API_KEY_2")
-client = genai.Client(api_key=api_key)
+import time, json, threading
+import numpy as np
+
+from collections import OrderedDict
+from functools import lru_cache
+from .llm_client import generate_content, generate_content_many
+from .embedding_store import content_hash
+from .query_cache import normalize_query
+from .tracing import span, count
+from .search_utils import CROSS_ENCODER_MODEL, RERANK_BATCH_SIZE, RERANK_CACHE_SIZE, RERANK_QUERY_TOKENS
+
+api_key_env = "GEMINI_API_KEY_2"
 model = "gemini-2.5-flash-lite"
 
-def individual_rerank(results, query):
-    new_results = results
-    for i, result in enumerate(results):
-        if i > 0:
-            time.sleep(60)
-        prompt = f"""Rate how well this movie matches the search query.
+def individual_rerank_prompt(result, query):
+    return f"""Rate how well this movie matches the search query.
             
                 Query: "{query}"
                 Movie: {result.get("document", {}).get("title", "")} - {result.get("document", "")}
@@ -29,15 +28,28 @@ def individual_rerank(results, query):
 
                 Score:"""
 
-        response = client.models.generate_content(model=model, contents=prompt)
-        corrected = (response.text or "").strip().strip('"')
-        new_results[i]["llm_rank"] = int(corrected)
+def individual_rerank(results, query):
+    # One request per result, issued together; the scheduler paces them to
+    # the key's requests/tokens-per-minute quota.
+    new_results = results
+    prompts = [individual_rerank_prompt(result, query) for result in results]
+    responses = generate_content_many(model, prompts, api_key_env, return_exceptions=True, parse=int)
+    for i, response in enumerate(responses):
+        # A request that failed after its retries, or a reply that is not a
+        # number, scores 0 rather than discarding the rest of the batch.
+        corrected = "" if isinstance(response, Exception) else (response.text or "").strip().strip('"')
+        new_results[i]["llm_rank"] = int(corrected) if corrected.isdigit() else 0
     
     return sorted(new_results, key=lambda item: item["llm_rank"], reverse=True)   
 
 
-def batch_rerank(results, query):
+def batch_rerank(results, query, semantic_search = None):
     documents = [result["document"] for result in results]
+    if semantic_search is not None:
+        from .context_builder import pack_context, format_context
+        header = lambda i, doc: f"ID {doc['id']}: {doc['title']}"
+        packed, _ = pack_context(query, results, semantic_search, every_document=True, header=header)
+        documents = format_context(results, packed, header, every_document=True)
     documents_map = {}
     for result in results:
         documents_map[result["document"]["id"]] = result
@@ -51,36 +63,157 @@ def batch_rerank(results, query):
 
             [75, 12, 34, 2, 1]
             """
-    response = client.models.generate_content(model=model, contents=prompt)
+    response = generate_content(model, prompt, api_key_env, parse=json.loads)
     corrected = (response.text or "").strip().strip('"')
     data = json.loads(corrected)
-    print(f"\n\n {data}")
     reranked_results = []
-    for i, id in enumerate(data):
-        documents_map[id]["llm_rank"] = i + 1
-        reranked_results.append(documents_map[id])
+    for id in data:
+        # Ids the model invented or repeated are skipped.
+        result = documents_map.pop(id, None)
+        if result is None:
+            continue
+        result["llm_rank"] = len(reranked_results) + 1
+        reranked_results.append(result)
     
     return reranked_results
 
 
-def cross_encoder(results, query):
-    pairs = []
-    cross_encode = CrossEncoder("cross-encoder/ms-marco-TinyBERT-L2-v2")
-    for result in results:
-        pairs.append([query, f"{result.get('document', '')} - {result["document"].get('title', '')}"])
-    scores = cross_encode.predict(pairs)
-    for i, score in enumerate(scores):
-        results[i]["llm_rank"] = score
-    sorted_results = sorted(results, key=lambda item: item["llm_rank"], reverse=True)
-    return sorted_results
-
-def rerank_result(results, query, method):
+@lru_cache
+def get_cross_encoder(model_name = CROSS_ENCODER_MODEL):
+    with span("model.load", model=model_name):
+        from sentence_transformers import CrossEncoder
+        return CrossEncoder(model_name)
+
+class CrossEncoderReranker:
+    # Scores (query, document) pairs with a cross-encoder. Documents are
+    # trimmed once to the model's token budget, pairs are predicted in
+    # batches, and scores are kept in an LRU keyed by the normalized query,
+    # the document id and a hash of the document text.
+    def __init__(self, model_name = CROSS_ENCODER_MODEL, batch_size = RERANK_BATCH_SIZE, cache_size = RERANK_CACHE_SIZE):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.scores = OrderedDict()
+        self.texts = OrderedDict()
+        self.lock = threading.Lock()
+        self.counts = {"pairs": 0, "cache_hits": 0, "predicted": 0, "predict_seconds": 0.0}
+        self.last_stats = None
+
+    @property
+    def model(self):
+        return get_cross_encoder(self.model_name)
+
+    def _token_budget(self):
+        max_length = getattr(self.model, "max_length", None)
+        tokenizer = getattr(self.model, "tokenizer", None)
+        if not max_length and tokenizer is not None:
+            max_length = tokenizer.model_max_length
+        return min(max_length or 512, 512) - RERANK_QUERY_TOKENS
+
+    def document_text(self, document):
+        text = f"{document.get('title', '')} - {document.get('description', '')}"
+        key = (document.get("id"), content_hash(text))
+        with self.lock:
+            if key in self.texts:
+                self.texts.move_to_end(key)
+                return key, self.texts[key]
+        trimmed = self._trim(text)
+        with self.lock:
+            _remember(self.texts, key, trimmed, self.cache_size)
+        return key, trimmed
+
+    def _trim(self, text):
+        # Cut the text where the document's share of the model input ends,
+        # leaving RERANK_QUERY_TOKENS for the query and special tokens, so
+        # long descriptions are not tokenized in full on every predict call.
+        tokenizer = getattr(self.model, "tokenizer", None)
+        if tokenizer is None or not getattr(tokenizer, "is_fast", False):
+            return text
+        encoding = tokenizer(text, add_special_tokens=False, truncation=True, max_length=self._token_budget(), return_offsets_mapping=True)
+        offsets = encoding["offset_mapping"]
+        return text[:offsets[-1][1]] if offsets else text
+
+    def score(self, query, documents):
+        query_key = normalize_query(query)
+        keys, texts = zip(*(self.document_text(document) for document in documents)) if documents else ((), ())
+        scores = np.empty(len(documents), dtype=np.float32)
+        missing = {}
+        with self.lock:
+            for i, key in enumerate(keys):
+                cached = self.scores.get((query_key, *key))
+                if cached is None:
+                    missing.setdefault((query_key, *key), []).append(i)
+                else:
+                    self.scores.move_to_end((query_key, *key))
+                    scores[i] = cached
+        started = time.perf_counter()
+        if missing:
+            pairs = [[query, texts[rows[0]]] for rows in missing.values()]
+            with span("rerank.predict", batch_size=self.batch_size) as s:
+                predicted = self.model.predict(pairs, batch_size=self.batch_size, show_progress_bar=False)
+                s.count("pairs_scored", len(pairs))
+            with self.lock:
+                for (key, rows), value in zip(missing.items(), predicted):
+                    scores[rows] = value
+                    _remember(self.scores, key, float(value), self.cache_size)
+        seconds = time.perf_counter() - started
+        predicted_count = len(missing)
+        stats = {"pairs": len(documents), "cache_hits": len(documents) - sum(len(rows) for rows in missing.values()), "predicted": predicted_count, "predict_seconds": seconds}
+        with self.lock:
+            for name, value in stats.items():
+                self.counts[name] += value
+        count("rerank_cache_hits", stats["cache_hits"])
+        self.last_stats = {**stats, "pairs_per_second": predicted_count / seconds if predicted_count and seconds else 0.0}
+        return scores
+
+    def rerank(self, query, results, top_n = None):
+        # Only the first top_n fused candidates are re-scored; the rest keep
+        # their fused order after them.
+        head, tail = (results, []) if top_n is None else (results[:top_n], results[top_n:])
+        scores = self.score(query, [result["document"] for result in head])
+        for result, score in zip(head, scores):
+            result["llm_rank"] = float(score)
+        return sorted(head, key=lambda item: item["llm_rank"], reverse=True) + tail
+
+    def stats(self):
+        with self.lock:
+            counts = dict(self.counts)
+        counts["pairs_per_second"] = counts["predicted"] / counts["predict_seconds"] if counts["predicted"] and counts["predict_seconds"] else 0.0
+        return counts
+
+def _remember(cache, key, value, size):
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > size:
+        cache.popitem(last=False)
+
+@lru_cache(maxsize=1)
+def get_reranker():
+    return CrossEncoderReranker()
+
+def cross_encoder(results, query, top_n = None):
+    return get_reranker().rerank(query, results, top_n)
+
+def format_rerank_stats(stats):
+    return (
+        f"Cross-encoder: {stats['pairs']} pairs, {stats['cache_hits']} cached, {stats['predicted']} predicted "
+        f"in {stats['predict_seconds'] * 1000:.1f} ms ({stats['pairs_per_second']:.0f} pairs/s)"
+    )
+
+def rerank_result(results, query, method, top_n = None, semantic_search = None):
+    with span(f"rerank.{method}") as s:
+        s.count("candidates", len(results) if top_n is None else min(top_n, len(results)))
+        return _rerank_result(results, query, method, top_n, semantic_search)
+
+def _rerank_result(results, query, method, top_n = None, semantic_search = None):
+    if method != "cross_encoder" and top_n is not None:
+        return _rerank_result(results[:top_n], query, method, None, semantic_search) + results[top_n:]
     match method:
         case "individual":
             return individual_rerank(results, query)
         case "batch":
-            return batch_rerank(results, query)
+            return batch_rerank(results, query, semantic_search)
         case "cross_encoder":
-            return cross_encoder(results, query)
+            return cross_encoder(results, query, top_n)
         case _:
             return query
\ No newline at end of file
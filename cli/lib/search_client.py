@@ -0,0 +1,24 @@
+import json
+from urllib import request, error
+
+from .search_utils import DEFAULT_SEARCH_LIMIT
+
+def server_request(server, endpoint, payload):
+    data = json.dumps(payload).encode("utf-8")
+    req = request.Request(f"{server.rstrip('/')}/{endpoint}", data=data, headers={"Content-Type": "application/json"})
+    try:
+        with request.urlopen(req) as response:
+            return json.load(response)
+    except error.HTTPError as e:
+        body = e.read().decode("utf-8", "replace")
+        try:
+            message = json.loads(body)["error"]
+        except (ValueError, KeyError):
+            message = body or e.reason
+        raise ValueError(f"Search server returned {e.code}: {message}") from None
+    except error.URLError as e:
+        raise ValueError(f"Could not reach search server at {server}: {e.reason}") from None
+
+def rag_request(server, mode, query, limit = DEFAULT_SEARCH_LIMIT):
+    response = server_request(server, "rag", {"mode": mode, "query": query, "limit": limit})
+    return response["titles"], response["answer"]
\ No newline at end of file
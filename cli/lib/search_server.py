@@ -0,0 +1,219 @@
+import json, inspect, threading, traceback
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from .keyword_search import InvertedIndex
+from .semantic_search import SemanticSearch, ChunkedSemanticSearch
+from .hybrid_search import HybridSearch, weighted_search_command, rrf_search_command
+from .query_cache import get_query_cache
+from .llm_client import get_llm_cache
+from .tracing import span, report_span
+from .search_utils import load_movies, DEFAULT_SEARCH_LIMIT, DEFAULT_ALPHA_HYBRID, RRF_K1, BM25_K1, BM25_B, SEARCH_SERVER_HOST, SEARCH_SERVER_PORT, BM25_PRUNING_METHODS, EMBEDDING_ENCODINGS
+
+RAG_MODES = ("rag", "summarize", "citations", "question")
+ENHANCE_METHODS = ("spell", "rewrite", "expand")
+RERANK_METHODS = ("individual", "batch", "cross_encoder")
+
+class BadRequest(ValueError):
+    # Raised by the endpoints for arguments they reject; any other error
+    # from a handler is the server's, and is reported as a 500.
+    pass
+
+def _check_choice(name, value, choices, optional = False):
+    if value is None and optional:
+        return
+    if value not in choices:
+        raise BadRequest(f"Unknown {name} '{value}', expected one of {', '.join(choices)}")
+
+class SearchService:
+    # Models and indexes are loaded on first use and then shared by every
+    # request; each resource has its own lock so a slow load (e.g. the image
+    # model) does not block requests that only need the keyword index.
+    def __init__(self):
+        self._resources = {}
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def _resource(self, key, factory):
+        if key in self._resources:
+            return self._resources[key]
+        with self._locks_lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self._resources:
+                self._resources[key] = factory()
+        return self._resources[key]
+
+    def movies(self):
+        return self._resource("movies", load_movies)
+
+    def inverted_index(self):
+        def factory():
+            idx = InvertedIndex()
+            if idx.exists():
+                idx.load()
+            else:
+                idx.build()
+                idx.save()
+            return idx
+        return self._resource("keyword", factory)
+
+    def semantic(self, encoding = "float32"):
+        def factory():
+            semantic_search = SemanticSearch(encoding=encoding)
+            semantic_search.load_or_create_embeddings(self.movies())
+            return semantic_search
+        return self._resource(f"semantic:{encoding}", factory)
+
+    def chunked(self, encoding = "float32"):
+        def factory():
+            chunked_semantic_search = ChunkedSemanticSearch(encoding=encoding)
+            chunked_semantic_search.load_or_create_chunk_embeddings(self.movies())
+            return chunked_semantic_search
+        return self._resource(f"chunked:{encoding}", factory)
+
+    def hybrid(self):
+        return self._resource("hybrid", lambda: HybridSearch(self.movies(), semantic_search=self.chunked(), idx=self.inverted_index()))
+
+    def multimodal(self, encoding = "float32"):
+        def factory():
+            from .multimodal_search import MultimodalSearch
+            multimodal_search = MultimodalSearch(self.movies(), encoding=encoding)
+            multimodal_search.load_or_create_embeddings()
+            return multimodal_search
+        return self._resource(f"multimodal:{encoding}", factory)
+
+    def preload(self):
+        self.hybrid()
+
+    def keyword_search(self, query, limit = DEFAULT_SEARCH_LIMIT, k1 = BM25_K1, b = BM25_B, pruning = None):
+        _check_choice("pruning method", pruning, BM25_PRUNING_METHODS, optional=True)
+        results, stats = self.inverted_index().bm25_search_stats(query, limit, k1, b, pruning)
+        return {"results": results, "stats": stats}
+
+    def semantic_search(self, query, limit = DEFAULT_SEARCH_LIMIT, encoding = "float32"):
+        _check_choice("encoding", encoding, EMBEDDING_ENCODINGS)
+        return self.semantic(encoding).search(query, limit)
+
+    def chunked_search(self, query, limit = DEFAULT_SEARCH_LIMIT, nprobe = None, encoding = "float32"):
+        _check_choice("encoding", encoding, EMBEDDING_ENCODINGS)
+        return self.chunked(encoding).search_chunks(query, limit, nprobe)
+
+    def weighted_search(self, query, alpha = DEFAULT_ALPHA_HYBRID, limit = DEFAULT_SEARCH_LIMIT, nprobe = None, depth = None, timeouts = None):
+        return weighted_search_command(query, alpha, limit, nprobe, hybrid_search=self.hybrid(), depth=depth, timeouts=timeouts)
+
+    def rrf_search(self, query, k = RRF_K1, enhance = None, rerank_method = None, limit = DEFAULT_SEARCH_LIMIT, nprobe = None, depth = None, timeouts = None, rerank_top_n = None):
+        _check_choice("enhance method", enhance, ENHANCE_METHODS, optional=True)
+        _check_choice("rerank method", rerank_method, RERANK_METHODS, optional=True)
+        return rrf_search_command(query, k, enhance, rerank_method, limit, nprobe, hybrid_search=self.hybrid(), depth=depth, timeouts=timeouts, rerank_top_n=rerank_top_n)
+
+    def image_search(self, image_path, limit = 5, encoding = "float32"):
+        _check_choice("encoding", encoding, EMBEDDING_ENCODINGS)
+        return self.multimodal(encoding).search_with_image(image_path, limit)
+
+    def rag(self, query, mode = "rag", limit = DEFAULT_SEARCH_LIMIT):
+        _check_choice("RAG mode", mode, RAG_MODES)
+        from .augmented_generation import rag_command, summarize_command, citations_command, question_command
+        match mode:
+            case "rag":
+                titles, answer = rag_command(query, hybrid_search=self.hybrid())
+            case "summarize":
+                titles, answer = summarize_command(query, limit, hybrid_search=self.hybrid())
+            case "citations":
+                titles, answer = citations_command(query, limit, hybrid_search=self.hybrid())
+            case "question":
+                titles, answer = question_command(query, limit, hybrid_search=self.hybrid())
+        return {"titles": titles, "answer": answer}
+
+    def endpoints(self):
+        return {
+            "keyword": self.keyword_search,
+            "semantic": self.semantic_search,
+            "chunked": self.chunked_search,
+            "weighted": self.weighted_search,
+            "rrf": self.rrf_search,
+            "image": self.image_search,
+            "rag": self.rag,
+        }
+
+def _json_default(value):
+    if hasattr(value, "item"):
+        return value.item()
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+class SearchRequestHandler(BaseHTTPRequestHandler):
+    service = None
+    quiet = False
+
+    def do_GET(self):
+        if self.path.strip("/") == "health":
+            self._send(200, {"status": "ok", "loaded": sorted(self.service._resources), "query_cache": get_query_cache().stats(), "llm_cache": get_llm_cache().stats()})
+        else:
+            self._send(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        endpoint = self.path.strip("/")
+        handler = self.service.endpoints().get(endpoint)
+        if handler is None:
+            self._send(404, {"error": f"Unknown endpoint {self.path}"})
+            return
+        # Only a malformed body, arguments that do not fit the endpoint and
+        # the endpoints' own BadRequest checks are the client's error; a
+        # ValueError or KeyError from deeper in a search (a malformed LLM
+        # reply, say) is the server's.
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(payload, dict):
+                raise ValueError("Request body must be a JSON object")
+            inspect.signature(handler).bind(**payload)
+        except (ValueError, TypeError) as e:
+            self._send(400, {"error": str(e)})
+            return
+        # With --profile every request is its own root span, so its stage
+        # tree is logged as it finishes and summed per endpoint on exit.
+        request = span(f"server.{endpoint}")
+        try:
+            with request:
+                body = handler(**payload)
+        except BadRequest as e:
+            status, body = 400, {"error": str(e)}
+        except Exception as e:
+            traceback.print_exc()
+            status, body = 500, {"error": f"{type(e).__name__}: {e}"}
+        else:
+            status = 200
+        report_span(request)
+        self._send(status, body)
+
+    def _send(self, status, body):
+        data = json.dumps(body, default=_json_default).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if not self.quiet:
+            super().log_message(format, *args)
+
+def make_server(host = SEARCH_SERVER_HOST, port = SEARCH_SERVER_PORT, service = None, quiet = False):
+    handler = type("BoundSearchRequestHandler", (SearchRequestHandler,), {"service": service or SearchService(), "quiet": quiet})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+def serve_command(host = SEARCH_SERVER_HOST, port = SEARCH_SERVER_PORT, preload = False, quiet = False):
+    service = SearchService()
+    if preload:
+        service.preload()
+    server = make_server(host, port, service, quiet)
+    print(f"Search server listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
\ No newline at end of file
@@ -1,6 +1,8 @@
 import json, os
 import numpy as np
 
+from .tracing import traced
+
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
 data_path = os.path.join(ROOT_DIR, "data", "movies.json")
 golden_data_path = os.path.join(ROOT_DIR, "data", "golden_dataset.json")
@@ -11,17 +13,68 @@ DEFAULT_SEARCH_LIMIT = 5
 BM25_K1 = 1.5
 BM25_B = 0.75
 SCORE_PRECISION = 3
+STEM_CACHE_SIZE = 65536
+BM25_BLOCK_SIZE = 64
+BM25_PRUNING_METHODS = ("wand", "bmw")
 
 DEFAULT_CHUNK_LIMIT = 200
 DEFAULT_CHUNK_OVERLAP = 2
+SEMANTIC_CHUNK_SIZE = 4
+SEMANTIC_CHUNK_OVERLAP = 1
 DEFAULT_ALPHA_HYBRID = 0.5
 RRF_K1 = 60
+HYBRID_CANDIDATE_MULTIPLIER = 500
+HYBRID_BRANCH_WORKERS = 8
+SEARCH_BATCH_SIZE = 256
+SEARCH_SHARDS = 4
+EMBED_BATCH_SIZE = 64
+EMBED_SORT_WINDOW = 4096
+BUILD_SHARD_SIZE = 500
+CROSS_ENCODER_MODEL = "cross-encoder/ms-marco-TinyBERT-L2-v2"
+RERANK_BATCH_SIZE = 32
+RERANK_CACHE_SIZE = 10_000
+RERANK_QUERY_TOKENS = 64
+# (requests, tokens) per minute; the Gemini free-tier quotas per model.
+LLM_RATE_LIMITS = {"gemini-2.5-flash": (10, 250_000), "gemini-2.5-flash-lite": (15, 250_000)}
+LLM_DEFAULT_RATE_LIMIT = (10, 250_000)
+LLM_MAX_CONCURRENCY = 4
+LLM_MAX_RETRIES = 5
+LLM_REQUEST_DEADLINE = 120.0
+LLM_RETRY_BASE_DELAY = 1.0
+LLM_RETRY_MAX_DELAY = 30.0
+LLM_IMAGE_TOKENS = 258
+RAG_CONTEXT_TOKENS = 600
+CONTEXT_DUPLICATE_SIMILARITY = 0.92
+ANN_DEFAULT_NPROBE = 8
+ANN_KMEANS_ITERATIONS = 20
+EMBEDDING_ENCODINGS = ("float32", "float16", "int8", "pq")
+QUANTIZED_RERANK_FACTOR = 4
+PQ_SUBSPACES = 64
+QUERY_CACHE_MEMORY_SIZE = 1024
+QUERY_CACHE_DISK_SIZE = 50_000
+SQLITE_BATCH_SIZE = 500
+LLM_CACHE_TTL = 30 * 24 * 3600
+LLM_CACHE_SIZE = 100_000
+SEARCH_SERVER_HOST = "127.0.0.1"
+SEARCH_SERVER_PORT = 8765
+DEFAULT_SEARCH_SERVER = f"http://{SEARCH_SERVER_HOST}:{SEARCH_SERVER_PORT}"
 
+@traced("data.load_movies")
 def load_movies():
     with open(data_path, 'r') as f:
         data = json.load(f)
     return data["movies"]
 
+def batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
 def load_golden_data():
     with open(golden_data_path, 'r') as f:
         golden_data = json.load(f)
@@ -39,6 +92,17 @@ def single_token(term):
             raise ValueError("Term must be a single token")
 
 
+def top_k_indices(scores, k):
+    scores = np.asarray(scores)
+    if k <= 0 or len(scores) == 0:
+        return np.array([], dtype=np.int64)
+    if k >= len(scores):
+        return np.argsort(-scores, kind="stable")
+    threshold = np.partition(-scores, k - 1)[k - 1]
+    candidates = np.flatnonzero(-scores <= threshold)
+    order = np.argsort(-scores[candidates], kind="stable")
+    return candidates[order[:k]]
+
 def cosine_similarity(vec1, vec2):
     dot_product = np.dot(vec1, vec2)
     norm1 = np.linalg.norm(vec1)
@@ -1,58 +1,125 @@
 import os, re, json
-from sentence_transformers import SentenceTransformer
-from lib.search_utils import CACHE_DIR, load_movies, SCORE_PRECISION, cosine_similarity
+from array import array
+from functools import lru_cache
+import numpy as np
+from lib.search_utils import CACHE_DIR, load_movies, top_k_indices, SCORE_PRECISION, QUANTIZED_RERANK_FACTOR, SEMANTIC_CHUNK_SIZE, SEMANTIC_CHUNK_OVERLAP, SEARCH_BATCH_SIZE
+from lib.ann_index import IVFIndex
+from lib.quantization import open_dense_index
+from lib.embedding_store import EmbeddingStore, source_hash
+from lib.query_cache import get_query_cache
+from lib.tracing import span, traced
+
+@lru_cache
+def get_model(model_name):
+    with span("model.load", model=model_name):
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(model_name)
+
+def document_texts(documents):
+    return [f"{doc['title']}: {doc['description']}" for doc in documents]
 
 class SemanticSearch:
-    def __init__(self, model_name = "all-MiniLM-L6-v2"):
-        self.model = SentenceTransformer(model_name)
+    def __init__(self, model_name = "all-MiniLM-L6-v2", encoding = "float32", rerank = True):
+        self.model_name = model_name
+        self.encoding = encoding
+        self.rerank = rerank
         self.embeddings = None
         self.embeddings_path = os.path.join(CACHE_DIR, "movie_embeddings.npy")
+        self.embedding_store = EmbeddingStore(self.embeddings_path, model_name)
         self.documents = None
         self.document_map = {}
+        self.doc_ids = None
+        self.doc_positions = {}
+        self.dense_index = None
+        self.query_cache = get_query_cache()
+
+    @property
+    def model(self):
+        return get_model(self.model_name)
 
     def generate_embedding(self, text):
         if not text.strip():
             raise ValueError("The text cannot be empty.")
-        embedding = self.model.encode([text])
-        return embedding[0]
+        with span("semantic.query_embedding"):
+            return self.query_cache.get(self.model_name, text, self._encode_query)
+
+    def generate_embeddings(self, texts):
+        if any(not text.strip() for text in texts):
+            raise ValueError("The text cannot be empty.")
+        with span("semantic.query_embedding", queries=len(texts)):
+            return self.query_cache.get_many(self.model_name, texts, self._encode_queries)
+
+    def _encode_query(self, text):
+        with span("semantic.encode", texts=1):
+            embedding = self.model.encode([text])
+            return embedding[0]
+
+    def _encode_queries(self, texts):
+        with span("semantic.encode", texts=len(texts)):
+            return self.model.encode(texts)
+
+    def encode_texts(self, texts):
+        with span("semantic.encode", texts=len(texts)):
+            return self.model.encode(texts, show_progress_bar = True)
+
+    def encode_batch(self, texts):
+        # One fixed-size batch from the streaming build; the caller groups
+        # texts by length, so the model's own sorting and progress bar are
+        # not needed.
+        with span("semantic.encode", texts=len(texts)):
+            return self.model.encode(texts, batch_size=len(texts), show_progress_bar=False)
 
     def build_embeddings(self, documents):
-        self.documents = documents
-        docs_representations = []
-        for doc in documents:
-            self.document_map[doc["id"]] = doc
-            docs_representations.append(f"{doc['title']}: {doc['description']}")
-        self.embeddings = self.model.encode(docs_representations, show_progress_bar = True)
-        os.makedirs(CACHE_DIR, exist_ok=True)
-        np.save(self.embeddings_path, self.embeddings)
-        return self.embeddings
+        return self.load_or_create_embeddings(documents, reuse=False)
 
-    def load_or_create_embeddings(self, documents):
+    def _set_documents(self, documents):
         self.documents = documents
         for doc in documents:
             self.document_map[doc["id"]] = doc
-        if os.path.exists(self.embeddings_path):
-            self.embeddings = np.load(self.embeddings_path)
-            if len(self.embeddings) == len(documents):
-                return self.embeddings
-        else: 
-            return self.build_embeddings(documents)
+        self.doc_ids = np.array([doc["id"] for doc in documents], dtype=np.int64)
+        self.doc_positions = {doc_id: i for i, doc_id in enumerate(self.doc_ids.tolist())}
 
-    def search(self, query, limit):
+    @traced("semantic.load_embeddings")
+    def load_or_create_embeddings(self, documents, reuse = True):
+        self._set_documents(documents)
+        texts = document_texts(documents)
+        source = source_hash(texts)
+        self.embeddings = self.embedding_store.open(source) if reuse else None
+        if self.embeddings is None:
+            self.embeddings = self.embedding_store.refresh(texts, self.encode_texts, "r", reuse, source)
+        self.dense_index = None
+        return self.embeddings
+
+    def _open_dense_index(self):
         if self.embeddings is None:
             raise ValueError("No embeddings loaded. Call `load_or_create_embeddings` first.")
+        if self.dense_index is None:
+            self.dense_index = open_dense_index(self.embeddings, self.embeddings_path, self.encoding, self.rerank, normalized=True, fingerprint=self.embedding_store.fingerprint())
+        return self.dense_index
+
+    def search(self, query, limit):
+        dense_index = self._open_dense_index()
         q_embedding = self.generate_embedding(query)
-        cosine_similarities = []
-        for i, embedding in enumerate(self.embeddings):
-            similarity_score = cosine_similarity(q_embedding, embedding)
-            cosine_similarities.append((similarity_score, self.documents[i]))
-        results = sorted(cosine_similarities, key=lambda x: x[0], reverse=True)
+        with span("semantic.score") as s:
+            top, scores = dense_index.search(q_embedding, limit)
+            s.count("documents_scored", len(dense_index))
+        return self._format_results(top, scores)
+
+    def search_many(self, queries, limit):
+        dense_index = self._open_dense_index()
+        q_embeddings = self.generate_embeddings(queries)
+        with span("semantic.score_many", queries=len(queries)) as s:
+            results = dense_index.search_many(q_embeddings, limit)
+            s.count("documents_scored", len(dense_index) * len(queries))
+        return [self._format_results(top, scores) for top, scores in results]
+
+    def _format_results(self, top, scores):
         listofdicts = []
-        for _, result in enumerate(results[:limit]):
+        for i, score in zip(top, scores):
             listofdicts.append({
-                "score": result[0],
-                "title": result[1]["title"],
-                "description": result[1]["description"],
+                "score": float(score),
+                "title": self.documents[i]["title"],
+                "description": self.documents[i]["description"],
             })
         return listofdicts
 
@@ -68,14 +135,21 @@ def embed_text(text):
     print(f"First 3 dimensions: {embedding[:3]}")
     print(f"Dimensions: {embedding.shape[0]}")
 
-def verify_embeddings():
-    semantic_search = SemanticSearch()
+def verify_embeddings(encoding = "float32"):
+    semantic_search = SemanticSearch(encoding=encoding)
     movies = load_movies()
     semantic_search.load_or_create_embeddings(movies)
     print(f"Number of docs: {len(semantic_search.documents)}")
     print(f"Embeddings shape: {semantic_search.embeddings.shape[0]} vectors in {semantic_search.embeddings.shape[1]} dimensions")
+    print_refresh_stats(semantic_search.embedding_store.last_refresh)
     return semantic_search
 
+def print_refresh_stats(stats):
+    if stats["changed"]:
+        print(f"Refreshed embeddings: {stats['encoded']} encoded, {stats['reused']} reused, {stats['dropped']} dropped, {stats['duplicates']} duplicates")
+    if "texts_per_second" in stats:
+        print(f"Built in {stats['seconds']:.1f} s: {stats['texts_per_second']:.0f} chunks/s, peak RSS {stats['peak_rss_bytes'] / 2**20:.0f} MiB")
+
 def embed_query_text(query):
     semantic_search = SemanticSearch()
     embedding = semantic_search.generate_embedding(query)
@@ -83,9 +157,11 @@ def embed_query_text(query):
     print(f"First 5 dimensions: {embedding[:5]}")
     print(f"Shape: {embedding.shape}")
 
-def search(query, limit):
-    semantic_search = verify_embeddings()
-    results = semantic_search.search(query, limit)
+def search(query, limit, encoding = "float32"):
+    semantic_search = verify_embeddings(encoding)
+    print_search_results(semantic_search.search(query, limit))
+
+def print_search_results(results):
     for i, movie in enumerate(results, start=1):
         print(f"{i}. {movie['title']} (score: {movie['score']})\n{movie['description']}")
 
@@ -115,75 +191,219 @@ def semantic_chunk(text, max_chunk_size, overlap):
         chunks = chunks[:1]
     return chunks
 
+def stream_chunks(documents):
+    for movie_idx, doc in enumerate(documents):
+        if doc["description"] == "":
+            continue
+        chunks = semantic_chunk(doc["description"], SEMANTIC_CHUNK_SIZE, SEMANTIC_CHUNK_OVERLAP)
+        for chunk_idx, chunk in enumerate(chunks):
+            yield movie_idx, chunk_idx, len(chunks), chunk
+
+def chunk_source_hash(documents):
+    return source_hash([f"semantic_chunk:{SEMANTIC_CHUNK_SIZE}:{SEMANTIC_CHUNK_OVERLAP}"] + [doc["description"] for doc in documents])
+
+CHUNK_METADATA_DTYPE = np.dtype([("movie_idx", "<i4"), ("chunk_idx", "<i4"), ("total_chunks", "<i4")])
+
+def chunk_metadata_array(chunks_metadata):
+    return np.array(
+        [(chunk["movie_idx"], chunk["chunk_idx"], chunk["total_chunks"]) for chunk in chunks_metadata],
+        dtype=CHUNK_METADATA_DTYPE,
+    )
+
 class ChunkedSemanticSearch(SemanticSearch):
-    def __init__(self, model_name = "all-MiniLM-L6-v2"):
-        super().__init__(model_name)
+    def __init__(self, model_name = "all-MiniLM-L6-v2", encoding = "float32", rerank = True):
+        super().__init__(model_name, encoding, rerank)
         self.chunk_embeddings = None
         self.chunk_embeddings_path = os.path.join(CACHE_DIR, "chunk_embeddings.npy")
+        self.chunk_store = EmbeddingStore(self.chunk_embeddings_path, model_name)
         self.chunk_metadata = None
         self.chunk_metadata_path = os.path.join(CACHE_DIR, "chunk_metadata.json")
+        self.chunk_metadata_binary_path = os.path.join(CACHE_DIR, "chunk_metadata.npy")
+        self.chunk_index = None
+        self.segment_starts = None
+        self.chunk_ranges = {}
+        self.ann_index = None
+        self.ann_index_path = os.path.join(CACHE_DIR, "chunk_ivf.npz")
 
-    def build_chunk_embeddings(self, documents):
-        self.documents = documents
-        for doc in documents:
-            self.document_map[doc["id"]] = doc
+    def chunk_documents(self, documents):
         all_chunks = []
         chunks_metadata = []
-        for i, doc in enumerate(documents):
-            if doc["description"] == "":
-                continue
-            chunks = semantic_chunk(doc["description"], 4, 1)
-            all_chunks = all_chunks + chunks
-            for j, _ in enumerate(chunks):
-                chunks_metadata.append({
-                    "movie_idx": i,
-                    "chunk_idx": j,
-                    "total_chunks": len(chunks),
-                })
-        self.chunk_embeddings = self.model.encode(all_chunks, show_progress_bar = True)
-        self.chunk_metadata = chunks_metadata
-        os.makedirs(CACHE_DIR, exist_ok=True)
-        np.save(self.chunk_embeddings_path, self.chunk_embeddings)
-        with open(self.chunk_metadata_path, "w", encoding="utf-8") as f:
-            json.dump({"chunks": chunks_metadata, "total_chunks": len(all_chunks)}, f, indent=2)
+        for movie_idx, chunk_idx, total_chunks, chunk in stream_chunks(documents):
+            all_chunks.append(chunk)
+            chunks_metadata.append({"movie_idx": movie_idx, "chunk_idx": chunk_idx, "total_chunks": total_chunks})
+        return all_chunks, chunks_metadata
+
+    def build_chunk_embeddings(self, documents):
+        return self.load_or_create_chunk_embeddings(documents, reuse=False)
+
+    @traced("chunked.load_embeddings")
+    def load_or_create_chunk_embeddings(self, documents, reuse = True):
+        self._set_documents(documents)
+        self.chunk_index = None
+        # The cached chunks are trusted without re-chunking when the
+        # descriptions and chunking parameters hash to the recorded source.
+        source = chunk_source_hash(documents)
+        self.chunk_embeddings = self.chunk_store.open(source) if reuse else None
+        if self.chunk_embeddings is not None and os.path.exists(self.chunk_metadata_binary_path):
+            metadata = self.load_chunk_metadata()
+            if len(metadata) == len(self.chunk_embeddings):
+                self._set_chunk_metadata(metadata)
+                self._refresh_ann_index()
+                return self.chunk_embeddings
+        # Chunks are produced, encoded and written as the documents are
+        # walked; only three int32s of metadata per chunk are kept. The
+        # metadata is saved before the manifest that makes the new rows
+        # usable, so the two never disagree.
+        metadata = array("i")
+        def chunks():
+            for movie_idx, chunk_idx, total_chunks, chunk in stream_chunks(documents):
+                metadata.extend((movie_idx, chunk_idx, total_chunks))
+                yield chunk
+        save_metadata = lambda: self.save_chunk_metadata(np.frombuffer(metadata, dtype=CHUNK_METADATA_DTYPE).copy())
+        self.chunk_embeddings = self.chunk_store.refresh_stream(chunks(), self.encode_batch, mmap_mode="r", reuse=reuse, source=source, before_manifest=save_metadata)
+        self._refresh_ann_index()
         return self.chunk_embeddings
 
-    def load_or_create_chunk_embeddings(self, documents):
-        self.documents = documents
-        for doc in documents:
-            self.document_map[doc["id"]] = doc
-        if os.path.exists(self.chunk_embeddings_path) and os.path.exists(self.chunk_metadata_path):
-            self.chunk_embeddings = np.load(self.chunk_embeddings_path)
-            with open(self.chunk_metadata_path, "r", encoding = "utf-8") as f:
-                data = json.load(f)
-                self.chunk_metadata = data["chunks"]
-            return self.chunk_embeddings
-        else: 
-            return self.build_chunk_embeddings(documents)
+    def save_chunk_metadata(self, metadata):
+        self._set_chunk_metadata(metadata)
+        np.save(self.chunk_metadata_binary_path, self.chunk_metadata)
+        self._write_chunk_metadata_json()
+
+    def _write_chunk_metadata_json(self):
+        with open(self.chunk_metadata_path, "w", encoding="utf-8") as f:
+            f.write('{"chunks": [')
+            for i, (movie_idx, chunk_idx, total_chunks) in enumerate(self.chunk_metadata.tolist()):
+                f.write((", " if i else "") + json.dumps({"movie_idx": movie_idx, "chunk_idx": chunk_idx, "total_chunks": total_chunks}))
+            f.write(f'], "total_chunks": {len(self.chunk_metadata)}}}')
+
+    def load_chunk_metadata(self):
+        if os.path.exists(self.chunk_metadata_binary_path):
+            return np.load(self.chunk_metadata_binary_path, mmap_mode="r")
+        with open(self.chunk_metadata_path, "r", encoding = "utf-8") as f:
+            data = json.load(f)
+        metadata = chunk_metadata_array(data["chunks"])
+        np.save(self.chunk_metadata_binary_path, metadata)
+        return metadata
+
+    def build_ann_index(self, n_lists = None):
+        self.ann_index = IVFIndex.build(self.chunk_embeddings, n_lists, fingerprint=self.chunk_store.fingerprint())
+        self.ann_index.save(self.ann_index_path)
+        return self.ann_index
+
+    def load_ann_index(self):
+        # An index built for other chunk embeddings, even of the same count,
+        # is not used; fingerprints are compared, not just lengths.
+        self.ann_index = None
+        if os.path.exists(self.ann_index_path):
+            ann_index = IVFIndex.load(self.ann_index_path)
+            if len(ann_index) == len(self.chunk_embeddings) and ann_index.fingerprint is not None and ann_index.fingerprint == self.chunk_store.fingerprint():
+                self.ann_index = ann_index
+        return self.ann_index
+
+    def _refresh_ann_index(self):
+        # A saved IVF index that no longer matches the embeddings is rebuilt.
+        if self.load_ann_index() is None and os.path.exists(self.ann_index_path):
+            self.build_ann_index()
+
+    def _set_chunk_metadata(self, metadata):
+        self.chunk_metadata = metadata
+        movie_idx = metadata["movie_idx"]
+        if len(movie_idx) == 0:
+            self.segment_starts = np.array([], dtype=np.int64)
+        else:
+            self.segment_starts = np.flatnonzero(np.r_[True, movie_idx[1:] != movie_idx[:-1]])
+        # Rows are grouped by document: each document's chunks are the rows
+        # [start, end) of its segment.
+        ends = np.r_[self.segment_starts[1:], len(movie_idx)]
+        self.chunk_ranges = dict(zip(np.asarray(movie_idx)[self.segment_starts].tolist(), zip(self.segment_starts.tolist(), ends.tolist())))
+
+    def max_chunk_scores(self, chunk_scores, rows = None):
+        movie_idx = self.chunk_metadata["movie_idx"]
+        if rows is None:
+            starts = self.segment_starts
+        else:
+            movie_idx = movie_idx[rows]
+            starts = np.flatnonzero(np.r_[True, movie_idx[1:] != movie_idx[:-1]]) if len(rows) else np.array([], dtype=np.int64)
+        if len(starts) == 0:
+            empty = np.array([], dtype=np.int64)
+            return empty, np.array([], dtype=np.float32), empty
+        movie_scores = np.maximum.reduceat(chunk_scores, starts)
+        lengths = np.diff(np.r_[starts, len(chunk_scores)])
+        positions = np.arange(len(chunk_scores))
+        is_best = chunk_scores == np.repeat(movie_scores, lengths)
+        best_rows = np.minimum.reduceat(np.where(is_best, positions, len(chunk_scores)), starts)
+        if rows is not None:
+            best_rows = rows[best_rows]
+        return movie_idx[starts], movie_scores, best_rows
         
-    def search_chunks(self, query, limit = 10):
-        q_embedding = self.generate_embedding(query)
-        chunk_scores = []
-        for i, chunk in enumerate(self.chunk_embeddings):
-            similarity_score = cosine_similarity(chunk, q_embedding)
-            chunk_scores.append({
-                "chunk_idx": self.chunk_metadata[i]["chunk_idx"],
-                "movie_idx": self.chunk_metadata[i]["movie_idx"],
-                "score": similarity_score,
-            })
-        movie_scores = {}
-        for i, c_score in enumerate(chunk_scores):
-            if c_score["movie_idx"] not in movie_scores or c_score["score"] > movie_scores[c_score["movie_idx"]]:
-                movie_scores[c_score["movie_idx"]] = c_score["score"]
-        top_results = sorted(movie_scores.items(), key=lambda x: x[1], reverse=True)[:limit]
+    def _open_chunk_index(self):
+        if self.chunk_index is None:
+            self.chunk_index = open_dense_index(self.chunk_embeddings, self.chunk_embeddings_path, self.encoding, self.rerank, normalized=True, fingerprint=self.chunk_store.fingerprint())
+        return self.chunk_index
+
+    def chunk_candidates(self, q_embedding, depth = 10, nprobe = None, chunk_scores = None):
+        with span("chunked.score", nprobe=nprobe) as s:
+            return self._chunk_candidates(q_embedding, depth, nprobe, chunk_scores, s)
+
+    def _chunk_candidates(self, q_embedding, depth, nprobe, chunk_scores, s):
+        self._open_chunk_index()
+        if chunk_scores is not None:
+            movie_idx, movie_scores, best_rows = self.max_chunk_scores(chunk_scores)
+        elif nprobe is not None:
+            if self.ann_index is None:
+                raise ValueError("No ANN index loaded. Build one with `build_ann_index` first.")
+            rows = self.ann_index.candidates(q_embedding, nprobe)
+            chunk_scores = self.chunk_index.scores(q_embedding, rows)
+            s.count("chunks_scored", len(rows))
+            movie_idx, movie_scores, best_rows = self.max_chunk_scores(chunk_scores, rows)
+        else:
+            chunk_scores = self.chunk_index.scores(q_embedding)
+            s.count("chunks_scored", len(chunk_scores))
+            movie_idx, movie_scores, best_rows = self.max_chunk_scores(chunk_scores)
+        if self.rerank and self.encoding != "float32":
+            shortlist = movie_idx[top_k_indices(movie_scores, depth * QUANTIZED_RERANK_FACTOR)]
+            rows = np.flatnonzero(np.isin(self.chunk_metadata["movie_idx"], shortlist))
+            chunk_scores = self.chunk_index.exact_scores(q_embedding, rows)
+            movie_idx, movie_scores, best_rows = self.max_chunk_scores(chunk_scores, rows)
+        top = top_k_indices(movie_scores, depth)
+        return movie_idx[top], movie_scores[top], best_rows[top]
+
+    def chunk_candidates_many(self, q_embeddings, depth = 10, nprobe = None):
+        chunk_index = self._open_chunk_index()
+        if nprobe is not None:
+            # Each query probes its own lists, so there is no shared matrix.
+            return [self.chunk_candidates(q_embedding, depth, nprobe) for q_embedding in q_embeddings]
+        results = []
+        for start in range(0, len(q_embeddings), SEARCH_BATCH_SIZE):
+            block = q_embeddings[start:start + SEARCH_BATCH_SIZE]
+            with span("chunked.score_many", queries=len(block)) as s:
+                block_scores = chunk_index.scores_many(block)
+                s.count("chunks_scored", block_scores.size)
+            for q_embedding, chunk_scores in zip(block, block_scores):
+                results.append(self.chunk_candidates(q_embedding, depth, chunk_scores=chunk_scores))
+        return results
+
+    def search_chunks(self, query, limit = 10, nprobe = None):
+        return self._format_chunk_results(*self.chunk_candidates(self.generate_embedding(query), limit, nprobe))
+
+    def search_chunks_many(self, queries, limit = 10, nprobe = None):
+        results = self.chunk_candidates_many(self.generate_embeddings(queries), limit, nprobe)
+        return [self._format_chunk_results(*candidates) for candidates in results]
+
+    def _format_chunk_results(self, movie_idx, movie_scores, best_rows):
         formatted_top_r = []
-        for i, result in enumerate(top_results):
+        for i in range(len(movie_idx)):
+            doc = self.documents[movie_idx[i]]
+            best_chunk = self.chunk_metadata[best_rows[i]]
             formatted_top_r.append({
-                 "id": self.documents[result[0]]["id"],
-                "title": self.documents[result[0]]["title"],
-                "document": self.documents[result[0]]["description"][:100],
-                "score": round(result[1], SCORE_PRECISION),
-                "metadata": {}
+                "id": doc["id"],
+                "title": doc["title"],
+                "document": doc["description"][:100],
+                "score": round(float(movie_scores[i]), SCORE_PRECISION),
+                "metadata": {
+                    "chunk_idx": int(best_chunk["chunk_idx"]),
+                    "total_chunks": int(best_chunk["total_chunks"]),
+                }
             })
         return formatted_top_r
 
@@ -191,11 +411,18 @@ def embed_chunks():
     movies = load_movies()
     chunked_semantic_search = ChunkedSemanticSearch()
     chunked_semantic_search.load_or_create_chunk_embeddings(movies)
+    print_refresh_stats(chunked_semantic_search.chunk_store.last_refresh)
     return chunked_semantic_search.chunk_embeddings
 
-def search_chunks_command(query, limit):
+def build_ann_command(n_lists = None):
     movies = load_movies()
     chunked_semantic_search = ChunkedSemanticSearch()
     chunked_semantic_search.load_or_create_chunk_embeddings(movies)
-    results = chunked_semantic_search.search_chunks(query, limit)
+    return chunked_semantic_search.build_ann_index(n_lists)
+
+def search_chunks_command(query, limit, nprobe = None, encoding = "float32"):
+    movies = load_movies()
+    chunked_semantic_search = ChunkedSemanticSearch(encoding=encoding)
+    chunked_semantic_search.load_or_create_chunk_embeddings(movies)
+    results = chunked_semantic_search.search_chunks(query, limit, nprobe)
     return results
\ No newline at end of file
@@ -0,0 +1,267 @@
+import os, json, time, pickle, shutil, multiprocessing
+import numpy as np
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .dense_retrieval import normalize_rows
+from .embedding_store import content_hash, source_hash, encode_sorted
+from .tracing import span
+from .search_utils import CACHE_DIR, BUILD_SHARD_SIZE, EMBED_BATCH_SIZE, load_movies
+
+BUILD_DIR = os.path.join(CACHE_DIR, "build")
+THREAD_ENV_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS")
+
+def default_threads(workers):
+    return max(1, (os.cpu_count() or 1) // workers)
+
+@contextmanager
+def worker_thread_env(threads):
+    # Each worker gets its share of the cores for intra-op parallelism
+    # instead of every process starting one thread per core. A spawned
+    # worker imports numpy, and sizes its BLAS pool, while unpickling its
+    # target, before any initializer runs; so the variables are set here,
+    # for the workers to inherit, while they are started.
+    names = THREAD_ENV_VARS + ("TOKENIZERS_PARALLELISM",)
+    saved = {name: os.environ.get(name) for name in names}
+    os.environ.update({name: str(threads) for name in THREAD_ENV_VARS}, TOKENIZERS_PARALLELISM="false")
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+def limit_threads(threads):
+    # Torch's intra-op pool, unlike BLAS, can still be resized after import.
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+
+@contextmanager
+def shard_pool(workers, threads = None):
+    # The pool starts workers as tasks are submitted, so the environment is
+    # kept for the pool's whole lifetime.
+    threads = threads or default_threads(workers)
+    with worker_thread_env(threads), ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=limit_threads,
+        initargs=(threads,),
+    ) as pool:
+        yield pool
+
+def _checkpoint(path, write):
+    # A shard file only appears once it is complete, so its existence is
+    # the checkpoint.
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+def _model(kind, model_name):
+    if kind == "multimodal":
+        from .multimodal_search import get_clip_model
+        return get_clip_model(model_name)
+    from .semantic_search import get_model
+    return get_model(model_name)
+
+def _save_embeddings(f, vectors, texts, **extra):
+    np.savez(f, embeddings=normalize_rows(vectors) if len(texts) else np.empty((0, 0), dtype=np.float32), hashes=np.array([content_hash(text) for text in texts]), **extra)
+
+def tokenize_shard(texts, path):
+    from .keyword_search import get_tokenizer
+    token_lists = get_tokenizer().tokenize_many(texts)
+    _checkpoint(path, lambda f: pickle.dump(token_lists, f))
+
+def embed_shard(kind, model_name, texts, path):
+    model = _model(kind, model_name)
+    encode = lambda batch: model.encode(batch, batch_size=len(batch), show_progress_bar=False)
+    vectors = encode_sorted(texts, encode, EMBED_BATCH_SIZE) if texts else None
+    _checkpoint(path, lambda f: _save_embeddings(f, vectors, texts))
+
+def embed_chunk_shard(model_name, documents, start, path):
+    from .semantic_search import stream_chunks, CHUNK_METADATA_DTYPE
+    chunks = list(stream_chunks(documents))
+    metadata = np.array([(start + movie_idx, chunk_idx, total_chunks) for movie_idx, chunk_idx, total_chunks, _ in chunks], dtype=CHUNK_METADATA_DTYPE)
+    texts = [chunk for *_, chunk in chunks]
+    model = _model("semantic", model_name)
+    encode = lambda batch: model.encode(batch, batch_size=len(batch), show_progress_bar=False)
+    vectors = encode_sorted(texts, encode, EMBED_BATCH_SIZE) if texts else None
+    _checkpoint(path, lambda f: _save_embeddings(f, vectors, texts, metadata=metadata))
+
+class ShardedBuild:
+    # One artifact built from fixed-size shards of the documents. Every
+    # finished shard is checkpointed to its own file under
+    # cache/build/<name>/; a rerun with the same inputs (the fingerprint)
+    # and shard size only runs the shards that are missing. Other inputs
+    # start the build over.
+    def __init__(self, name, fingerprint, count, shard_size = BUILD_SHARD_SIZE, resume = True, extension = "npz"):
+        self.name = name
+        self.directory = os.path.join(BUILD_DIR, name)
+        self.extension = extension
+        self.shards = [(start, min(start + shard_size, count)) for start in range(0, count, shard_size)]
+        plan = {"fingerprint": fingerprint, "shard_size": shard_size, "count": count}
+        plan_path = os.path.join(self.directory, "plan.json")
+        if not resume or _read_json(plan_path) != plan:
+            shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+        with open(plan_path, "w", encoding="utf-8") as f:
+            json.dump(plan, f)
+        self.resumed = sum(os.path.exists(self.shard_path(i)) for i in range(len(self.shards)))
+
+    def shard_path(self, i):
+        return os.path.join(self.directory, f"shard-{i:05d}.{self.extension}")
+
+    def pending(self):
+        return [(i, start, end) for i, (start, end) in enumerate(self.shards) if not os.path.exists(self.shard_path(i))]
+
+    def submit(self, pool, task, args):
+        # args(start, end) gives the task's arguments before the shard path.
+        return {pool.submit(task, *args(start, end), self.shard_path(i)): (self.name, i) for i, start, end in self.pending()}
+
+    def run(self, task, args, progress = None, done = 0, total = None):
+        # The shards run one after another in this process.
+        for i, start, end in self.pending():
+            task(*args(start, end), self.shard_path(i))
+            done += 1
+            if progress:
+                progress(self.name, i, done, total)
+        return done
+
+    def embedding_parts(self):
+        for i in range(len(self.shards)):
+            with np.load(self.shard_path(i)) as shard:
+                yield shard["embeddings"], shard["hashes"].tolist()
+
+    def finish(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def stats(self):
+        return {"name": self.name, "shards": len(self.shards), "resumed": self.resumed}
+
+def _read_json(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def run_shards(futures, progress = None):
+    # Waits for every shard; on the first failure the queued shards are
+    # cancelled and the error raised, leaving the finished ones to resume from.
+    total, done = len(futures), 0
+    try:
+        for future in as_completed(futures):
+            future.result()
+            done += 1
+            if progress:
+                progress(*futures[future], done, total)
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+    return done
+
+def _build(builds, submit, workers, threads, progress):
+    started = time.perf_counter()
+    threads = threads or default_threads(workers)
+    pending = sum(len(build.shards) - build.resumed for build in builds)
+    if pending and workers <= 1:
+        # A single worker needs no pool: the shards are built in this process.
+        limit_threads(threads)
+        done = 0
+        for build, task, args in submit:
+            done = build.run(task, args, progress, done, pending)
+    elif pending:
+        with shard_pool(min(workers, pending), threads) as pool:
+            futures = {}
+            for build, task, args in submit:
+                futures.update(build.submit(pool, task, args))
+            run_shards(futures, progress)
+    return {"workers": workers, "threads": threads, "built": pending, "shard_seconds": time.perf_counter() - started, "artifacts": [build.stats() for build in builds]}
+
+def build_keyword_index(workers = 1, threads = None, shard_size = BUILD_SHARD_SIZE, resume = True, progress = None):
+    from .keyword_search import InvertedIndex, document_texts, get_tokenizer
+    with span("build.keyword", workers=workers):
+        movies = load_movies()
+        texts = document_texts(movies)
+        # Checkpointed token lists are only reused with the same stop words
+        # and stemmer.
+        build = ShardedBuild("keyword", source_hash(["bm25"] + get_tokenizer().fingerprint() + texts), len(texts), shard_size, resume, "pkl")
+        stats = _build([build], [(build, tokenize_shard, lambda start, end: (texts[start:end],))], workers, threads, progress)
+        started = time.perf_counter()
+        index = InvertedIndex()
+        token_lists = []
+        for i in range(len(build.shards)):
+            with open(build.shard_path(i), "rb") as f:
+                token_lists += pickle.load(f)
+        index.add_documents(movies, token_lists)
+        index.save()
+        build.finish()
+        stats["merge_seconds"] = time.perf_counter() - started
+        return stats
+
+def build_semantic_embeddings(workers = 1, threads = None, shard_size = BUILD_SHARD_SIZE, resume = True, progress = None):
+    # Movie and chunk embeddings share one pool, so each worker loads the
+    # model once for both.
+    from .semantic_search import ChunkedSemanticSearch, document_texts, chunk_source_hash
+    with span("build.semantic", workers=workers):
+        movies = load_movies()
+        search = ChunkedSemanticSearch()
+        texts = document_texts(movies)
+        source = source_hash(texts)
+        chunk_source = chunk_source_hash(movies)
+        fingerprint = lambda source: f"{search.model_name}:{source}"
+        movie_build = ShardedBuild("movie_embeddings", fingerprint(source), len(movies), shard_size, resume)
+        chunk_build = ShardedBuild("chunk_embeddings", fingerprint(chunk_source), len(movies), shard_size, resume)
+        stats = _build([movie_build, chunk_build], [
+            (movie_build, embed_shard, lambda start, end: ("semantic", search.model_name, texts[start:end])),
+            (chunk_build, embed_chunk_shard, lambda start, end: (search.model_name, movies[start:end], start)),
+        ], workers, threads, progress)
+
+        started = time.perf_counter()
+        search.embedding_store.write_parts(movie_build.embedding_parts(), source)
+        metadata = []
+        for i in range(len(chunk_build.shards)):
+            with np.load(chunk_build.shard_path(i)) as shard:
+                metadata.append(shard["metadata"])
+        # Saved before the manifest is published, like a streamed refresh.
+        search.chunk_store.write_parts(chunk_build.embedding_parts(), chunk_source, before_manifest=lambda: search.save_chunk_metadata(np.concatenate(metadata)))
+        if os.path.exists(search.ann_index_path):
+            search.chunk_embeddings = np.load(search.chunk_embeddings_path, mmap_mode="r")
+            search.build_ann_index()
+        movie_build.finish()
+        chunk_build.finish()
+        stats["merge_seconds"] = time.perf_counter() - started
+        return stats
+
+def build_multimodal_embeddings(workers = 1, threads = None, shard_size = BUILD_SHARD_SIZE, resume = True, progress = None):
+    from .multimodal_search import MultimodalSearch
+    with span("build.multimodal", workers=workers):
+        search = MultimodalSearch(load_movies())
+        source = source_hash(search.texts)
+        build = ShardedBuild("movie_embeddings2", f"{search.model_name}:{source}", len(search.texts), shard_size, resume)
+        stats = _build([build], [(build, embed_shard, lambda start, end: ("multimodal", search.model_name, search.texts[start:end]))], workers, threads, progress)
+        started = time.perf_counter()
+        search.embedding_store.write_parts(build.embedding_parts(), source)
+        build.finish()
+        stats["merge_seconds"] = time.perf_counter() - started
+        return stats
+
+def print_build_progress(name, shard, done, total):
+    print(f"  {name} shard {shard + 1} done ({done}/{total})", flush=True)
+
+def print_build_stats(stats):
+    for artifact in stats["artifacts"]:
+        print(f"{artifact['name']}: {artifact['shards']} shards, {artifact['resumed']} resumed from checkpoints")
+    print(f"Built {stats['built']} shards with {stats['workers']} workers x {stats['threads']} threads in {stats['shard_seconds']:.1f}s, merged in {stats['merge_seconds']:.1f}s")
+
+def add_build_arguments(parser):
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes that tokenize and encode shards")
+    parser.add_argument("--threads", type=int, help="Torch/BLAS threads per worker (defaults to the cores divided among the workers)")
+    parser.add_argument("--shard-size", type=int, default=BUILD_SHARD_SIZE, help="Documents per shard (the unit of checkpointing)")
+    parser.add_argument("--restart", action="store_true", help="Discard finished shards from an interrupted build instead of resuming")
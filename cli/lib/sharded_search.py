@@ -0,0 +1,305 @@
+import os, json, heapq, itertools, threading, multiprocessing
+import numpy as np
+from concurrent.futures import Future
+
+from .compact_index import CompactIndex
+from .dense_retrieval import DenseIndex
+from .hybrid_search import HybridSearch
+from .keyword_search import InvertedIndex, CorpusStats, document_texts, get_tokenizer
+from .semantic_search import ChunkedSemanticSearch, chunk_source_hash
+from .sharded_build import worker_thread_env, limit_threads, default_threads
+from .tracing import span, traced
+from .search_utils import CACHE_DIR, SEARCH_SHARDS, DEFAULT_SEARCH_LIMIT, BM25_K1, BM25_B, load_movies
+
+SHARDS_DIR = os.path.join(CACHE_DIR, "shards")
+SHARD_LAYOUT_VERSION = 1
+
+def shard_ranges(count, shards):
+    # Contiguous, near-equal ranges in corpus order, so a shard's local
+    # positions plus its start are global positions.
+    bounds = [count * i // shards for i in range(shards + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def _layout_path(shards):
+    return os.path.join(SHARDS_DIR, str(shards), "layout.json")
+
+def _fingerprint(header, manifest):
+    manifest = manifest or {}
+    return {
+        "documents": header["doc_count"],
+        "postings": header["posting_count"],
+        "total_doc_length": header["total_doc_length"],
+        "chunks": manifest.get("count"),
+        "chunk_source": manifest.get("source"),
+    }
+
+def _load_global(documents):
+    idx = InvertedIndex()
+    if not os.path.exists(idx.compact_path):
+        idx.build()
+        idx.save()
+    idx.load_compact()
+    semantic_search = ChunkedSemanticSearch()
+    semantic_search.load_or_create_chunk_embeddings(documents)
+    return idx, semantic_search
+
+@traced("shards.build_layout")
+def build_shard_layout(shards, documents = None):
+    # Writes one compact BM25 index per shard under cache/shards/<n>/ and a
+    # layout recording each shard's document and chunk-row ranges. Chunk
+    # rows are ordered by document, so a shard's chunks are one slice of
+    # chunk_embeddings.npy that its worker copies into its own memory.
+    documents = documents or load_movies()
+    idx, semantic_search = _load_global(documents)
+    directory = os.path.dirname(_layout_path(shards))
+    os.makedirs(directory, exist_ok=True)
+    token_lists = get_tokenizer().tokenize_many(document_texts(documents))
+    movie_idx = np.asarray(semantic_search.chunk_metadata["movie_idx"])
+    specs = []
+    for i, (start, end) in enumerate(shard_ranges(len(documents), shards)):
+        shard_idx = InvertedIndex()
+        shard_idx.add_documents(documents[start:end], token_lists[start:end])
+        shard_idx.compact_path = os.path.join(directory, f"bm25-{i:02d}.bin")
+        shard_idx.save()
+        specs.append({
+            "documents": [start, end],
+            "chunks": [int(movie_idx.searchsorted(start)), int(movie_idx.searchsorted(end))],
+            "bm25": shard_idx.compact_path,
+        })
+    layout = {
+        "format_version": SHARD_LAYOUT_VERSION,
+        "fingerprint": _fingerprint(idx.compact.header, semantic_search.chunk_store.load_manifest()),
+        "documents": idx.compact.doc_count,
+        "avg_doc_length": idx.compact.avg_doc_length(),
+        "index": idx.compact_path,
+        "chunk_embeddings": semantic_search.chunk_embeddings_path,
+        "chunk_metadata": semantic_search.chunk_metadata_binary_path,
+        "shards": specs,
+    }
+    with open(_layout_path(shards), "w", encoding="utf-8") as f:
+        json.dump(layout, f)
+    return layout
+
+def _is_current(layout, documents):
+    # Checked against the full index's header and the chunk embeddings'
+    # manifest alone, without loading either.
+    store = ChunkedSemanticSearch().chunk_store
+    manifest = store.load_manifest()
+    if not os.path.exists(layout["index"]) or store.fingerprint(manifest) is None or manifest.get("source") != chunk_source_hash(documents):
+        return False
+    header = CompactIndex(layout["index"]).header
+    return header["doc_count"] == len(documents) and layout["fingerprint"] == _fingerprint(header, manifest)
+
+def load_shard_layout(shards, documents = None):
+    # Reuses the shard files while the full index and chunk embeddings they
+    # were cut from are unchanged.
+    documents = documents or load_movies()
+    path = _layout_path(shards)
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            layout = json.load(f)
+        if layout.get("format_version") == SHARD_LAYOUT_VERSION and _is_current(layout, documents):
+            return layout
+    return build_shard_layout(shards, documents)
+
+class _Shard:
+    # The state of one shard worker process: a BM25 index over its documents
+    # scored with collection-wide statistics, and its slice of the chunk
+    # embeddings.
+    def __init__(self, layout, spec):
+        self.start = spec["documents"][0]
+        self.idx = InvertedIndex()
+        self.idx.compact_path = spec["bm25"]
+        self.idx.load_compact()
+        self.idx.corpus_stats = CorpusStats(layout["documents"], layout["avg_doc_length"])
+        row_start, row_end = spec["chunks"]
+        self.chunks = None
+        if row_start == row_end:
+            return
+        self.chunks = ChunkedSemanticSearch()
+        self.chunks.chunk_embeddings = np.array(np.load(layout["chunk_embeddings"], mmap_mode="r")[row_start:row_end])
+        self.chunks._set_chunk_metadata(np.array(np.load(layout["chunk_metadata"], mmap_mode="r")[row_start:row_end]))
+        self.chunks.chunk_index = DenseIndex(self.chunks.chunk_embeddings, normalized=True)
+
+    def bm25(self, token_lists, doc_freqs, depth, k1, b, pruning):
+        results = self.idx.bm25_top_k_many(token_lists, depth, k1, b, pruning, doc_freqs)
+        return [(self.idx._doc_id_array[top], scores, top + self.start) for top, scores in results]
+
+    def semantic(self, q_embeddings, depth):
+        return [(movie_idx, scores, movie_idx) for movie_idx, scores, _ in self.chunks.chunk_candidates_many(q_embeddings, depth)]
+
+def _serve_shard(connection, threads, layout, spec):
+    # The BLAS limits come from the environment the coordinator started
+    # this process with; torch's pool is sized here.
+    limit_threads(threads)
+    try:
+        shard = _Shard(layout, spec)
+    except Exception as e:
+        connection.send((0, False, e))
+        return
+    connection.send((0, True, None))
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        request_id, method, args = message
+        try:
+            connection.send((request_id, True, getattr(shard, method)(*args)))
+        except Exception as e:
+            connection.send((request_id, False, e))
+
+class _ShardProcess:
+    # Coordinator-side handle of one shard worker: requests are pipelined
+    # over a pipe and a reader thread resolves each reply's future, so
+    # several queries (and both retrievers) can be queued on a shard at once.
+    def __init__(self, context, threads, layout, spec):
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=_serve_shard, args=(child, threads, layout, spec), daemon=True)
+        self.process.start()
+        child.close()
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.ids = itertools.count(1)
+        self.reader = None
+
+    def wait_ready(self):
+        try:
+            _, ok, error = self.connection.recv()
+        except EOFError:
+            self.process.join(5)
+            raise RuntimeError(f"Shard worker exited during startup (exit code {self.process.exitcode})") from None
+        if not ok:
+            raise error
+        self.reader = threading.Thread(target=self._read, name="shard-reader", daemon=True)
+        self.reader.start()
+
+    def submit(self, method, *args):
+        future = Future()
+        with self.lock:
+            request_id = next(self.ids)
+            self.pending[request_id] = future
+            self.connection.send((request_id, method, args))
+        return future
+
+    def _read(self):
+        while True:
+            try:
+                request_id, ok, value = self.connection.recv()
+            except (EOFError, OSError):
+                with self.lock:
+                    pending, self.pending = self.pending, {}
+                for future in pending.values():
+                    future.set_exception(ConnectionError("Shard worker exited"))
+                return
+            with self.lock:
+                future = self.pending.pop(request_id)
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def close(self):
+        try:
+            with self.lock:
+                self.connection.send(None)
+        except OSError:
+            pass
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.connection.close()
+
+def merge_top_k(shard_results, depth):
+    # Each shard's list is sorted by descending score with ties in corpus
+    # order; merging on (-score, position) reproduces the unsharded top-k.
+    merged = list(itertools.islice(heapq.merge(*(
+        zip((-np.asarray(scores, dtype=np.float64)).tolist(), np.asarray(positions).tolist(), np.asarray(ids).tolist())
+        for ids, scores, positions in shard_results
+    )), depth))
+    dtype = shard_results[0][1].dtype if shard_results else np.float64
+    return np.array([item[2] for item in merged], dtype=np.int64), np.array([-item[0] for item in merged], dtype=dtype)
+
+class ShardCoordinator:
+    # Fans queries out to one worker process per shard and merges their
+    # top-k lists. Workers get the corpus size and average document length
+    # at startup; each BM25 request carries the document frequencies of its
+    # query terms, read here from the term table of the full index
+    # (memory-mapped, its postings are never read), so idf is global.
+    def __init__(self, shards = SEARCH_SHARDS, threads = None, documents = None):
+        self.layout = load_shard_layout(shards, documents)
+        self.global_index = CompactIndex(self.layout["index"])
+        self.tokenizer = get_tokenizer()
+        context = multiprocessing.get_context("spawn")
+        threads = threads or default_threads(shards)
+        with span("shards.start", shards=shards):
+            with worker_thread_env(threads):
+                self.workers = [_ShardProcess(context, threads, self.layout, spec) for spec in self.layout["shards"]]
+            # Shards without chunks (more shards than documents with a
+            # description) are left out of semantic requests.
+            self.semantic_workers = [worker for worker, spec in zip(self.workers, self.layout["shards"]) if spec["chunks"][0] < spec["chunks"][1]]
+            try:
+                for worker in self.workers:
+                    worker.wait_ready()
+            except BaseException:
+                self.close()
+                raise
+
+    def __len__(self):
+        return len(self.workers)
+
+    def _scatter(self, workers, method, *args):
+        futures = [worker.submit(method, *args) for worker in workers]
+        return [future.result() for future in futures]
+
+    def bm25_candidates(self, query, depth = DEFAULT_SEARCH_LIMIT, k1=BM25_K1, b=BM25_B, pruning=None):
+        return self.bm25_candidates_many([query], depth, k1, b, pruning)[0]
+
+    def bm25_candidates_many(self, queries, depth = DEFAULT_SEARCH_LIMIT, k1=BM25_K1, b=BM25_B, pruning=None):
+        with span("shards.bm25", queries=len(queries), shards=len(self.workers)):
+            token_lists = self.tokenizer.tokenize_many(queries)
+            doc_freqs = {token: self.global_index.doc_freq(token) for tokens in token_lists for token in tokens}
+            per_shard = self._scatter(self.workers, "bm25", token_lists, doc_freqs, depth, k1, b, pruning)
+            return [merge_top_k([results[i] for results in per_shard], depth) for i in range(len(queries))]
+
+    def chunk_candidates_many(self, q_embeddings, depth = DEFAULT_SEARCH_LIMIT):
+        # Returns (movie_idx, scores) per query, like chunk_candidates
+        # without the best chunk rows.
+        with span("shards.semantic", queries=len(q_embeddings), shards=len(self.semantic_workers)):
+            per_shard = self._scatter(self.semantic_workers, "semantic", np.asarray(q_embeddings, dtype=np.float32), depth)
+            return [merge_top_k([results[i] for results in per_shard], depth) for i in range(len(q_embeddings))]
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+        self.workers, self.semantic_workers = [], []
+
+class ShardedHybridSearch(HybridSearch):
+    # HybridSearch whose retrievers run in shard worker processes; this
+    # process only encodes queries (through the query cache) and fuses.
+    # Exact chunk scoring only: the IVF index is not sharded.
+    def __init__(self, documents, shards = SEARCH_SHARDS, coordinator = None, concurrent = True, timeouts = None):
+        self.coordinator = coordinator or ShardCoordinator(shards, documents=documents)
+        semantic_search = ChunkedSemanticSearch()
+        semantic_search._set_documents(documents)
+        # Memory-mapped only for packing LLM context (reranking, evaluation);
+        # the workers score the chunks.
+        semantic_search.chunk_embeddings = np.load(self.coordinator.layout["chunk_embeddings"], mmap_mode="r")
+        semantic_search._set_chunk_metadata(np.load(self.coordinator.layout["chunk_metadata"], mmap_mode="r"))
+        super().__init__(documents, None, semantic_search, self.coordinator, concurrent, timeouts)
+
+    @traced("hybrid.semantic_branch")
+    def semantic_candidates(self, query, depth, nprobe = None):
+        return self._semantic_candidates([self.semantic_search.generate_embedding(query)], depth, nprobe)[0]
+
+    @traced("hybrid.semantic_branch")
+    def semantic_candidates_many(self, queries, depth, nprobe = None):
+        return self._semantic_candidates(self.semantic_search.generate_embeddings(queries), depth, nprobe)
+
+    def _semantic_candidates(self, q_embeddings, depth, nprobe):
+        if self._nprobe(nprobe) is not None:
+            raise ValueError("Sharded search scores every chunk; nprobe is not supported")
+        return [(self.semantic_search.doc_ids[movie_idx], scores) for movie_idx, scores in self.coordinator.chunk_candidates_many(q_embeddings, depth)]
+
+    def close(self):
+        super().close()
+        self.coordinator.close()
@@ -0,0 +1,256 @@
+import os, sys, json, time, atexit, argparse, resource, threading, tracemalloc
+from functools import wraps
+
+# Spans are only recorded while a Tracer is active (--profile); otherwise
+# span() hands back a shared no-op object, so instrumented code pays one
+# global lookup per call.
+_tracer = None
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def count(self, name, value = 1):
+        pass
+
+NULL_SPAN = _NullSpan()
+
+class Span:
+    __slots__ = ("tracer", "name", "attrs", "counters", "parent", "thread", "start", "end", "memory_start", "memory_delta")
+
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.counters = {}
+        self.parent = None
+        self.memory_delta = None
+
+    def __enter__(self):
+        self.parent = self.tracer.current()
+        self.thread = threading.get_ident()
+        self.tracer._stack().append(self)
+        if self.tracer.memory:
+            self.memory_start = tracemalloc.get_traced_memory()[0]
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.end = time.perf_counter()
+        if self.tracer.memory:
+            self.memory_delta = tracemalloc.get_traced_memory()[0] - self.memory_start
+        self.tracer._stack().pop()
+        self.tracer.spans.append(self)
+        return False
+
+    def count(self, name, value = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def path(self):
+        names, span = [], self
+        while span is not None:
+            names.append(span.name)
+            span = span.parent
+        return tuple(reversed(names))
+
+class Tracer:
+    def __init__(self, memory = False):
+        self.spans = []
+        self.local = threading.local()
+        self.memory = memory
+        self.started = time.perf_counter()
+        self.finished = None
+        self.memory_peak = None
+        if memory:
+            tracemalloc.start()
+
+    def _stack(self):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def current(self):
+        stack = self._stack()
+        return stack[-1] if stack else getattr(self.local, "parent", None)
+
+    def finish(self):
+        self.finished = time.perf_counter()
+        if self.memory:
+            self.memory_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    def within(self, root):
+        def under(s):
+            while s is not None and s is not root:
+                s = s.parent
+            return s is root
+        return [s for s in self.spans if under(s)]
+
+    def stages(self, spans = None):
+        # Spans aggregated by their path from the root; each stage is listed
+        # under its parent, siblings in first-start order.
+        stages, first_start = {}, {}
+        for s in sorted(self.spans if spans is None else spans, key=lambda s: s.start):
+            path = s.path()
+            first_start.setdefault(path, s.start)
+            stage = stages.setdefault(path, {"calls": 0, "total_ms": 0.0, "counters": {}, "memory_delta": 0 if s.memory_delta is not None else None})
+            stage["calls"] += 1
+            stage["total_ms"] += (s.end - s.start) * 1000
+            for name, value in s.counters.items():
+                stage["counters"][name] = stage["counters"].get(name, 0) + value
+            if s.memory_delta is not None:
+                stage["memory_delta"] += s.memory_delta
+        order = lambda path: tuple(first_start.get(path[:i], 0.0) for i in range(1, len(path) + 1))
+        return {path: stages[path] for path in sorted(stages, key=order)}
+
+    def summary(self):
+        return {
+            "wall_ms": ((self.finished or time.perf_counter()) - self.started) * 1000,
+            "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            "peak_traced_bytes": self.memory_peak,
+        }
+
+    def format_report(self):
+        summary = self.summary()
+        header = f"Profile: {summary['wall_ms']:.1f} ms wall, peak RSS {summary['peak_rss_bytes'] / 2**20:.1f} MiB"
+        if summary["peak_traced_bytes"] is not None:
+            header += f", peak traced Python memory {summary['peak_traced_bytes'] / 2**20:.1f} MiB"
+        lines = [header]
+        for path, stage in self.stages().items():
+            label = "  " * (len(path) - 1) + path[-1]
+            share = stage["total_ms"] / summary["wall_ms"] if summary["wall_ms"] else 0.0
+            line = f"  {label:<44} {stage['calls']:>5}x {stage['total_ms']:>10.2f} ms {share:>6.1%}"
+            if stage["memory_delta"] is not None:
+                line += f" {stage['memory_delta'] / 2**20:>+8.2f} MiB"
+            if stage["counters"]:
+                line += "  " + ", ".join(f"{name}={value}" for name, value in stage["counters"].items())
+            lines.append(line)
+        return "\n".join(lines)
+
+    def format_span(self, root):
+        # One span's own stage tree, e.g. a single server request.
+        wall_ms = (root.end - root.start) * 1000
+        attrs = " ".join(f"{name}={value}" for name, value in root.attrs.items())
+        lines = [f"Profile {root.name}: {wall_ms:.1f} ms" + (f" ({attrs})" if attrs else "")]
+        for path, stage in self.stages(self.within(root)).items():
+            if len(path) == 1:
+                continue
+            label = "  " * (len(path) - 2) + path[-1]
+            line = f"  {label:<44} {stage['calls']:>5}x {stage['total_ms']:>10.2f} ms"
+            if stage["counters"]:
+                line += "  " + ", ".join(f"{name}={value}" for name, value in stage["counters"].items())
+            lines.append(line)
+        return "\n".join(lines)
+
+    def chrome_trace(self):
+        # Trace Event Format, loadable in chrome://tracing and Perfetto.
+        pid = os.getpid()
+        events = []
+        for s in self.spans:
+            events.append({
+                "name": s.name,
+                "cat": s.name.split(".")[0],
+                "ph": "X",
+                "ts": (s.start - self.started) * 1e6,
+                "dur": (s.end - s.start) * 1e6,
+                "pid": pid,
+                "tid": s.thread,
+                "args": {**s.attrs, **s.counters, **({"memory_delta": s.memory_delta} if s.memory_delta is not None else {})},
+            })
+        stages = [{"stage": "/".join(path), **stage} for path, stage in self.stages().items()]
+        return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {**self.summary(), "stages": stages}}
+
+def span(name, **attrs):
+    tracer = _tracer
+    if tracer is None:
+        return NULL_SPAN
+    return Span(tracer, name, attrs)
+
+def count(name, value = 1):
+    tracer = _tracer
+    if tracer is None:
+        return
+    current = tracer.current()
+    if current is not None:
+        current.count(name, value)
+
+def traced(name):
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return fn(*args, **kwargs)
+            with Span(_tracer, name, {}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def report_span(s):
+    # Prints a finished span's stage tree while profiling; a no-op otherwise.
+    tracer = _tracer
+    if tracer is None or s is NULL_SPAN:
+        return
+    print(tracer.format_span(s), file=sys.stderr)
+
+def bind(fn):
+    # Carries the submitting thread's span into a worker thread so pool
+    # tasks nest under the stage that started them.
+    tracer = _tracer
+    if tracer is None:
+        return fn
+    parent = tracer.current()
+    @wraps(fn)
+    def bound(*args, **kwargs):
+        tracer.local.parent = parent
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            tracer.local.parent = None
+    return bound
+
+def start_tracing(memory = False):
+    global _tracer
+    _tracer = Tracer(memory)
+    return _tracer
+
+def stop_tracing():
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None:
+        tracer.finish()
+    return tracer
+
+def write_trace(tracer, path):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(tracer.chrome_trace(), f)
+
+def add_profile_arguments(parser):
+    # Added to every subcommand so the flags go after it, e.g.
+    # `hybrid_search_cli.py rrf-search "query" --profile trace.json`.
+    subparsers = [action for action in parser._actions if isinstance(action, argparse._SubParsersAction)]
+    targets = [subparser for action in subparsers for subparser in action.choices.values()] or [parser]
+    for target in targets:
+        target.add_argument("--profile", type=str, nargs="?", const="-", metavar="TRACE_JSON", help="Print a per-stage latency breakdown on exit; with a path, also write a Chrome trace JSON file")
+        target.add_argument("--profile-memory", action="store_true", help="Also record Python allocations per stage with tracemalloc (slower)")
+
+def start_profiling(args):
+    target = getattr(args, "profile", None)
+    if target is None:
+        return None
+    tracer = start_tracing(getattr(args, "profile_memory", False))
+    root = Span(tracer, os.path.basename(sys.argv[0]).removesuffix(".py"), {"argv": sys.argv[1:]})
+    root.__enter__()
+    atexit.register(_finish_profiling, root, target)
+    return tracer
+
+def _finish_profiling(root, target):
+    root.__exit__(None, None, None)
+    tracer = stop_tracing()
+    print(tracer.format_report(), file=sys.stderr)
+    if target != "-":
+        write_trace(tracer, target)
+        print(f"Wrote Chrome trace to {target}", file=sys.stderr)
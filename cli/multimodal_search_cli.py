@@ -1,6 +1,10 @@
-import argparse
+import argparse, os
 
-from lib.multimodal_search import verify_image_embedding_command, image_search_command
+from lib.multimodal_search import verify_image_embedding_command, image_search_command, text_search_command
+from lib.search_utils import EMBEDDING_ENCODINGS, DEFAULT_SEARCH_SERVER
+from lib.search_client import server_request
+from lib.sharded_build import add_build_arguments, build_multimodal_embeddings, print_build_progress, print_build_stats
+from lib.tracing import add_profile_arguments, start_profiling
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="Hybrid Search CLI")
@@ -9,14 +13,33 @@ def main() -> None:
     verify_image_embedding_parser.add_argument("image_path", type=str, help="Required image path to embed")
     image_search_parser = subparsers.add_parser("image_search", help="Image to search for similar movies")
     image_search_parser.add_argument("image_path", type=str, help="Required image path to search")
+    image_search_parser.add_argument("--encoding", type=str, choices=EMBEDDING_ENCODINGS, default="float32", help="Embedding storage encoding to search with")
+    image_search_parser.add_argument("--server", type=str, nargs='?', const=DEFAULT_SEARCH_SERVER, help="Send the request to a running search_server_cli.py instead of loading models locally")
+    build_parser = subparsers.add_parser("build", help="Rebuild the CLIP text embeddings across worker processes")
+    add_build_arguments(build_parser)
+    text_search_parser = subparsers.add_parser("text_search", help="Text query to search for similar movies in the image model's embedding space")
+    text_search_parser.add_argument("query", type=str, help="Query to search")
+    text_search_parser.add_argument("--limit", type=int, default=5, help="Limit search")
+    text_search_parser.add_argument("--encoding", type=str, choices=EMBEDDING_ENCODINGS, default="float32", help="Embedding storage encoding to search with")
     
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    start_profiling(args)
 
     match args.command:
         case "verify_image_embedding":
             verify_image_embedding_command(args.image_path)
         case "image_search":
-            results = image_search_command(args.image_path)
+            if args.server:
+                results = server_request(args.server, "image", {"image_path": os.path.abspath(args.image_path), "encoding": args.encoding})
+            else:
+                results = image_search_command(args.image_path, args.encoding)
+            for i, result in enumerate(results, start=1):
+                print(f"{i}. {result["title"]} (similarity: {result["similarity_score"]:.3f}) \n   {result["description"][:200]}...")
+        case "build":
+            print_build_stats(build_multimodal_embeddings(args.workers, args.threads, args.shard_size, not args.restart, print_build_progress))
+        case "text_search":
+            results = text_search_command(args.query, args.limit, args.encoding)
             for i, result in enumerate(results, start=1):
                 print(f"{i}. {result["title"]} (similarity: {result["similarity_score"]:.3f}) \n   {result["description"][:200]}...")
             
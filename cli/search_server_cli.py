@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+import argparse
+from lib.search_server import serve_command
+from lib.search_utils import SEARCH_SERVER_HOST, SEARCH_SERVER_PORT
+from lib.tracing import add_profile_arguments, start_profiling
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Search Server CLI")
+    subparsers = parser.add_subparsers(dest="command", help="Available commands")
+    serve_parser = subparsers.add_parser("serve", help="Serve keyword, semantic, hybrid, image and RAG search over a local JSON API")
+    serve_parser.add_argument("--host", type=str, default=SEARCH_SERVER_HOST, help="Interface to bind")
+    serve_parser.add_argument("--port", type=int, default=SEARCH_SERVER_PORT, help="Port to listen on")
+    serve_parser.add_argument("--preload", action="store_true", help="Load the hybrid search models and indexes before accepting requests")
+    serve_parser.add_argument("--quiet", action="store_true", help="Do not log requests")
+
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    start_profiling(args)
+
+    match args.command:
+        case "serve":
+            serve_command(args.host, args.port, args.preload, args.quiet)
+        case _:
+            parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 import argparse
-from lib.semantic_search import verify_model, embed_text, verify_embeddings, embed_query_text, search, chunking, semantic_chunk, embed_chunks, search_chunks_command
-from lib.search_utils import DEFAULT_SEARCH_LIMIT, DEFAULT_CHUNK_LIMIT
+from lib.semantic_search import verify_model, embed_text, verify_embeddings, embed_query_text, search, print_search_results, chunking, semantic_chunk, embed_chunks, build_ann_command, search_chunks_command
+from lib.search_utils import DEFAULT_SEARCH_LIMIT, DEFAULT_CHUNK_LIMIT, EMBEDDING_ENCODINGS, DEFAULT_SEARCH_SERVER
+from lib.search_client import server_request
+from lib.query_cache import get_query_cache, format_cache_stats
+from lib.sharded_build import add_build_arguments, build_semantic_embeddings, print_build_progress, print_build_stats
+from lib.tracing import add_profile_arguments, start_profiling
 
 def main():
     parser = argparse.ArgumentParser(description="Semantic Search CLI")
@@ -15,6 +19,8 @@ def main():
     search_parser = subparsers.add_parser("search", help="Search similar movies")
     search_parser.add_argument("query", type=str, help="Query to search similar movies.")
     search_parser.add_argument("--limit", type=int, nargs='?', default=DEFAULT_SEARCH_LIMIT, help="Tunable search limit")
+    search_parser.add_argument("--encoding", type=str, choices=EMBEDDING_ENCODINGS, default="float32", help="Embedding storage encoding to search with")
+    search_parser.add_argument("--server", type=str, nargs='?', const=DEFAULT_SEARCH_SERVER, help="Send the request to a running search_server_cli.py instead of loading models locally")
     chunk_parser = subparsers.add_parser("chunk", help="Chunk documents")
     chunk_parser.add_argument("text", type=str, help="Text to chunk")
     chunk_parser.add_argument("--chunk-size", type=int, nargs='?', default=DEFAULT_CHUNK_LIMIT, help="Tunable search limit")
@@ -27,8 +33,19 @@ def main():
     search_chunked_parser = subparsers.add_parser("search_chunked", help="Search best scores for a query")
     search_chunked_parser.add_argument("query", type=str, help="Query to search")
     search_chunked_parser.add_argument("--limit", type=int, nargs='?', default=5, help="Tunable search limit")
+    search_chunked_parser.add_argument("--nprobe", type=int, help="Search the ANN index, probing this many inverted lists")
+    search_chunked_parser.add_argument("--encoding", type=str, choices=EMBEDDING_ENCODINGS, default="float32", help="Embedding storage encoding to search with")
+    search_chunked_parser.add_argument("--server", type=str, nargs='?', const=DEFAULT_SEARCH_SERVER, help="Send the request to a running search_server_cli.py instead of loading models locally")
+    build_parser = subparsers.add_parser("build", help="Rebuild the movie and chunk embeddings across worker processes")
+    add_build_arguments(build_parser)
+    build_ann_parser = subparsers.add_parser("build_ann", help="Build an IVF approximate nearest-neighbour index over the chunk embeddings")
+    build_ann_parser.add_argument("--lists", type=int, help="Number of inverted lists (defaults to 4 * sqrt(chunks))")
+    query_cache_parser = subparsers.add_parser("query_cache", help="Show the persistent query-embedding cache")
+    query_cache_parser.add_argument("--clear", action="store_true", help="Delete every cached query embedding")
 
+    add_profile_arguments(parser)
     args = parser.parse_args()
+    start_profiling(args)
 
     match args.command:
         case "verify":
@@ -40,7 +57,10 @@ def main():
         case "embedquery":
             embed_query_text(args.query)
         case "search":
-            search(args.query, args.limit)
+            if args.server:
+                print_search_results(server_request(args.server, "semantic", {"query": args.query, "limit": args.limit, "encoding": args.encoding}))
+            else:
+                search(args.query, args.limit, args.encoding)
         case "chunk":
             chunking(args.text, args.chunk_size, args.overlap)
         case "semantic_chunk":
@@ -53,10 +73,24 @@ def main():
             chunked_embbedings = embed_chunks()
             print(f"Generated {len(chunked_embbedings)} chunked embeddings")
         case "search_chunked":
-            results = search_chunks_command(args.query, args.limit)
+            if args.server:
+                results = server_request(args.server, "chunked", {"query": args.query, "limit": args.limit, "nprobe": args.nprobe, "encoding": args.encoding})
+            else:
+                results = search_chunks_command(args.query, args.limit, args.nprobe, args.encoding)
             for i, result in enumerate(results):
-                print(f"\n{i}. {result['title']} (score: {result['score']:.4f})")
+                print(f"\n{i}. {result['title']} (score: {result['score']:.4f}, best chunk: {result['metadata']['chunk_idx'] + 1}/{result['metadata']['total_chunks']})")
                 print(f"   {result['document']}...")
+        case "build":
+            print_build_stats(build_semantic_embeddings(args.workers, args.threads, args.shard_size, not args.restart, print_build_progress))
+        case "build_ann":
+            ann_index = build_ann_command(args.lists)
+            print(f"Built IVF index with {ann_index.n_lists} lists over {len(ann_index)} chunks")
+        case "query_cache":
+            query_cache = get_query_cache()
+            if args.clear:
+                query_cache.clear()
+                print("Cleared the query embedding cache")
+            print(format_cache_stats(query_cache.stats()))
         case _:
             parser.print_help()
 
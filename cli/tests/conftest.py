@@ -0,0 +1,37 @@
+import sys, random
+import pytest
+
+from lib import keyword_search
+
+WORDS = ["space", "war", "love", "ship", "alien", "robot", "detective", "murder", "island", "dragon", "king", "school", "heist", "zombie", "ghost", "pirate"]
+
+@pytest.fixture(autouse=True)
+def tokenizer(monkeypatch):
+    # The stop word list lives in data/, which the tests do not need.
+    tokenizer = keyword_search.Tokenizer(stop_words=["the", "a", "of", "and"])
+    monkeypatch.setattr(keyword_search, "get_tokenizer", lambda: tokenizer)
+    return tokenizer
+
+@pytest.fixture
+def movies():
+    rng = random.Random(0)
+    return [
+        {"id": i + 1, "title": f"{rng.choice(WORDS).title()} {i}", "description": " ".join(rng.choices(WORDS, k=rng.randint(5, 40)))}
+        for i in range(400)
+    ]
+
+@pytest.fixture
+def make_index(movies):
+    def make():
+        idx = keyword_search.InvertedIndex()
+        idx.add_documents(movies, idx.tokenizer.tokenize_many(keyword_search.document_texts(movies)))
+        return idx
+    return make
+
+@pytest.fixture
+def fast_switching():
+    # Threads switch every microsecond, so unsynchronized state shows up.
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield
+    sys.setswitchinterval(interval)
@@ -0,0 +1,38 @@
+from types import SimpleNamespace
+import numpy as np
+
+from lib import evaluation, rerank
+from lib.context_builder import document_chunks
+from lib.semantic_search import ChunkedSemanticSearch, chunk_metadata_array, stream_chunks, semantic_chunk
+from lib.search_utils import SEMANTIC_CHUNK_SIZE, SEMANTIC_CHUNK_OVERLAP
+
+def test_document_chunks_uses_the_chunk_ranges(movies):
+    documents = [dict(movie, description=movie["description"].replace(" ", ". ", 4 * (i % 4))) for i, movie in enumerate(movies[:50])]
+    documents[7]["description"] = ""
+    semantic_search = ChunkedSemanticSearch()
+    semantic_search._set_documents(documents)
+    semantic_search._set_chunk_metadata(chunk_metadata_array(
+        {"movie_idx": movie_idx, "chunk_idx": chunk_idx, "total_chunks": total} for movie_idx, chunk_idx, total, _ in stream_chunks(documents)
+    ))
+    results = [{"document": documents[i]} for i in (13, 7, 3, 0, 47)]
+    rows, owners, texts = document_chunks(semantic_search, results)
+    assert len(rows) > len(results)
+    movie_idx = semantic_search.chunk_metadata["movie_idx"]
+    expected = [row for i in (13, 7, 3, 0, 47) for row in np.flatnonzero(movie_idx == i)]
+    assert rows.tolist() == expected
+    assert owners.tolist() == [[13, 7, 3, 0, 47].index(movie_idx[row]) for row in expected]
+    assert texts == [semantic_chunk(documents[movie_idx[row]]["description"], SEMANTIC_CHUNK_SIZE, SEMANTIC_CHUNK_OVERLAP)[semantic_search.chunk_metadata[row]["chunk_idx"]] for row in expected]
+
+def test_unparseable_relevance_scores_are_zero(monkeypatch):
+    replies = [SimpleNamespace(text="7"), SimpleNamespace(text="Eight"), TimeoutError(), SimpleNamespace(text=' "10"\n')]
+    monkeypatch.setattr(evaluation, "generate_content_many", lambda model, prompts, **kwargs: replies)
+    assert evaluation.answer_relevance_many(["q"] * 4, ["a"] * 4) == [7, 0, 0, 10]
+
+def test_batch_rerank_skips_invented_and_repeated_ids(movies, monkeypatch):
+    results = [{"document": movie} for movie in movies[:4]]
+    ids = [movie["id"] for movie in movies[:4]]
+    reply = SimpleNamespace(text=str([ids[2], -1, ids[0], ids[2], ids[3]]))
+    monkeypatch.setattr(rerank, "generate_content", lambda *args, **kwargs: reply)
+    reranked = rerank.batch_rerank(results, "q")
+    assert [result["document"]["id"] for result in reranked] == [ids[2], ids[0], ids[3]]
+    assert [result["llm_rank"] for result in reranked] == [1, 2, 3]
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from lib.embedding_store import EmbeddingStore
+
+class Encoder:
+    # Deterministic vectors per text, recording every text it encodes.
+    def __init__(self):
+        self.texts = []
+
+    def __call__(self, texts):
+        self.texts += texts
+        return np.array([[len(text), sum(map(ord, text)) % 7, 1.0] for text in texts], dtype=np.float32)
+
+def refresh(store, texts, source = None, window = 2, **kwargs):
+    encoder = Encoder()
+    embeddings = np.array(store.refresh_stream(iter(texts), encoder, batch_size=2, window=window, source=source, **kwargs))
+    return embeddings, encoder.texts
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "cache" / "embeddings.npy")
+
+def test_edited_text_is_reencoded(path):
+    store = EmbeddingStore(path, "model")
+    before, _ = refresh(store, ["alien", "robot", "ghost"])
+    after, encoded = refresh(store, ["alien", "robots", "ghost"])
+    assert encoded == ["robots"]
+    assert store.last_refresh["reused"] == 2 and store.last_refresh["dropped"] == 1
+    assert np.array_equal(after[[0, 2]], before[[0, 2]])
+
+def test_deleted_text_is_dropped(path):
+    store = EmbeddingStore(path, "model")
+    before, _ = refresh(store, ["alien", "robot", "ghost"])
+    after, encoded = refresh(store, ["alien", "ghost"])
+    assert encoded == [] and store.last_refresh["dropped"] == 1
+    assert np.array_equal(after, before[[0, 2]])
+    assert store.load_manifest()["count"] == 2
+
+def test_model_change_invalidates_the_cache(path):
+    refresh(EmbeddingStore(path, "model"), ["alien", "robot"], source="s")
+    other = EmbeddingStore(path, "other")
+    assert other.open("s") is None
+    _, encoded = refresh(other, ["alien", "robot"], source="s")
+    assert encoded == ["alien", "robot"]
+
+def test_identical_texts_are_encoded_once_across_windows(path):
+    store = EmbeddingStore(path, "model")
+    embeddings, encoded = refresh(store, ["alien", "robot", "alien", "ghost", "robot", "alien"])
+    assert encoded == ["alien", "robot", "ghost"]
+    assert store.last_refresh["encoded"] == 3 and store.last_refresh["duplicates"] == 3
+    assert np.array_equal(embeddings[[2, 5]], embeddings[[0, 0]]) and np.array_equal(embeddings[4], embeddings[1])
+
+def test_stale_manifest_is_rejected(path):
+    store = EmbeddingStore(path, "model")
+    refresh(store, ["alien", "robot", "ghost"], source="s1")
+    assert store.open("s1") is not None
+    assert store.open("s2") is None
+    np.save(path, np.zeros((2, 3), dtype=np.float32))
+    assert store.open("s1") is None
+
+def test_metadata_failure_leaves_no_manifest(path):
+    store = EmbeddingStore(path, "model")
+    refresh(store, ["alien", "robot"], source="s1")
+    def crash():
+        raise OSError("disk full")
+    with pytest.raises(OSError):
+        refresh(store, ["alien", "ghost"], source="s2", before_manifest=crash)
+    assert store.open("s1") is None and store.open("s2") is None
@@ -0,0 +1,68 @@
+import os, sys, time, threading, subprocess
+import numpy as np
+import pytest
+
+from lib.hybrid_search import HybridSearch, BranchExecutor
+
+CLI_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class SlowRetrievers:
+    # Both retrievers of a HybridSearch: BM25 answers at once, the semantic
+    # branch takes `delay` seconds.
+    def __init__(self, delay):
+        self.delay = delay
+        self.doc_ids = np.arange(1, 11)
+        self.document_map = {int(i): {"id": int(i), "title": str(i)} for i in self.doc_ids}
+
+    def bm25_candidates(self, query, depth):
+        return self.doc_ids[:depth], np.linspace(1, 0, len(self.doc_ids))[:depth]
+
+    def generate_embedding(self, query):
+        time.sleep(self.delay)
+        return np.zeros(2)
+
+    def chunk_candidates(self, q_embedding, depth, nprobe = None):
+        top = np.arange(len(self.doc_ids))[::-1][:depth]
+        return top, np.ones(len(top)), top
+
+def hybrid(delay, concurrent):
+    retrievers = SlowRetrievers(delay)
+    return HybridSearch([], semantic_search=retrievers, idx=retrievers, concurrent=concurrent)
+
+@pytest.mark.parametrize("concurrent", [True, False])
+def test_timed_out_branch_is_dropped(concurrent):
+    search = hybrid(0.3, concurrent)
+    results = search.rrf_search("q", 60, limit=3, timeouts={"semantic": 0.1})
+    assert search.last_search_stats["timed_out"] == ["semantic"]
+    assert [result["semantic_rank"] for result in results] == [None] * 3
+    search.close()
+
+def test_sequential_branch_past_its_deadline_is_skipped():
+    search = hybrid(0.3, False)
+    search.candidates("q", 5, timeouts={"bm25": 0.0})
+    assert search.last_search_stats["timed_out"] == ["bm25"]
+    assert list(search.last_search_stats["branch_ms"]) == ["semantic"]
+
+def test_timed_out_branch_does_not_delay_exit():
+    script = (
+        "import sys; sys.path[:0] = ['tests', '.']\n"
+        "from test_hybrid_search import hybrid\n"
+        "search = hybrid(30, True)\n"
+        "search.rrf_search('q', 60, limit=3, timeouts={'semantic': 0.1})\n"
+        "search.close()\n"
+    )
+    started = time.perf_counter()
+    subprocess.run([sys.executable, "-c", script], cwd=CLI_DIR, check=True, timeout=20)
+    assert time.perf_counter() - started < 10
+
+def test_shutdown_cancels_queued_branches():
+    executor = BranchExecutor(max_workers=1)
+    release = threading.Event()
+    running = executor.submit(release.wait)
+    queued = executor.submit(lambda: "never")
+    executor.shutdown(wait=False, cancel_futures=True)
+    assert queued.cancelled()
+    release.set()
+    assert running.result(timeout=5) is True
+    with pytest.raises(RuntimeError):
+        executor.submit(lambda: None)
@@ -0,0 +1,47 @@
+import threading
+import pytest
+
+from lib import keyword_search
+
+@pytest.mark.parametrize("pruning", [None, "wand", "bmw"])
+def test_threads_share_a_fresh_index(make_index, fast_switching, pruning):
+    expected = make_index().bm25_candidates("space war robot", 10, pruning=pruning)
+    for _ in range(20):
+        idx = make_index()
+        start = threading.Barrier(8)
+        results, errors = [], []
+        def search():
+            start.wait()
+            try:
+                results.append(idx.bm25_candidates("space war robot", 10, pruning=pruning))
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=search) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors
+        for doc_ids, scores in results:
+            assert doc_ids.tolist() == expected[0].tolist()
+            assert scores.tolist() == expected[1].tolist()
+
+def test_search_stats_are_returned_per_call(make_index):
+    idx = make_index()
+    _, exhaustive = idx.bm25_search_stats("space war", 5)
+    _, pruned = idx.bm25_search_stats("space war", 5, pruning="wand")
+    assert exhaustive["method"] == "exhaustive" and pruned["method"] == "wand"
+    assert pruned["scored"] + pruned["skipped"] == pruned["matched"] == exhaustive["matched"]
+
+@pytest.mark.parametrize("pruning", [None, "wand", "bmw"])
+def test_shard_scores_with_per_call_doc_freqs(movies, make_index, pruning):
+    full = make_index()
+    shard = keyword_search.InvertedIndex()
+    shard.add_documents(movies[:200], shard.tokenizer.tokenize_many(keyword_search.document_texts(movies[:200])))
+    full._prepare_scoring()
+    shard.corpus_stats = keyword_search.CorpusStats(len(movies), full._avg_doc_length)
+    token_lists = [full.tokenize(query) for query in ("space war", "robot detective ghost")]
+    doc_freqs = {token: len(full.index[token]) for tokens in token_lists for token in tokens}
+    for (top, scores), tokens in zip(shard.bm25_top_k_many(token_lists, 10, pruning=pruning, doc_freqs=doc_freqs), token_lists):
+        assert scores.tolist() == pytest.approx(full.bm25_scores(tokens)[top].tolist())
+    assert shard.corpus_stats.doc_freqs == {}
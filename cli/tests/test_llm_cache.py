@@ -0,0 +1,57 @@
+from types import SimpleNamespace
+import pytest
+
+from lib import llm_client
+from lib.llm_cache import LLMResponseCache, format_llm_cache_stats
+from lib.llm_scheduler import LLMScheduler, StubAPIError
+
+def reply(text):
+    return SimpleNamespace(text=text, usage_metadata=None)
+
+@pytest.fixture
+def model(tmp_path, monkeypatch):
+    # Answers each prompt with its "reply" part; "fail" raises a
+    # non-retryable error.
+    calls = []
+    def call(model, contents, config):
+        calls.append(contents)
+        if contents == "fail":
+            raise StubAPIError(400, "INVALID_ARGUMENT")
+        return reply(contents.split(":")[-1])
+    cache = LLMResponseCache(str(tmp_path / "llm_responses.sqlite"))
+    monkeypatch.setattr(llm_client, "get_llm_cache", lambda: cache)
+    monkeypatch.setattr(llm_client, "get_scheduler", lambda api_key_env, model: LLMScheduler(call, 600, 250_000))
+    return SimpleNamespace(calls=calls, cache=cache)
+
+def test_unwritable_directory_disables_the_cache(tmp_path):
+    blocker = tmp_path / "blocker"
+    blocker.write_text("")
+    cache = LLMResponseCache(str(blocker / "cache" / "llm_responses.sqlite"))
+    assert cache.get("key") is None
+    cache.put("key", "model", reply("3"))
+    assert cache.get("key") is None
+    cache.clear()
+    stats = cache.stats()
+    assert stats["entries"] == 0 and stats["misses"] == 2 and not stats["disk_available"]
+    assert "unavailable" in format_llm_cache_stats(stats)
+
+def test_successes_of_a_failed_batch_are_cached(model):
+    with pytest.raises(StubAPIError):
+        llm_client.generate_content_many("model", ["a:1", "fail", "b:2"])
+    responses = llm_client.generate_content_many("model", ["a:1", "b:2"])
+    assert [response.text for response in responses] == ["1", "2"]
+    assert all(response.cached for response in responses)
+    assert model.calls.count("a:1") == 1
+
+def test_unparseable_replies_are_not_cached(model):
+    responses = llm_client.generate_content_many("model", ["a:1", "b:two"], parse=int)
+    assert [response.text for response in responses] == ["1", "two"]
+    assert llm_client.generate_content("model", "b:two", parse=int).text == "two"
+    assert model.calls.count("b:two") == 2
+    assert getattr(llm_client.generate_content("model", "a:1", parse=int), "cached", False)
+
+@pytest.mark.parametrize("text", ['  "Alien (1979)" is the one.\n', '"Yes"', ' " " ', "", '"say "hi" " \n'])
+def test_streamed_text_is_stripped_like_blocking_text(text):
+    for size in (1, 2, 5):
+        chunks = [text[i:i + size] for i in range(0, len(text), size)]
+        assert "".join(llm_client._normalized(chunks)) == text.strip().strip('"')
@@ -0,0 +1,99 @@
+import time, threading
+import pytest
+
+from lib.llm_scheduler import LLMScheduler, StubClient, StubAPIError
+
+def stub_call(client):
+    return lambda model, contents, config: client.models.generate_content(model=model, contents=contents, config=config)
+
+def test_requests_are_paced_to_the_quota():
+    scheduler = LLMScheduler(stub_call(StubClient(latency=0)), 600, 250_000)
+    scheduler.requests.tokens = 0
+    started = time.monotonic()
+    responses = scheduler.generate_many("model", [f"prompt {i}" for i in range(5)])
+    assert len(responses) == 5
+    # 600 requests per minute is one every 0.1s once the bucket is empty.
+    assert time.monotonic() - started >= 0.4
+    assert scheduler.stats()["throttled_seconds"] > 0
+
+def test_transient_errors_are_retried():
+    failures = iter([StubAPIError(429, "RESOURCE_EXHAUSTED"), StubAPIError(503, "UNAVAILABLE")])
+    def call(model, contents, config):
+        error = next(failures, None)
+        if error is not None:
+            raise error
+        return "ok"
+    scheduler = LLMScheduler(call, 600, 250_000, base_delay=0.01)
+    assert scheduler.generate("model", "prompt") == "ok"
+    assert scheduler.stats()["retries"] == 2
+
+def test_permanent_errors_are_not_retried():
+    def call(model, contents, config):
+        raise StubAPIError(400, "INVALID_ARGUMENT")
+    scheduler = LLMScheduler(call, 600, 250_000, base_delay=0.01)
+    with pytest.raises(StubAPIError):
+        scheduler.generate("model", "prompt")
+    assert scheduler.stats()["retries"] == 0
+
+def test_batch_longer_than_the_deadline_completes():
+    # Ten requests paced at one per 0.1s take about a second in all;
+    # each one only has to finish within 0.3s of getting its quota.
+    client = StubClient(latency=0)
+    scheduler = LLMScheduler(stub_call(client), 600, 250_000, deadline=0.3)
+    scheduler.requests.tokens = 1
+    responses = scheduler.generate_many("model", [f"prompt {i}" for i in range(10)])
+    assert len(responses) == 10 and client.calls == 10
+    assert scheduler.stats()["failures"] == 0
+
+def test_deadline_bounds_the_call():
+    def call(model, contents, config):
+        time.sleep(0.5)
+        return "late"
+    scheduler = LLMScheduler(call, 600, 250_000, deadline=0.1, max_retries=0)
+    started = time.monotonic()
+    with pytest.raises(TimeoutError):
+        scheduler.generate("model", "prompt")
+    assert time.monotonic() - started < 0.4
+
+def test_failed_items_do_not_discard_the_batch():
+    def call(model, contents, config):
+        if contents == "bad":
+            raise StubAPIError(400, "INVALID_ARGUMENT")
+        return contents.upper()
+    scheduler = LLMScheduler(call, 600, 250_000)
+    results = scheduler.generate_many("model", ["a", "bad", "c"], return_exceptions=True)
+    assert results[0] == "A" and results[2] == "C"
+    assert isinstance(results[1], StubAPIError)
+    with pytest.raises(StubAPIError):
+        scheduler.generate_many("model", ["a", "bad"])
+
+def test_abandoned_call_keeps_its_concurrency_slot():
+    lock = threading.Lock()
+    running, peak = [0], [0]
+    def call(model, contents, config):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.4 if contents == "slow" else 0.01)
+        with lock:
+            running[0] -= 1
+        return contents
+    scheduler = LLMScheduler(call, 600, 250_000, max_concurrency=1, max_retries=0)
+    slow = scheduler.submit("model", "slow", deadline=0.1)
+    with pytest.raises(TimeoutError):
+        slow.result()
+    assert scheduler.generate("model", "fast") == "fast"
+    assert peak[0] == 1
+
+def test_opening_a_stream_is_retried():
+    failures = iter([StubAPIError(429, "RESOURCE_EXHAUSTED")])
+    def open_stream():
+        error = next(failures, None)
+        if error is not None:
+            raise error
+        return iter(["a", "b"])
+    scheduler = LLMScheduler(None, 600, 250_000, base_delay=0.01)
+    _, chunks = scheduler.open_stream(open_stream, "prompt")
+    assert list(chunks) == ["a", "b"]
+    stats = scheduler.stats()
+    assert stats["retries"] == 1 and stats["requests"] == 2
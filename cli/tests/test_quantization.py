@@ -0,0 +1,23 @@
+import os
+import numpy as np
+
+from lib.quantization import QuantizedIndex, open_dense_index, quantized_path
+
+def embeddings():
+    vectors = np.random.default_rng(0).standard_normal((200, 16)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def test_codes_without_a_fingerprint_are_not_saved(tmp_path):
+    path = str(tmp_path / "embeddings.npy")
+    open_dense_index(embeddings(), path, "int8", normalized=True)
+    assert not os.path.exists(quantized_path(path, "int8"))
+
+def test_saved_codes_are_reused_for_the_same_fingerprint(tmp_path):
+    path = str(tmp_path / "embeddings.npy")
+    first = open_dense_index(embeddings(), path, "int8", normalized=True, fingerprint="a")
+    saved = os.path.getmtime(quantized_path(path, "int8"))
+    second = open_dense_index(embeddings(), path, "int8", normalized=True, fingerprint="a")
+    assert os.path.getmtime(quantized_path(path, "int8")) == saved
+    assert np.array_equal(first.codes, second.codes)
+    open_dense_index(embeddings(), path, "int8", normalized=True, fingerprint="b")
+    assert QuantizedIndex.load(quantized_path(path, "int8")).fingerprint == "b"
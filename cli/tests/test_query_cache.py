@@ -0,0 +1,31 @@
+import numpy as np
+
+from lib.query_cache import QueryEmbeddingCache, format_cache_stats
+
+def encode(query):
+    return np.full(4, len(query), dtype=np.float32)
+
+def encode_many(queries):
+    return np.stack([encode(query) for query in queries])
+
+def test_round_trip_through_disk(tmp_path):
+    path = tmp_path / "cache" / "query_embeddings.sqlite"
+    QueryEmbeddingCache(str(path)).get("model", "Space  War", encode)
+    cache = QueryEmbeddingCache(str(path))
+    assert cache.get("model", "space war", encode).tolist() == [9.0] * 4
+    assert cache.stats()["disk_hits"] == 1
+
+def test_unwritable_directory_falls_back_to_memory(tmp_path):
+    # A path below a regular file can never be created, even as root.
+    blocker = tmp_path / "blocker"
+    blocker.write_text("")
+    cache = QueryEmbeddingCache(str(blocker / "cache" / "query_embeddings.sqlite"))
+    assert cache.get("model", "space war", encode).tolist() == [9.0] * 4
+    assert cache.get("model", "space war", encode).tolist() == [9.0] * 4
+    assert cache.get_many("model", ["space war", "love"], encode_many).shape == (2, 4)
+    stats = cache.stats()
+    assert stats["memory_hits"] == 2 and stats["misses"] == 2
+    assert stats["disk_entries"] == 0 and not stats["disk_available"]
+    assert "memory only" in format_cache_stats(stats)
+    cache.clear()
+    assert cache.stats()["memory_entries"] == 0
@@ -0,0 +1,118 @@
+import json, threading
+import numpy as np
+import pytest
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib import request, error
+
+from lib.hybrid_search import HybridSearch
+from lib.search_server import SearchService, BadRequest, make_server
+from lib.tracing import span, start_tracing, stop_tracing
+
+class FakeChunkedSearch:
+    # Stands in for the chunk embeddings: scores documents by a hash of the
+    # query, so both hybrid branches return candidates without a model.
+    def __init__(self, movies):
+        self.doc_ids = np.array([movie["id"] for movie in movies], dtype=np.int64)
+        self.document_map = {movie["id"]: movie for movie in movies}
+
+    def generate_embedding(self, query):
+        return np.random.default_rng(sum(query.encode("utf-8"))).random(len(self.doc_ids))
+
+    def chunk_candidates(self, q_embedding, depth, nprobe = None):
+        top = np.argsort(-q_embedding, kind="stable")[:depth]
+        return top, q_embedding[top], top
+
+def make_service(movies, idx):
+    service = SearchService()
+    service._resources["movies"] = movies
+    service._resources["keyword"] = idx
+    service._resources["hybrid"] = HybridSearch(movies, semantic_search=FakeChunkedSearch(movies), idx=idx)
+    return service
+
+QUERIES = ["space war", "love ship alien", "robot detective", "murder island king", "dragon school heist", "zombie ghost pirate", "war love"]
+
+def run(service, job):
+    kind, query, option = job
+    match kind:
+        case "keyword":
+            return service.keyword_search(query, 10, pruning=option)
+        case "weighted":
+            return service.weighted_search(query, limit=10)
+        case "rrf":
+            return service.rrf_search(query, limit=10)
+
+def test_concurrent_queries_match_sequential(movies, make_index, fast_switching):
+    jobs = [(kind, query, pruning) for query in QUERIES for kind, pruning in [("keyword", None), ("keyword", "wand"), ("keyword", "bmw"), ("weighted", None), ("rrf", None)]] * 4
+    expected = [run(make_service(movies, make_index()), job) for job in jobs]
+    # One service with a fresh index, and the first queries released
+    # together, so scoring state is prepared while they race each other.
+    service = make_service(movies, make_index())
+    start = threading.Barrier(8)
+    def run_job(i, job):
+        if i < 8:
+            start.wait()
+        return run(service, job)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(run_job, range(len(jobs)), jobs))
+    assert results == expected
+
+class BrokenService(SearchService):
+    def endpoints(self):
+        def broken(query):
+            return len(None)
+        def bad_reply(query):
+            return json.loads("not json")
+        def unknown_id(query):
+            return {}[query]
+        def checked(mode):
+            raise BadRequest(f"Unknown mode '{mode}'")
+        def staged(query):
+            with span("test.stage") as s:
+                s.count("hits", 3)
+            return []
+        return {"broken": broken, "bad_reply": bad_reply, "unknown_id": unknown_id, "checked": checked, "staged": staged}
+
+@pytest.fixture
+def server():
+    server = make_server("127.0.0.1", 0, BrokenService(), quiet=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+def post(server, payload, endpoint = "broken"):
+    req = request.Request(f"{server}/{endpoint}", data=json.dumps(payload).encode("utf-8"))
+    try:
+        with request.urlopen(req) as response:
+            return response.status
+    except error.HTTPError as e:
+        return e.code
+
+def test_bad_arguments_are_client_errors(server):
+    assert post(server, {"query": "x", "limit": 3}) == 400
+    assert post(server, {}) == 400
+
+def test_internal_type_errors_are_server_errors(server, capsys):
+    assert post(server, {"query": "x"}) == 500
+
+def test_errors_raised_while_searching_are_server_errors(server, capsys):
+    assert post(server, {"query": "x"}, "bad_reply") == 500
+    assert post(server, {"query": "x"}, "unknown_id") == 500
+    assert "JSONDecodeError" in capsys.readouterr().err
+
+def test_rejected_arguments_are_client_errors(server):
+    assert post(server, {"mode": "x"}, "checked") == 400
+
+def test_profiled_requests_log_their_stage_tree(server, capsys):
+    start_tracing()
+    try:
+        assert post(server, {"query": "x"}, "staged") == 200
+        assert post(server, {"query": "x"}, "staged") == 200
+    finally:
+        tracer = stop_tracing()
+    err = capsys.readouterr().err
+    assert err.count("Profile server.staged") == 2
+    assert err.count("test.stage") == 2 and "hits=3" in err
+    assert tracer.stages()[("server.staged", "test.stage")]["calls"] == 2
@@ -0,0 +1,27 @@
+import os
+
+from lib import sharded_build
+from lib.keyword_search import Tokenizer
+from lib.sharded_build import ShardedBuild, shard_pool, _build
+
+def test_workers_start_with_the_thread_limits(monkeypatch):
+    monkeypatch.delenv("OMP_NUM_THREADS", raising=False)
+    with shard_pool(2, threads=3) as pool:
+        assert pool.submit(os.getenv, "OMP_NUM_THREADS").result() == "3"
+        assert pool.submit(os.getenv, "TOKENIZERS_PARALLELISM").result() == "false"
+    assert "OMP_NUM_THREADS" not in os.environ
+
+def test_one_worker_builds_in_process(tmp_path, monkeypatch):
+    monkeypatch.setattr(sharded_build, "BUILD_DIR", str(tmp_path))
+    build = ShardedBuild("test", "fingerprint", 10, shard_size=4, extension="txt")
+    # A closure cannot be sent to a worker process.
+    def write(start, end, path):
+        with open(path, "w") as f:
+            f.write(f"{start}-{end}")
+    progress = []
+    stats = _build([build], [(build, write, lambda start, end: (start, end))], 1, None, lambda *args: progress.append(args))
+    assert stats["built"] == 3 and progress[-1] == ("test", 2, 3, 3)
+    assert [open(build.shard_path(i)).read() for i in range(3)] == ["0-4", "4-8", "8-10"]
+
+def test_tokenizer_fingerprint_covers_the_stop_words():
+    assert Tokenizer(stop_words=["the"]).fingerprint() != Tokenizer(stop_words=["the", "a"]).fingerprint()